@@ -0,0 +1,12 @@
+'''
+fsnd_auth
+Auth0 access token verification shared by the Flask apps of this repository
+
+    BasicFlaskAuth/app.py and the coffee shop backend both use it, their
+    requirements.txt install it from the repository root (setup.py).
+'''
+from .auth import (AuthError, Auth0, check_permissions,
+                   get_token_auth_header)
+from .jwks import JWKSCache, JWKSUnavailable, shared_jwks_cache
+from .permissions import ALL, ANY, Permissions, required_permissions
+from .token_cache import TokenCache
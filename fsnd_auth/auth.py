@@ -0,0 +1,255 @@
+from flask import request
+from functools import wraps
+from jose import jwt
+
+from .jwks import JWKSUnavailable, shared_jwks_cache
+from .permissions import ALL, ANY, Permissions, required_permissions
+from .token_cache import TokenCache
+
+## AuthError Exception
+'''
+AuthError Exception
+A standardized way to communicate auth failure modes
+'''
+class AuthError(Exception):
+    def __init__(self, error, status_code):
+        self.error = error
+        self.status_code = status_code
+
+
+## Auth Header
+
+'''
+get_token_auth_header()
+    it should attempt to get the header from the request
+        it should raise an AuthError if no header is present
+    it should attempt to split bearer and the token
+        it should raise an AuthError if the header is malformed
+    return the token part of the header
+'''
+def get_token_auth_header():
+    auth = request.headers.get("Authorization", None)
+    if not auth:
+        raise AuthError({"code": "authorization_header_missing",
+                        "description":
+                            "Authorization header is expected"}, 401)
+
+    parts = auth.split()
+
+    if parts[0].lower() != "bearer":
+        raise AuthError({"code": "invalid_header",
+                        "description":
+                            "Authorization header must start with"
+                            " Bearer"}, 401)
+    elif len(parts) == 1:
+        raise AuthError({"code": "invalid_header",
+                        "description": "Token not found"}, 401)
+    elif len(parts) > 2:
+        raise AuthError({"code": "invalid_header",
+                        "description":
+                            "Authorization header must be"
+                            " Bearer token"}, 401)
+
+    token = parts[1]
+    return token
+
+'''
+check_permissions(permission, payload)
+    @INPUTS
+        permission: string permission (i.e. 'post:drink'), or a list of them
+        payload: decoded jwt payload
+        match: ALL (every permission is required) or ANY (one is enough)
+        granted: the payload permissions already compiled with
+            Permissions.from_payload(payload), built from payload when omitted
+
+    it should raise an AuthError if permissions are not included in the payload
+        !!NOTE check your RBAC settings in Auth0
+    it should raise an AuthError if the requested permission string is not in the payload permissions array
+    return true otherwise
+'''
+def check_permissions(permission, payload, match=ALL, granted=None):
+    if granted is None:
+        granted = Permissions.from_payload(payload)
+    if granted is None:
+        raise AuthError({
+            'code': 'invalid_claims',
+            'description': 'Permissions not included in JWT.'
+        }, 400)
+
+    if isinstance(permission, frozenset):
+        required = permission
+    else:
+        required = required_permissions(permission)
+    if not granted.allows(required, match):
+        raise AuthError({
+            'code': 'unauthorized',
+            'description': 'Permission not found.'
+        }, 403)
+    return True
+
+'''
+Auth0
+verifies the Auth0 access tokens of one API
+
+    @INPUTS
+        domain: the Auth0 tenant domain (i.e. 'example.us.auth0.com')
+        audience: the API audience
+        algorithms: accepted signing algorithms
+        jwks_file: path to a local copy of the tenant JWKS, when set the keys
+            are only ever read from that file (offline mode)
+        jwks_ttl: seconds before the keys are revalidated in the background
+        jwks_min_refresh_interval: minimum seconds between refetches forced
+            by tokens carrying an unknown kid
+        token_cache_size: maximum number of verified tokens kept, 0 disables
+            the verified token cache
+        token_cache_max_ttl: upper bound in seconds on how long a verified
+            payload is reused, entries never outlive the token exp claim
+
+    the signing keys come from a process-wide cache shared by every Auth0
+    instance of the same tenant (or jwks file)
+    EXAMPLE
+        auth = Auth0('example.us.auth0.com', 'coffeeShop')
+        auth.prefetch()
+
+        @app.route('/drinks-detail')
+        @auth.requires_auth('get:drinks-detail')
+        def get_drinks_detail(payload):
+            ...
+'''
+class Auth0:
+    def __init__(self, domain, audience, algorithms=('RS256',),
+                 jwks_file=None, jwks_ttl=600, jwks_min_refresh_interval=30,
+                 token_cache_size=1024, token_cache_max_ttl=300):
+        self.domain = domain
+        self.audience = audience
+        self.algorithms = list(algorithms)
+        self.issuer = 'https://' + domain + '/'
+        self.jwks_cache = shared_jwks_cache(
+            f'https://{domain}/.well-known/jwks.json',
+            jwks_file=jwks_file,
+            ttl=jwks_ttl,
+            min_refresh_interval=jwks_min_refresh_interval)
+        self.token_cache = TokenCache(maxsize=token_cache_size,
+                                      max_ttl=token_cache_max_ttl,
+                                      enabled=token_cache_size > 0)
+
+    '''
+    prefetch()
+        loads the signing keys at startup so the first request does not pay
+        for the fetch, returns False if they could not be loaded
+    '''
+    def prefetch(self):
+        return self.jwks_cache.prefetch()
+
+    '''
+    verify_decode_jwt(token)
+        @INPUTS
+            token: a json web token (string)
+
+        it should be an Auth0 token with key id (kid)
+        it should verify the token using the tenant keys (see jwks_cache)
+            it should raise an AuthError (503) if the keys cannot be fetched
+        it should decode the payload from the token
+        it should validate the claims
+        return the decoded payload
+    '''
+    def verify_decode_jwt(self, token):
+        try:
+            unverified_header = jwt.get_unverified_header(token)
+        except jwt.JWTError:
+            raise AuthError({
+                'code': 'invalid_header',
+                'description': 'Unable to parse authentication token.'
+            }, 400)
+        if 'kid' not in unverified_header:
+            raise AuthError({
+                'code': 'invalid_header',
+                'description': 'Authorization malformed.'
+            }, 401)
+
+        try:
+            rsa_key = self.jwks_cache.get_key(unverified_header['kid'])
+        except JWKSUnavailable:
+            raise AuthError({
+                'code': 'jwks_unavailable',
+                'description': 'Unable to fetch the signing keys.'
+            }, 503)
+        if rsa_key:
+            try:
+                payload = jwt.decode(
+                    token,
+                    rsa_key,
+                    algorithms=self.algorithms,
+                    audience=self.audience,
+                    issuer=self.issuer
+                )
+
+                return payload
+
+            except jwt.ExpiredSignatureError:
+                raise AuthError({
+                    'code': 'token_expired',
+                    'description': 'Token expired.'
+                }, 401)
+
+            except jwt.JWTClaimsError:
+                raise AuthError({
+                    'code': 'invalid_claims',
+                    'description': 'Incorrect claims. Please, check the audience and issuer.'
+                }, 401)
+            except Exception:
+                raise AuthError({
+                    'code': 'invalid_header',
+                    'description': 'Unable to parse authentication token.'
+                }, 400)
+        raise AuthError({
+                    'code': 'invalid_header',
+                    'description': 'Unable to find the appropriate key.'
+                }, 400)
+
+    '''
+    verify_token(token)
+        returns (payload, permissions) for token, from the verified token
+        cache when possible, verifying and caching it otherwise
+    '''
+    def verify_token(self, token):
+        cached = self.token_cache.get(token)
+        if cached is not None:
+            return cached
+        payload = self.verify_decode_jwt(token)
+        granted = Permissions.from_payload(payload)
+        self.token_cache.put(token, payload, granted)
+        return payload, granted
+
+    '''
+    requires_auth(*permissions, match=ALL)
+        @INPUTS
+            permissions: string permissions (i.e. 'post:drink'), none, one
+                or more. without permissions any valid token is accepted
+            match: ALL (default) requires every permission, ANY requires one
+            EXAMPLE
+                @auth.requires_auth('patch:drinks', 'delete:drinks', match=ANY)
+
+        it should use the get_token_auth_header method to get the token
+        it should use the verify_decode_jwt method to decode the jwt
+            (skipped when the token is already in token_cache)
+        it should use the check_permissions method validate claims and check the requested permission
+            (on every request, cached payloads included)
+        return the decorator which passes the decoded payload to the decorated method
+    '''
+    def requires_auth(self, *permissions, match=ALL):
+        if match not in (ALL, ANY):
+            raise ValueError('match must be ALL or ANY')
+        required = required_permissions(*permissions)
+
+        def requires_auth_decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                token = get_token_auth_header()
+                payload, granted = self.verify_token(token)
+                if required:
+                    check_permissions(required, payload, match, granted)
+                return f(payload, *args, **kwargs)
+
+            return wrapper
+        return requires_auth_decorator
@@ -0,0 +1,240 @@
+import json
+import os
+import threading
+import time
+from urllib.request import urlopen
+
+'''
+JWKSUnavailable Exception
+raised when no signing keys have been loaded yet and they cannot be fetched
+'''
+class JWKSUnavailable(Exception):
+    pass
+
+
+'''
+JWKSCache
+an in-process cache of the identity provider signing keys, indexed by kid
+
+    keys are served from memory for `ttl` seconds after a successful fetch.
+    once the ttl has passed the stale keys keep being served while a single
+    background thread refetches them (stale-while-revalidate), so a slow
+    identity provider never blocks request threads.
+    an unknown kid forces a synchronous refetch (the provider may have rotated
+    its keys), but at most once every `min_refresh_interval` seconds so a
+    flood of tokens with garbage kids cannot trigger refetch storms.
+    before any key was loaded a lookup fetches them, and raises
+    JWKSUnavailable when that fails. failed fetches are retried at most once
+    every `min_refresh_interval` seconds too, lookups in between fail fast.
+
+    the url can be anything urlopen understands, so a local stand-in works:
+        JWKSCache('file:///path/to/jwks.json')
+        JWKSCache('http://127.0.0.1:8000/.well-known/jwks.json')
+    for offline mode, where no outbound call is ever made, use
+        JWKSCache.from_file('/path/to/jwks.json')
+'''
+class JWKSCache:
+    def __init__(self, url, ttl=600, min_refresh_interval=30, timeout=5,
+                 fetch=None):
+        self.url = url
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self._fetch = fetch or self._fetch_url
+        self._keys = None
+        self._fetched_at = 0.0
+        self._last_attempt = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+        self._fetch_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_errors = 0
+
+    '''
+    from_file(path)
+        a cache that loads the keys from a local JWKS file (a saved copy of
+        https://<domain>/.well-known/jwks.json) and never touches the network
+    '''
+    @classmethod
+    def from_file(cls, path, **options):
+        path = os.path.abspath(path)
+
+        def read_file():
+            with open(path) as jwks_file:
+                return json.load(jwks_file)
+
+        return cls('file://' + path, fetch=read_file, **options)
+
+    '''
+    prefetch()
+        loads the keys ahead of the first request, e.g. at app startup
+        returns False instead of raising when the keys cannot be loaded,
+        requests then retry once `min_refresh_interval` has passed
+    '''
+    def prefetch(self):
+        try:
+            self.refresh()
+        except Exception:
+            return False
+        return True
+
+    '''
+    get_key(kid)
+        returns the rsa key dict for kid, or None if the provider does not
+        publish such a key
+        raises JWKSUnavailable if no keys are loaded and they cannot be
+    '''
+    def get_key(self, kid):
+        keys = self._keys
+        if keys is None:
+            keys = self._load_cold()
+        elif time.monotonic() - self._fetched_at > self.ttl:
+            self._revalidate_in_background()
+
+        key = keys.get(kid)
+        if key is not None:
+            self.hits += 1
+            return key
+
+        self.misses += 1
+        if self._refresh_allowed():
+            try:
+                keys = self.refresh()
+            except Exception:
+                return None
+            return keys.get(kid)
+        return None
+
+    '''
+    refresh()
+        fetches the key set synchronously and swaps it in
+        returns the new keys, raises if the fetch fails
+    '''
+    def refresh(self):
+        with self._fetch_lock:
+            return self._refresh_locked()
+
+    '''
+    stats()
+        hit/miss/refresh counters, useful for logging and tests
+    '''
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'refreshes': self.refreshes,
+            'refresh_errors': self.refresh_errors,
+            'keys': len(self._keys or ()),
+        }
+
+    def _load_cold(self):
+        # only one thread fetches, the others wait and reuse its result, or
+        # fail fast once it failed
+        with self._fetch_lock:
+            if self._keys is not None:
+                return self._keys
+            if self._last_attempt is not None and time.monotonic() - \
+                    self._last_attempt < self.min_refresh_interval:
+                raise JWKSUnavailable('signing keys could not be fetched '
+                                      'from ' + self.url)
+            try:
+                return self._refresh_locked()
+            except Exception as error:
+                raise JWKSUnavailable('signing keys could not be fetched '
+                                      'from ' + self.url) from error
+
+    def _refresh_locked(self):
+        # the caller holds _fetch_lock
+        self._last_attempt = time.monotonic()
+        try:
+            jwks = self._fetch()
+        except Exception:
+            self.refresh_errors += 1
+            raise
+        keys = self._index(jwks)
+        with self._lock:
+            self._keys = keys
+            self._fetched_at = time.monotonic()
+            self.refreshes += 1
+        return keys
+
+    def _refresh_allowed(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._last_attempt is not None and \
+                    now - self._last_attempt < self.min_refresh_interval:
+                return False
+            self._last_attempt = now
+            return True
+
+    def _revalidate_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        thread = threading.Thread(target=self._background_refresh, daemon=True)
+        thread.start()
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        except Exception:
+            # keep serving the stale keys, the next expired read retries
+            with self._lock:
+                self._fetched_at = time.monotonic() - self.ttl + \
+                    self.min_refresh_interval
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def _fetch_url(self):
+        with urlopen(self.url, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    @staticmethod
+    def _index(jwks):
+        keys = {}
+        for key in jwks.get('keys', []):
+            if 'kid' not in key:
+                continue
+            keys[key['kid']] = {
+                'kty': key.get('kty'),
+                'kid': key['kid'],
+                'use': key.get('use'),
+                'n': key.get('n'),
+                'e': key.get('e')
+            }
+        return keys
+
+
+_shared_caches = {}
+_shared_caches_lock = threading.Lock()
+
+'''
+shared_jwks_cache(url, jwks_file)
+    returns the process-wide cache for a key source, creating it on first use
+    so every app and decorator verifying tokens of the same identity provider
+    shares one set of keys and one refresh schedule
+    raises ValueError if options (ttl, min_refresh_interval, timeout) differ
+    from the ones the shared cache was created with
+'''
+def shared_jwks_cache(url, jwks_file=None, **options):
+    source = os.path.abspath(jwks_file) if jwks_file else url
+    with _shared_caches_lock:
+        cache = _shared_caches.get(source)
+        if cache is None:
+            if jwks_file:
+                cache = JWKSCache.from_file(jwks_file, **options)
+            else:
+                cache = JWKSCache(url, **options)
+            _shared_caches[source] = cache
+        else:
+            conflicts = sorted(name for name, value in options.items()
+                               if getattr(cache, name, None) != value)
+            if conflicts:
+                raise ValueError('the shared JWKS cache of {} was created '
+                                 'with other {}'.format(source,
+                                                        ', '.join(conflicts)))
+        return cache
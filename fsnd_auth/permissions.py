@@ -0,0 +1,67 @@
+'''
+match modes for checking several required permissions at once
+    ALL: every required permission must be granted
+    ANY: at least one required permission must be granted
+'''
+ALL = 'all'
+ANY = 'any'
+
+'''
+Permissions
+the permissions claim of a decoded jwt payload, compiled once into a frozenset
+
+    membership checks are O(1) instead of a scan of the claim list, and the
+    object is cached alongside the payload so it is built once per token.
+    EXAMPLE
+        granted = Permissions.from_payload(payload)
+        granted.allows(required_permissions('post:drinks', 'patch:drinks'), ANY)
+'''
+class Permissions:
+    __slots__ = ('granted',)
+
+    def __init__(self, granted):
+        self.granted = frozenset(granted)
+
+    '''
+    from_payload(payload)
+        returns the compiled permissions, or None when the payload carries
+        no permissions claim
+    '''
+    @classmethod
+    def from_payload(cls, payload):
+        if payload.get('permissions') is None:
+            return None
+        return cls(payload['permissions'])
+
+    '''
+    allows(required, match)
+        required: a frozenset as returned by required_permissions()
+        match: ALL or ANY
+        an empty requirement is always allowed
+    '''
+    def allows(self, required, match=ALL):
+        if not required:
+            return True
+        if match == ANY:
+            return not self.granted.isdisjoint(required)
+        return self.granted.issuperset(required)
+
+    def __contains__(self, permission):
+        return permission in self.granted
+
+    def __len__(self):
+        return len(self.granted)
+
+
+'''
+required_permissions(*permissions)
+    normalizes a permission string, or several, into a frozenset
+    empty strings are ignored
+'''
+def required_permissions(*permissions):
+    required = set()
+    for permission in permissions:
+        if isinstance(permission, str):
+            permission = (permission,)
+        required.update(p for p in permission if p)
+    return frozenset(required)
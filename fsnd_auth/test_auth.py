@@ -0,0 +1,449 @@
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from unittest import mock
+from urllib.error import URLError
+
+import rsa
+from flask import Flask
+from jose import jwk, jwt
+
+from fsnd_auth import ANY, Auth0, AuthError, JWKSCache, JWKSUnavailable, \
+    Permissions, TokenCache, check_permissions
+
+AUTH0_DOMAIN = 'fsnd-test.us.auth0.com'
+API_AUDIENCE = 'fsndTest'
+
+
+def generate_key(kid):
+    """Generate a local RSA key pair, returns (private pem, public jwk)."""
+    _, private_key = rsa.newkeys(1024)
+    pem = private_key.save_pkcs1().decode()
+    public_jwk = jwk.construct(pem, 'RS256').public_key().to_dict()
+    public_jwk.update({'kid': kid, 'use': 'sig'})
+    return pem, public_jwk
+
+
+def make_token(pem, kid, **claims):
+    payload = {
+        'iss': 'https://' + AUTH0_DOMAIN + '/',
+        'aud': API_AUDIENCE,
+        'sub': 'auth0|tester',
+        'exp': int(time.time()) + 3600,
+        'permissions': ['get:drinks-detail']
+    }
+    payload.update(claims)
+    return jwt.encode(payload, pem, algorithm='RS256', headers={'kid': kid})
+
+
+class JWKSCacheTestCase(unittest.TestCase):
+    """This class represents the JWKS key cache test case"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.pem, cls.public_jwk = generate_key('key-1')
+        cls.rotated_pem, cls.rotated_jwk = generate_key('key-2')
+
+    def setUp(self):
+        handle, self.jwks_path = tempfile.mkstemp(suffix='.json')
+        os.close(handle)
+        self.write_jwks([self.public_jwk])
+        self.jwks_url = 'file://' + self.jwks_path
+        self.auth = Auth0(AUTH0_DOMAIN, API_AUDIENCE)
+
+    def tearDown(self):
+        if os.path.exists(self.jwks_path):
+            os.remove(self.jwks_path)
+
+    def write_jwks(self, keys):
+        with open(self.jwks_path, 'w') as jwks_file:
+            json.dump({'keys': keys}, jwks_file)
+
+    def test_keys_are_fetched_once(self):
+        """Test repeated verifications reuse the cached keys"""
+        self.auth.jwks_cache = JWKSCache(self.jwks_url)
+        token = make_token(self.pem, 'key-1')
+
+        for _ in range(5):
+            payload = self.auth.verify_decode_jwt(token)
+
+        self.assertEqual(payload['sub'], 'auth0|tester')
+        self.assertEqual(self.auth.jwks_cache.stats()['refreshes'], 1)
+        self.assertEqual(self.auth.jwks_cache.stats()['hits'], 5)
+        self.assertEqual(self.auth.jwks_cache.stats()['misses'], 0)
+
+    def test_unknown_kid_refreshes_for_rotated_keys(self):
+        """Test a new kid triggers a refetch that picks up rotated keys"""
+        self.auth.jwks_cache = JWKSCache(self.jwks_url,
+                                         min_refresh_interval=0)
+        self.auth.verify_decode_jwt(make_token(self.pem, 'key-1'))
+
+        self.write_jwks([self.public_jwk, self.rotated_jwk])
+        payload = self.auth.verify_decode_jwt(
+            make_token(self.rotated_pem, 'key-2'))
+
+        self.assertEqual(payload['sub'], 'auth0|tester')
+        self.assertEqual(self.auth.jwks_cache.stats()['refreshes'], 2)
+        self.assertEqual(self.auth.jwks_cache.stats()['misses'], 1)
+
+    def test_unknown_kid_refresh_is_rate_limited(self):
+        """Test garbage kids cannot trigger a refetch storm"""
+        cache = JWKSCache(self.jwks_url, min_refresh_interval=60)
+        cache.get_key('key-1')
+
+        for i in range(50):
+            self.assertIsNone(cache.get_key('garbage-%d' % i))
+
+        self.assertEqual(cache.stats()['misses'], 50)
+        self.assertEqual(cache.stats()['refreshes'], 1)
+
+    def test_unknown_kid_raises_auth_error(self):
+        """Test tokens signed with an unpublished key are rejected"""
+        self.auth.jwks_cache = JWKSCache(self.jwks_url)
+
+        with self.assertRaises(AuthError) as context:
+            self.auth.verify_decode_jwt(make_token(self.rotated_pem, 'key-2'))
+
+        self.assertEqual(context.exception.status_code, 400)
+
+    def test_expired_keys_are_served_while_revalidating(self):
+        """Test a slow provider does not block lookups once keys expired"""
+        release = threading.Event()
+        calls = []
+
+        def slow_fetch():
+            calls.append(1)
+            if len(calls) > 1:
+                release.wait(5)
+            return {'keys': [self.public_jwk]}
+
+        cache = JWKSCache(self.jwks_url, ttl=0, fetch=slow_fetch)
+        cache.get_key('key-1')
+
+        started = time.monotonic()
+        for _ in range(10):
+            self.assertIsNotNone(cache.get_key('key-1'))
+        elapsed = time.monotonic() - started
+        release.set()
+
+        self.assertLess(elapsed, 1)
+        self.assertEqual(len(calls), 2)
+
+    def test_failed_refresh_keeps_stale_keys(self):
+        """Test a provider outage after startup keeps the last known keys"""
+        cache = JWKSCache(self.jwks_url, ttl=60)
+        cache.get_key('key-1')
+        os.remove(self.jwks_path)
+
+        cache._fetched_at -= 120
+        self.assertIsNotNone(cache.get_key('key-1'))
+        for _ in range(100):
+            if not cache._refreshing:
+                break
+            time.sleep(0.01)
+
+        self.assertIsNotNone(cache.get_key('key-1'))
+        self.assertEqual(cache.stats()['refresh_errors'], 1)
+
+    def test_provider_outage_before_first_fetch(self):
+        """Test an unreachable provider is an auth error, fetched once"""
+        calls = []
+
+        def failing_fetch():
+            calls.append(1)
+            raise URLError('connection refused')
+
+        self.auth.jwks_cache = JWKSCache(
+            self.jwks_url, min_refresh_interval=60, fetch=failing_fetch)
+        token = make_token(self.pem, 'key-1')
+
+        for _ in range(5):
+            with self.assertRaises(AuthError) as context:
+                self.auth.verify_decode_jwt(token)
+            self.assertEqual(context.exception.status_code, 503)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(self.auth.jwks_cache.stats()['refresh_errors'], 1)
+
+    def test_cold_fetch_retried_after_interval(self):
+        """Test a failed first fetch is retried once the interval passed"""
+        cache = JWKSCache(self.jwks_url, min_refresh_interval=60)
+        os.rename(self.jwks_path, self.jwks_path + '.down')
+        with self.assertRaises(JWKSUnavailable):
+            cache.get_key('key-1')
+        os.rename(self.jwks_path + '.down', self.jwks_path)
+
+        with self.assertRaises(JWKSUnavailable):
+            cache.get_key('key-1')
+        cache._last_attempt -= 60
+        self.assertIsNotNone(cache.get_key('key-1'))
+        self.assertEqual(cache.stats()['refreshes'], 1)
+
+    def test_concurrent_cold_lookups_fetch_once(self):
+        """Test threads waiting on the first fetch reuse its keys"""
+        calls = []
+
+        def slow_fetch():
+            calls.append(1)
+            time.sleep(0.2)
+            return {'keys': [self.public_jwk]}
+
+        cache = JWKSCache(self.jwks_url, fetch=slow_fetch)
+        keys = []
+        threads = [threading.Thread(
+            target=lambda: keys.append(cache.get_key('key-1')))
+            for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(keys), 5)
+        self.assertTrue(all(keys))
+
+    def test_local_http_jwks_server(self):
+        """Test the cache against a local stand-in identity provider"""
+        body = json.dumps({'keys': [self.public_jwk]}).encode()
+        requests = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests.append(self.path)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            url = 'http://127.0.0.1:%d/.well-known/jwks.json' % \
+                server.server_address[1]
+            self.auth.jwks_cache = JWKSCache(url)
+            token = make_token(self.pem, 'key-1')
+            for _ in range(3):
+                self.auth.verify_decode_jwt(token)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        self.assertEqual(requests, ['/.well-known/jwks.json'])
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    """This class represents the verified token cache test case"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.pem, cls.public_jwk = generate_key('key-1')
+        cls.app = Flask(__name__)
+
+    def setUp(self):
+        self.auth = Auth0(AUTH0_DOMAIN, API_AUDIENCE, token_cache_size=2)
+        self.auth.jwks_cache = JWKSCache(
+            'unused', fetch=lambda: {'keys': [self.public_jwk]})
+
+        @self.auth.requires_auth('get:drinks-detail')
+        def protected(payload):
+            return payload
+
+        self.protected = protected
+
+    def call(self, token):
+        headers = {'Authorization': 'Bearer ' + token}
+        with self.app.test_request_context(headers=headers):
+            return self.protected()
+
+    def test_repeated_token_skips_verification(self):
+        """Test the signature is verified once per token"""
+        token = make_token(self.pem, 'key-1')
+
+        for _ in range(5):
+            payload = self.call(token)
+
+        self.assertEqual(payload['sub'], 'auth0|tester')
+        self.assertEqual(self.auth.jwks_cache.stats()['hits'], 1)
+        self.assertEqual(self.auth.token_cache.stats()['hits'], 4)
+        self.assertEqual(self.auth.token_cache.stats()['misses'], 1)
+
+    def test_permissions_checked_against_cached_payload(self):
+        """Test a cached token still needs the required permission"""
+        token = make_token(self.pem, 'key-1', permissions=['get:drinks'])
+
+        for _ in range(2):
+            with self.assertRaises(AuthError) as context:
+                self.call(token)
+            self.assertEqual(context.exception.status_code, 403)
+
+        self.assertEqual(self.auth.token_cache.stats()['hits'], 1)
+
+    def test_entries_expire_with_token(self):
+        """Test a payload is not reused past the token exp claim"""
+        cache = TokenCache()
+        cache.put('token', {'exp': time.time() - 1})
+        cache.put('no-exp', {'sub': 'x'})
+
+        self.assertIsNone(cache.get('token'))
+        self.assertIsNone(cache.get('no-exp'))
+        self.assertEqual(cache.stats()['expirations'], 1)
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_least_recently_used_token_is_evicted(self):
+        """Test the cache is bounded and evicts the oldest token"""
+        tokens = [make_token(self.pem, 'key-1', sub=str(i)) for i in range(3)]
+        for token in tokens:
+            self.call(token)
+
+        self.assertEqual(self.auth.token_cache.stats()['size'], 2)
+        self.assertEqual(self.auth.token_cache.stats()['evictions'], 1)
+        self.assertIsNone(self.auth.token_cache.get(tokens[0]))
+
+    def test_disabled_cache_verifies_every_request(self):
+        """Test the switch turns caching off"""
+        self.auth.token_cache.enabled = False
+        token = make_token(self.pem, 'key-1')
+
+        for _ in range(3):
+            self.call(token)
+
+        self.assertEqual(self.auth.jwks_cache.stats()['hits'], 3)
+        self.assertEqual(self.auth.token_cache.stats()['size'], 0)
+
+
+class SharedAuthTestCase(unittest.TestCase):
+    """This class represents the shared, offline capable setup test case"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.pem, cls.public_jwk = generate_key('key-1')
+        cls.app = Flask(__name__)
+
+    def setUp(self):
+        handle, self.jwks_path = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(handle, 'w') as jwks_file:
+            json.dump({'keys': [self.public_jwk]}, jwks_file)
+
+    def tearDown(self):
+        os.remove(self.jwks_path)
+
+    def test_offline_mode_never_opens_a_url(self):
+        """Test keys are read from the local JWKS file only"""
+        with mock.patch('fsnd_auth.jwks.urlopen',
+                        side_effect=AssertionError('network call')):
+            auth = Auth0(AUTH0_DOMAIN, API_AUDIENCE, jwks_file=self.jwks_path)
+            self.assertTrue(auth.prefetch())
+            payload = auth.verify_decode_jwt(make_token(self.pem, 'key-1'))
+            self.assertIsNone(auth.jwks_cache.get_key('unknown'))
+
+        self.assertEqual(payload['sub'], 'auth0|tester')
+        self.assertEqual(auth.jwks_cache.stats()['hits'], 1)
+
+    def test_prefetch_failure_does_not_raise(self):
+        """Test an unreachable provider at boot does not crash startup"""
+        auth = Auth0(AUTH0_DOMAIN, API_AUDIENCE,
+                     jwks_file=self.jwks_path + '.missing')
+
+        self.assertFalse(auth.prefetch())
+
+    def test_apps_share_the_key_cache(self):
+        """Test every Auth0 instance of a key source shares one cache"""
+        first = Auth0(AUTH0_DOMAIN, API_AUDIENCE, jwks_file=self.jwks_path)
+        second = Auth0(AUTH0_DOMAIN, 'otherApi', jwks_file=self.jwks_path)
+        other = Auth0('other.us.auth0.com', API_AUDIENCE)
+
+        self.assertIs(first.jwks_cache, second.jwks_cache)
+        self.assertIsNot(first.jwks_cache, other.jwks_cache)
+        self.assertIsNot(first.token_cache, second.token_cache)
+
+    def test_conflicting_shared_cache_options_raise(self):
+        """Test a second app cannot silently get other key cache options"""
+        Auth0(AUTH0_DOMAIN, API_AUDIENCE, jwks_file=self.jwks_path)
+
+        with self.assertRaises(ValueError) as context:
+            Auth0(AUTH0_DOMAIN, API_AUDIENCE, jwks_file=self.jwks_path,
+                  jwks_ttl=60)
+        self.assertIn('ttl', str(context.exception))
+        Auth0(AUTH0_DOMAIN, 'otherApi', jwks_file=self.jwks_path,
+              token_cache_size=0)
+
+    def test_requires_auth_without_permissions(self):
+        """Test a bare requires_auth accepts any valid token"""
+        auth = Auth0(AUTH0_DOMAIN, API_AUDIENCE, jwks_file=self.jwks_path)
+        token = make_token(self.pem, 'key-1')
+        claims = jwt.get_unverified_claims(token)
+        del claims['permissions']
+        token_without_claim = jwt.encode(
+            claims, self.pem, algorithm='RS256', headers={'kid': 'key-1'})
+
+        @auth.requires_auth()
+        def protected(payload):
+            return payload['sub']
+
+        for bearer in (token, token_without_claim):
+            headers = {'Authorization': 'Bearer ' + bearer}
+            with self.app.test_request_context(headers=headers):
+                self.assertEqual(protected(), 'auth0|tester')
+
+    def test_garbage_token_is_rejected(self):
+        """Test a token that is not a jwt raises an AuthError"""
+        auth = Auth0(AUTH0_DOMAIN, API_AUDIENCE, jwks_file=self.jwks_path)
+
+        with self.assertRaises(AuthError) as context:
+            auth.verify_decode_jwt('not-a-token')
+
+        self.assertEqual(context.exception.status_code, 400)
+
+
+class PermissionsTestCase(unittest.TestCase):
+    """This class represents the permission checks test case"""
+
+    def setUp(self):
+        self.payload = {'permissions': ['get:drinks-detail', 'post:drinks']}
+
+    def test_single_permission(self):
+        """Test a single permission string is checked as before"""
+        self.assertTrue(check_permissions('post:drinks', self.payload))
+        with self.assertRaises(AuthError) as context:
+            check_permissions('delete:drinks', self.payload)
+        self.assertEqual(context.exception.status_code, 403)
+
+    def test_all_permissions_required(self):
+        """Test ALL semantics need every permission"""
+        self.assertTrue(check_permissions(
+            ['get:drinks-detail', 'post:drinks'], self.payload))
+        with self.assertRaises(AuthError):
+            check_permissions(['post:drinks', 'patch:drinks'], self.payload)
+
+    def test_any_permission_required(self):
+        """Test ANY semantics need a single matching permission"""
+        self.assertTrue(check_permissions(
+            ['patch:drinks', 'post:drinks'], self.payload, ANY))
+        with self.assertRaises(AuthError):
+            check_permissions(
+                ['patch:drinks', 'delete:drinks'], self.payload, ANY)
+
+    def test_missing_permissions_claim(self):
+        """Test tokens without a permissions claim are rejected"""
+        with self.assertRaises(AuthError) as context:
+            check_permissions('post:drinks', {'sub': 'x'})
+        self.assertEqual(context.exception.status_code, 400)
+
+    def test_precompiled_permissions(self):
+        """Test a cached Permissions object is used instead of the claim"""
+        granted = Permissions(['patch:drinks'])
+        self.assertTrue(check_permissions(
+            'patch:drinks', self.payload, granted=granted))
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
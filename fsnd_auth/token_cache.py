@@ -0,0 +1,91 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+'''
+TokenCache
+a bounded LRU cache of verified bearer tokens
+
+    maps the sha256 digest of a token to its decoded payload and compiled
+    Permissions, so repeated requests with the same token skip the RS256
+    signature verification and claim validation. an entry never outlives
+    the token's `exp` claim, nor `max_ttl` seconds. tokens without an `exp`
+    claim are never cached.
+    the raw token is never stored, only its digest.
+'''
+class TokenCache:
+    def __init__(self, maxsize=1024, max_ttl=300, enabled=True):
+        self.maxsize = maxsize
+        self.max_ttl = max_ttl
+        self.enabled = enabled
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    '''
+    get(token)
+        returns the cached (payload, permissions) for token, or None on a miss
+    '''
+    def get(self, token):
+        if not self.enabled:
+            return None
+        key = self._digest(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            payload, permissions, expires_at = entry
+            if time.time() >= expires_at:
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return payload, permissions
+
+    '''
+    put(token, payload, permissions)
+        stores the verified payload of token, with its compiled permissions
+    '''
+    def put(self, token, payload, permissions=None):
+        if not self.enabled or self.maxsize <= 0:
+            return
+        exp = payload.get('exp')
+        if not isinstance(exp, (int, float)):
+            return
+        expires_at = min(exp, time.time() + self.max_ttl)
+        key = self._digest(token)
+        with self._lock:
+            self._entries[key] = (payload, permissions, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    '''
+    stats()
+        hit/miss/eviction counters, useful for logging and tests
+    '''
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+    @staticmethod
+    def _digest(token):
+        return hashlib.sha256(token.encode()).digest()
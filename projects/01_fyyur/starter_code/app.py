@@ -5,16 +5,21 @@
 import json
 import dateutil.parser
 import babel
-from flask import Flask, render_template, request, Response, flash, redirect, url_for, abort
+from flask import Flask, render_template, stream_template, request, Response, flash, redirect, url_for, abort
 from flask_moment import Moment
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 import logging
 from logging import Formatter, FileHandler
 from flask_wtf import Form, CSRFProtect
+from flask_wtf.csrf import generate_csrf
 from forms import *
 import sys
 import datetime
+import threading
+import time
+from sqlalchemy import event
+from sqlalchemy.orm import Session
 #----------------------------------------------------------------------------#
 # App Config.
 #----------------------------------------------------------------------------#
@@ -24,7 +29,13 @@ moment = Moment(app)
 CSRFProtect(app)
 app.config.from_object('config')
 db = SQLAlchemy(app)
-migrate = Migrate(app,db)
+
+# the trigram indexes are created on PostgreSQL only, outside of the
+# metadata (see TRIGRAM_INDEXES), so autogenerate must not drop them
+def include_object(object, name, type_, reflected, compare_to):
+    return not (type_ == 'index' and name in TRIGRAM_INDEXES)
+
+migrate = Migrate(app,db,include_object=include_object)
 # TODO: connect to a local postgresql database
 
 #----------------------------------------------------------------------------#
@@ -39,6 +50,12 @@ migrate = Migrate(app,db)
 
 class Show(db.Model):
     __tablename__ = 'shows'
+    # the shows of a venue or an artist by date, for their pages (the second
+    # one also backs the duplicate show check). see the 6f1d2c8b9a47 migration
+    __table_args__ = (
+      db.Index('ix_shows_venue_id_start_time', 'venue_id', 'start_time'),
+      db.Index('ix_shows_artist_id_start_time', 'artist_id', 'start_time'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     venue_id = db.Column(db.Integer, db.ForeignKey('venues.id'), nullable=False)
@@ -49,6 +66,13 @@ class Show(db.Model):
 
 class Venue(db.Model):
     __tablename__ = 'venues'
+    # /venues areas and the duplicate venue check, see TRIGRAM_INDEXES for
+    # the name search
+    __table_args__ = (
+      db.Index('ix_venues_city_state', 'city', 'state'),
+      db.Index('ix_venues_address', 'address'),
+      db.Index('ix_venues_phone', 'phone'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False)
@@ -70,6 +94,11 @@ class Venue(db.Model):
 
 class Artist(db.Model):
     __tablename__ = 'artists'
+    # the duplicate artist check, see TRIGRAM_INDEXES for the name search
+    __table_args__ = (
+      db.Index('ix_artists_name', 'name'),
+      db.Index('ix_artists_phone', 'phone'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False)
@@ -89,6 +118,19 @@ class Artist(db.Model):
     # TODO: implement any missing fields, as a database migration using Flask-Migrate
 
 # TODO Implement Show and Artist models, and complete all model relationships and properties, as a database migration.
+
+# the name searches: ilike '%...%' can only use a pg_trgm index, which only
+# PostgreSQL has, and a plain index would only duplicate ix_artists_name on
+# other databases. db.create_all() creates them on PostgreSQL only, as the
+# 6f1d2c8b9a47 migration does
+TRIGRAM_INDEXES = {
+    'ix_venues_name_trgm': Venue.__table__,
+    'ix_artists_name_trgm': Artist.__table__,
+}
+TRIGRAM_INDEX_DDL = 'CREATE INDEX {} ON {} USING gin (name gin_trgm_ops)'
+event.listen(db.metadata, 'before_create', db.DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql'))
+for index_name, table in TRIGRAM_INDEXES.items():
+    event.listen(table, 'after_create', db.DDL(TRIGRAM_INDEX_DDL.format(index_name, table.name)).execute_if(dialect='postgresql'))
 #----------------------------------------------------------------------------#
 # Filters.
 #----------------------------------------------------------------------------#
@@ -103,10 +145,148 @@ def format_datetime(value, format='medium'):
 
 app.jinja_env.filters['datetime'] = format_datetime
 
+#----------------------------------------------------------------------------#
+# Venue areas.
+#----------------------------------------------------------------------------#
+
+def list_venue_areas():
+  # the venues grouped by city and state, with their number of upcoming shows,
+  # read by one query ordered by area and grouped in a single pass
+  rows = db.session.query(Venue.city, Venue.state, Venue.id, Venue.name, db.func.count(Show.id)).outerjoin(Show, db.and_(Show.venue_id == Venue.id, Show.start_time > datetime.datetime.now())).group_by(Venue.id, Venue.city, Venue.state, Venue.name).order_by(Venue.state, Venue.city, Venue.name, Venue.id).all()
+  areas = {}
+  for city, state, venue_id, name, num_upcoming_shows in rows:
+    area = areas.get((city, state))
+    if area is None:
+      area = areas[(city, state)] = {'city': city, 'state': state, 'venues': []}
+    area['venues'].append({'id': venue_id, 'name': name, 'num_upcoming_shows': num_upcoming_shows})
+  return list(areas.values())
+
+class VenueAreas:
+  # list_venue_areas() kept for ttl seconds (shows become past ones meanwhile),
+  # shared by every request to /venues. venues and shows written through the
+  # orm drop it once their transaction is committed
+  def __init__(self, ttl):
+    self.ttl = ttl
+    self._lock = threading.Lock()
+    self._entry = None
+    self._generation = 0
+    self.hits = 0
+    self.misses = 0
+
+  def areas(self):
+    entry = self._entry
+    if entry is not None and entry[1] > time.monotonic():
+      self.hits += 1
+      return entry[0]
+    self.misses += 1
+    generation = self._generation
+    areas = list_venue_areas()
+    # not kept if it was invalidated meanwhile, or if it has uncommitted changes
+    if not db.session.info.get('venue_areas_changed'):
+      with self._lock:
+        if generation == self._generation:
+          self._entry = (areas, time.monotonic() + self.ttl)
+    return areas
+
+  def invalidate(self):
+    with self._lock:
+      self._generation += 1
+      self._entry = None
+
+app.extensions['venue_areas'] = VenueAreas(app.config['VENUE_AREAS_TTL'])
+
+def venue_areas_changed(mapper, connection, target):
+  Session.object_session(target).info['venue_areas_changed'] = True
+
+for model in (Venue, Show):
+  for change in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(model, change, venue_areas_changed)
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_venue_areas(session):
+  if session.info.pop('venue_areas_changed', False):
+    app.extensions['venue_areas'].invalidate()
+
+@event.listens_for(Session, 'after_rollback')
+def forget_venue_areas_changes(session):
+  session.info.pop('venue_areas_changed', None)
+
 #----------------------------------------------------------------------------#
 # Controllers.
 #----------------------------------------------------------------------------#
 
+def search_with_upcoming_shows(model, show_key, search_word, page):
+  # one page of the venues or artists (model) whose name contains search_word,
+  # SEARCH_RESULTS_PER_PAGE at most, by name. their upcoming shows are counted
+  # by the same query (an outer join on show_key grouped by venue or artist)
+  # instead of one count query per result
+  per_page = app.config['SEARCH_RESULTS_PER_PAGE']
+  page = max(page, 1)
+  name_filter = model.name.ilike('%'+search_word+'%')
+  rows = db.session.query(model.id, model.name, db.func.count(Show.id)).outerjoin(Show, db.and_(show_key == model.id, Show.start_time > datetime.datetime.now())).filter(name_filter).group_by(model.id, model.name).order_by(model.name, model.id).limit(per_page).offset((page - 1) * per_page).all()
+  if page == 1 and len(rows) < per_page:
+    # all the results fit on the first page, no need to count them
+    count = len(rows)
+  else:
+    count = db.session.query(db.func.count(model.id)).filter(name_filter).scalar()
+  return {
+    "count": count,
+    "page": page,
+    "pages": (count + per_page - 1) // per_page,
+    "data": [{"id": row[0], "name": row[1], "num_upcoming_shows": row[2]} for row in rows]
+  }
+
+def with_shows(model, show_key, other, other_key, entity_id, pages):
+  # the venue or artist (model) entity_id with its shows and the artists or
+  # venues (other) playing them, all read by a single query. the shows are
+  # ranked by a window function, soonest upcoming and latest past shows first,
+  # and only the first pages[upcoming] * SHOWS_PER_PAGE of each are joined,
+  # every row also has the total number of upcoming or past shows.
+  # returns the entity, or None, and {upcoming: [count, shows]}
+  upcoming = Show.start_time > datetime.datetime.now()
+  ranked = db.session.query(other_key.label('other_id'), Show.start_time.label('start_time'), upcoming.label('upcoming'),
+    db.func.row_number().over(partition_by=upcoming, order_by=(db.case((upcoming, Show.start_time)), Show.start_time.desc(), Show.id)).label('rank'),
+    db.func.count().over(partition_by=upcoming).label('total')).filter(show_key == entity_id).subquery()
+  per_page = app.config['SHOWS_PER_PAGE']
+  shown = db.or_(db.and_(ranked.c.upcoming, ranked.c.rank <= pages[True] * per_page), db.and_(db.not_(ranked.c.upcoming), ranked.c.rank <= pages[False] * per_page))
+  rows = db.session.query(model, ranked.c.upcoming, ranked.c.total, ranked.c.start_time, other.id, other.name, other.image_link).select_from(model).outerjoin(ranked, shown).outerjoin(other, other.id == ranked.c.other_id).filter(model.id == entity_id).order_by(ranked.c.rank).all()
+  entity = None
+  shows = {True: [0, []], False: [0, []]}
+  for row in rows:
+    entity = row[0]
+    if row[1] is None:
+      # no shows at all
+      continue
+    listed = shows[bool(row[1])]
+    listed[0] = row[2]
+    listed[1].append({"id": row[4], "name": row[5], "image_link": row[6], "start_time": row[3]})
+  return entity, shows
+
+def show_pages():
+  # the number of pages of upcoming and past shows asked for by the "load more" links
+  return {True: max(request.args.get('upcoming_page', 1, type=int), 1), False: max(request.args.get('past_page', 1, type=int), 1)}
+
+def render_listing(template, name, query, key):
+  # renders the page of query (LISTING_PER_PAGE rows) following the ?after_id=
+  # key, with a next_url to the following page. with ?stream=1 every row after
+  # it is rendered instead, read and sent in batches as the template goes
+  after_id = request.args.get('after_id', type=int)
+  query = query.order_by(key)
+  if after_id is not None:
+    query = query.filter(key > after_id)
+  if request.args.get('stream'):
+    # the csrf token of the layout is kept in the session, which is saved
+    # before the first chunk is sent
+    generate_csrf()
+    return Response(stream_template(template, **{name: query.yield_per(1000)}), mimetype='text/html')
+  per_page = app.config['LISTING_PER_PAGE']
+  rows = query.limit(per_page + 1).all()
+  next_url = None
+  if len(rows) > per_page:
+    rows = rows[:per_page]
+    next_url = url_for(request.endpoint, after_id=rows[-1].id)
+  return render_template(template, next_url=next_url, **{name: rows})
+
 @app.route('/')
 def index():
   return render_template('pages/home.html')
@@ -118,16 +298,7 @@ def index():
 def venues():
   # TODO: replace with real venues data.
   #       num_shows should be aggregated based on number of upcoming shows per venue.
-  result = db.session.query(Venue.city+','+Venue.state,Venue.name,Venue.id,db.func.count(Show.venue_id)).outerjoin(Show, Venue.id == Show.venue_id).group_by(Venue.city,Venue.state,Venue.id,Venue.name).all()
-  city_state = {item[0] for item in result}
-  data_list = []
-  for item in city_state:
-    data_obj = {'city': item.split(',')[0],'state': item.split(',')[1],'venues':[]}
-    for row in result:
-      if item==row[0]:
-        data_obj['venues'].append({'id': row[2],'name': row[1],'num_upcoming_shows': row[3]})
-    data_list.append(data_obj)
-  return render_template('pages/venues.html', areas=data_list)
+  return render_template('pages/venues.html', areas=app.extensions['venue_areas'].areas())
 
 @app.route('/venues/search', methods=['POST'])
 def search_venues():
@@ -135,26 +306,17 @@ def search_venues():
   # seach for Hop should return "The Musical Hop".
   # search for "Music" should return "The Musical Hop" and "Park Square Live Music & Coffee"
   search_word=request.form.get('search_term', '')
-  venues = Venue.query.filter(Venue.name.ilike('%'+search_word+'%')).all()
-  response={
-    "count": len(venues),
-    "data": []
-  }
-  for venue in venues:
-    response["data"].append({
-      "id": venue.id,
-      "name": venue.name,
-      "num_upcoming_shows": Show.query.filter(Show.venue_id == venue.id, Show.start_time > datetime.datetime.now()).count(),
-    })
+  response = search_with_upcoming_shows(Venue, Show.venue_id, search_word, request.form.get('page', 1, type=int))
   return render_template('pages/search_venues.html', results=response, search_term=search_word)
 
 @app.route('/venues/<int:venue_id>')
 def show_venue(venue_id):
   # shows the venue page with the given venue_id
   # TODO: replace with real venue data from the venues table, using venue_id
-  venue_obj = Venue.query.filter(Venue.id == venue_id).first()
-  past_shows = Show.query.filter(Show.venue_id == venue_id, Show.start_time < datetime.datetime.now()).all()
-  upcoming_shows = Show.query.filter(Show.venue_id == venue_id, Show.start_time > datetime.datetime.now()).all()
+  pages = show_pages()
+  venue_obj, shows = with_shows(Venue, Show.venue_id, Artist, Show.artist_id, venue_id, pages)
+  if venue_obj is None:
+    abort(404)
   data={
     "id": venue_obj.id,
     "name": venue_obj.name,
@@ -169,23 +331,19 @@ def show_venue(venue_id):
     "image_link": venue_obj.image_link,
     "past_shows": [],
     "upcoming_shows": [],
-    "past_shows_count": len(past_shows),
-    "upcoming_shows_count": len(upcoming_shows),
+    "past_shows_count": shows[False][0],
+    "upcoming_shows_count": shows[True][0],
+    "past_page": pages[False],
+    "upcoming_page": pages[True],
   }
-  for show in past_shows:
-    data['past_shows'].append({
-      "artist_id": show.artist.id,
-      "artist_name": show.artist.name,
-      "artist_image_link": show.artist.image_link,
-      "start_time": show.start_time
-    })
-  for show in upcoming_shows:
-    data['upcoming_shows'].append({
-      "artist_id": show.artist.id,
-      "artist_name": show.artist.name,
-      "artist_image_link": show.artist.image_link,
-      "start_time": show.start_time
-    })
+  for upcoming, key in ((False, 'past_shows'), (True, 'upcoming_shows')):
+    for show in shows[upcoming][1]:
+      data[key].append({
+        "artist_id": show["id"],
+        "artist_name": show["name"],
+        "artist_image_link": show["image_link"],
+        "start_time": show["start_time"]
+      })
   return render_template('pages/show_venue.html', venue=data)
 
 #  Create Venue
@@ -250,8 +408,8 @@ def delete_venue(venue_id):
 @app.route('/artists')
 def artists():
   # TODO: replace with real data returned from querying the database
-  data_list = Artist.query.all()
-  return render_template('pages/artists.html', artists=data_list)
+  query = db.session.query(Artist.id, Artist.name)
+  return render_listing('pages/artists.html', 'artists', query, Artist.id)
 
 @app.route('/artists/search', methods=['POST'])
 def search_artists():
@@ -259,26 +417,17 @@ def search_artists():
   # seach for "A" should return "Guns N Petals", "Matt Quevado", and "The Wild Sax Band".
   # search for "band" should return "The Wild Sax Band".
   search_word=request.form.get('search_term', '')
-  artists = Artist.query.filter(Artist.name.ilike('%'+search_word+'%')).all()
-  response={
-    "count": len(artists),
-    "data": []
-  }
-  for artist in artists:
-    response["data"].append({
-      "id": artist.id,
-      "name": artist.name,
-      "num_upcoming_shows": Show.query.filter(Show.artist_id == artist.id, Show.start_time > datetime.datetime.now()).count(),
-    })
-  return render_template('pages/search_artists.html', results=response, search_term=request.form.get('search_term', ''))
+  response = search_with_upcoming_shows(Artist, Show.artist_id, search_word, request.form.get('page', 1, type=int))
+  return render_template('pages/search_artists.html', results=response, search_term=search_word)
 
 @app.route('/artists/<int:artist_id>')
 def show_artist(artist_id):
   # shows the venue page with the given venue_id
   # TODO: replace with real venue data from the venues table, using venue_id
-  artist_obj = Artist.query.filter(Artist.id == artist_id).first()
-  past_shows = Show.query.filter(Show.artist_id == artist_id, Show.start_time < datetime.datetime.now()).all()
-  upcoming_shows = Show.query.filter(Show.artist_id == artist_id, Show.start_time > datetime.datetime.now()).all()
+  pages = show_pages()
+  artist_obj, shows = with_shows(Artist, Show.artist_id, Venue, Show.venue_id, artist_id, pages)
+  if artist_obj is None:
+    abort(404)
   data={
     "id": artist_obj.id,
     "name": artist_obj.name,
@@ -292,23 +441,19 @@ def show_artist(artist_id):
     "image_link": artist_obj.image_link,
     "past_shows": [],
     "upcoming_shows": [],
-    "past_shows_count": len(past_shows),
-    "upcoming_shows_count": len(upcoming_shows),
+    "past_shows_count": shows[False][0],
+    "upcoming_shows_count": shows[True][0],
+    "past_page": pages[False],
+    "upcoming_page": pages[True],
   }
-  for show in past_shows:
-    data['past_shows'].append({
-      "venue_id": show.venue.id,
-      "venue_name": show.venue.name,
-      "venue_image_link": show.venue.image_link,
-      "start_time": show.start_time
-    })
-  for show in upcoming_shows:
-    data['upcoming_shows'].append({
-      "venue_id": show.venue.id,
-      "venue_name": show.venue.name,
-      "venue_image_link": show.venue.image_link,
-      "start_time": show.start_time
-    })
+  for upcoming, key in ((False, 'past_shows'), (True, 'upcoming_shows')):
+    for show in shows[upcoming][1]:
+      data[key].append({
+        "venue_id": show["id"],
+        "venue_name": show["name"],
+        "venue_image_link": show["image_link"],
+        "start_time": show["start_time"]
+      })
   return render_template('pages/show_artist.html', artist=data)
 
 #  Update
@@ -423,8 +568,11 @@ def shows():
   # displays list of shows at /shows
   # TODO: replace with real venues data.
   #       num_shows should be aggregated based on number of upcoming shows per venue.
-  data_list = Show.query.all()
-  return render_template('pages/shows.html', shows=data_list)
+  query = Show.query.options(
+    db.load_only(Show.id, Show.venue_id, Show.artist_id, Show.start_time),
+    db.joinedload(Show.artist).load_only(Artist.id, Artist.name, Artist.image_link),
+    db.joinedload(Show.venue).load_only(Venue.id, Venue.name))
+  return render_listing('pages/shows.html', 'shows', query, Show.id)
 
 @app.route('/shows/create')
 def create_shows():
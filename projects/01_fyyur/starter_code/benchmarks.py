@@ -0,0 +1,255 @@
+'''
+Micro-benchmarks for fyyur
+
+they run against a throwaway sqlite database unless FYYUR_BENCHMARK_DATABASE
+names another one (e.g. postgresql://postgres@localhost:5432/fyyur_bench,
+its tables are dropped at the end). run them from the starter_code directory:
+    python benchmarks.py                # every benchmark
+    python benchmarks.py venues         # a single one
+'''
+import datetime
+import os
+import random
+import sys
+import tempfile
+import timeit
+from contextlib import contextmanager
+
+BENCHMARKS = {}
+
+
+def benchmark(f):
+    BENCHMARKS[f.__name__[len('bench_'):]] = f
+    return f
+
+
+def report_ms(label, seconds, number):
+    print('  {:<44} {:>10.2f} ms/op'.format(label, seconds / number * 1e3))
+
+
+'''
+temporary_app()
+    the fyyur app bound to the benchmark database, emptied on exit
+'''
+@contextmanager
+def temporary_app():
+    from app import app, db
+
+    app.config.update(
+        SQLALCHEMY_DATABASE_URI=os.environ.get('FYYUR_BENCHMARK_DATABASE') or
+        'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'benchmark.db'),
+        WTF_CSRF_ENABLED=False)
+    with app.app_context():
+        db.create_all()
+        app.extensions['venue_areas'].invalidate()
+        try:
+            yield app
+        finally:
+            db.session.remove()
+            db.drop_all()
+            db.engine.dispose()
+
+
+WORDS = ['blue', 'moon', 'hall', 'jazz', 'river', 'loft', 'garden', 'cellar',
+         'velvet', 'echo', 'harbor', 'neon', 'orchard', 'station', 'lantern']
+
+
+def seed(venues, artists, shows, cities, batch_size=10000):
+    from app import db, Venue, Artist, Show
+
+    rng = random.Random(venues)
+    now = datetime.datetime.now()
+    areas = [('City {}'.format(i), 'S{}'.format(i % 50)) for i in range(cities)]
+    tables = [
+        (Venue, venues, lambda i: dict(zip(('city', 'state'), rng.choice(areas)),
+            name='The {} {} {}'.format(*rng.sample(WORDS, 2), i),
+            address='{} {} Street'.format(i, rng.choice(WORDS)),
+            phone='{:03}-{:03}-{:04}'.format(i % 1000, i // 1000 % 1000, i),
+            genres='{Jazz}', seeking_talent=False)),
+        (Artist, artists, lambda i: dict(zip(('city', 'state'), rng.choice(areas)),
+            name='{} {} {}'.format(*rng.sample(WORDS, 2), i).title(),
+            phone='{:03}-{:04}-{:03}'.format(i % 1000, i, i // 1000 % 1000),
+            genres='{Jazz}', seeking_venue=False)),
+        (Show, shows, lambda i: dict(
+            venue_id=rng.randint(1, venues), artist_id=rng.randint(1, artists),
+            start_time=now + datetime.timedelta(
+                hours=rng.randint(-24 * 365, 24 * 365)))),
+    ]
+    for model, count, make in tables:
+        for start in range(0, count, batch_size):
+            db.session.execute(model.__table__.insert(), [
+                make(i) for i in range(start, min(start + batch_size, count))])
+    db.session.commit()
+
+
+'''
+venues
+    GET /venues over tens of thousands of venues in hundreds of cities: the
+    former implementation (every show counted, rows matched to their area by
+    a nested loop) versus the single pass grouping, uncached and cached
+'''
+@benchmark
+def bench_venues(venues=30000, cities=500, shows=100000, number=20):
+    from app import db, Venue, Show, list_venue_areas
+
+    with temporary_app() as app:
+        seed(venues, 1000, shows, cities)
+        client = app.test_client()
+        areas = app.extensions['venue_areas']
+        print('venues ({} venues, {} cities, {} shows, {} requests)'.format(
+            venues, cities, shows, number))
+
+        def nested_loop():
+            result = db.session.query(Venue.city+','+Venue.state,Venue.name,Venue.id,db.func.count(Show.venue_id)).outerjoin(Show, Venue.id == Show.venue_id).group_by(Venue.city,Venue.state,Venue.id,Venue.name).all()
+            city_state = {item[0] for item in result}
+            data_list = []
+            for item in city_state:
+                data_obj = {'city': item.split(',')[0],'state': item.split(',')[1],'venues':[]}
+                for row in result:
+                    if item==row[0]:
+                        data_obj['venues'].append({'id': row[2],'name': row[1],'num_upcoming_shows': row[3]})
+                data_list.append(data_obj)
+            return data_list
+
+        report_ms('former query + nested loop',
+                  timeit.timeit(nested_loop, number=1), 1)
+        report_ms('list_venue_areas()',
+                  timeit.timeit(list_venue_areas, number=number), number)
+
+        def uncached():
+            areas.invalidate()
+            client.get('/venues')
+
+        report_ms('GET /venues, uncached',
+                  timeit.timeit(uncached, number=number), number)
+        client.get('/venues')
+        report_ms('GET /venues, cached',
+                  timeit.timeit(lambda: client.get('/venues'), number=number),
+                  number)
+        report_ms('cached areas only',
+                  timeit.timeit(areas.areas, number=number * 100),
+                  number * 100)
+
+
+'''
+indexes
+    the queries behind the venue and artist pages, the area listing, the
+    duplicate checks of the create forms and the name search, without and
+    with the indexes of the 6f1d2c8b9a47 migration (the trigram ones on
+    postgresql only), with their plans
+'''
+@benchmark
+def bench_indexes(venues=30000, artists=30000, shows=300000, number=200):
+    from app import db, Venue, Artist, Show, TRIGRAM_INDEXES, \
+        TRIGRAM_INDEX_DDL
+    from sqlalchemy import text
+
+    with temporary_app() as app:
+        seed(venues, artists, shows, 500)
+        client = app.test_client()
+        postgresql = db.engine.dialect.name == 'postgresql'
+        explain = 'EXPLAIN' if postgresql else 'EXPLAIN QUERY PLAN'
+        venue = db.session.query(Venue).get(venues // 2)
+        artist = db.session.query(Artist).get(artists // 2)
+        show = db.session.query(Show).get(shows // 2)
+        params = {'venue_id': venue.id, 'artist_id': artist.id,
+                  'now': datetime.datetime.now(), 'city': venue.city,
+                  'state': venue.state, 'address': venue.address,
+                  'phone': venue.phone, 'name': artist.name,
+                  'artist_phone': artist.phone,
+                  'show_artist_id': show.artist_id,
+                  'start_time': show.start_time, 'pattern': '%jazz 1234%'}
+        queries = [
+            ('venue page shows', 'SELECT artist_id, start_time FROM shows '
+             'WHERE venue_id = :venue_id AND start_time > :now '
+             'ORDER BY start_time LIMIT 12'),
+            ('artist page shows', 'SELECT venue_id, start_time FROM shows '
+             'WHERE artist_id = :artist_id AND start_time > :now '
+             'ORDER BY start_time LIMIT 12'),
+            ('venues of an area', 'SELECT id, name FROM venues '
+             'WHERE city = :city AND state = :state'),
+            ('duplicate venue check', 'SELECT id FROM venues '
+             'WHERE address = :address OR phone = :phone LIMIT 1'),
+            ('duplicate artist check', 'SELECT id FROM artists '
+             'WHERE name = :name OR phone = :artist_phone LIMIT 1'),
+            ('duplicate show check', 'SELECT id FROM shows WHERE artist_id = '
+             ':show_artist_id AND start_time = :start_time LIMIT 1'),
+            ('venue name search', 'SELECT id, name FROM venues WHERE name {} '
+             ':pattern'.format('ILIKE' if postgresql else 'LIKE')),
+        ]
+        indexes = [index for model in (Venue, Artist, Show)
+                   for index in model.__table__.indexes]
+        print('indexes ({} venues, {} artists, {} shows, {} queries)'.format(
+            venues, artists, shows, number))
+
+        for indexed in (False, True):
+            for index in indexes:
+                if indexed:
+                    index.create(db.engine)
+                else:
+                    index.drop(db.engine)
+            for name, table in TRIGRAM_INDEXES.items() if postgresql else ():
+                db.session.execute(text(
+                    TRIGRAM_INDEX_DDL.format(name, table.name) if indexed
+                    else 'DROP INDEX ' + name))
+            db.session.execute(text('ANALYZE'))
+            db.session.commit()
+            state = 'with indexes' if indexed else 'no indexes'
+            for label, query in queries:
+                print('  {}, {} plan:'.format(state, label))
+                for row in db.session.execute(text(explain + ' ' + query),
+                                              params):
+                    print('    ' + str(row[-1]))
+            for label, query in queries:
+                report_ms('{}, {}'.format(state, label),
+                          timeit.timeit(lambda: db.session.execute(
+                              text(query), params).fetchall(), number=number),
+                          number)
+            for url in ['/venues/{}'.format(venue.id),
+                        '/artists/{}'.format(artist.id)]:
+                report_ms('{}, GET {}'.format(state, url),
+                          timeit.timeit(lambda: client.get(url),
+                                        number=number // 10), number // 10)
+
+
+'''
+listings
+    GET /shows and /artists: every show with its artist and venue loaded
+    lazily, and every artist (the former implementation), versus a keyset
+    page, a deep one, and the whole listing streamed with ?stream=1
+'''
+@benchmark
+def bench_listings(venues=5000, artists=20000, shows=50000, number=20):
+    from app import db, Show, Artist
+    from flask import render_template
+
+    with temporary_app() as app:
+        seed(venues, artists, shows, 100)
+        client = app.test_client()
+        print('listings ({} artists, {} shows, {} requests)'.format(
+            artists, shows, number))
+
+        def former(template, name, model):
+            with app.test_request_context():
+                render_template(template, **{name: model.query.all()})
+
+        for path, template, count, model in [
+                ('/shows', 'pages/shows.html', shows, Show),
+                ('/artists', 'pages/artists.html', artists, Artist)]:
+            report_ms('former {}, every row'.format(path),
+                      timeit.timeit(lambda: former(template, path[1:], model),
+                                    number=1), 1)
+            for url in [path, '{}?after_id={}'.format(path, count - 100)]:
+                report_ms('GET ' + url,
+                          timeit.timeit(lambda: client.get(url),
+                                        number=number), number)
+            report_ms('GET {}?stream=1, every row'.format(path),
+                      timeit.timeit(lambda: client.get(
+                          path + '?stream=1').get_data(), number=1), 1)
+            db.session.remove()
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
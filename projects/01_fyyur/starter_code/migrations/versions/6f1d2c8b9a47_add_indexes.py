@@ -0,0 +1,48 @@
+"""add indexes
+
+Revision ID: 6f1d2c8b9a47
+Revises: 018c63d48a22
+Create Date: 2026-10-18 10:12:40.318206
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6f1d2c8b9a47'
+down_revision = '018c63d48a22'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the shows of a venue or an artist by date (venue and artist pages, the
+    # duplicate show check)
+    op.create_index('ix_shows_venue_id_start_time', 'shows', ['venue_id', 'start_time'])
+    op.create_index('ix_shows_artist_id_start_time', 'shows', ['artist_id', 'start_time'])
+    # /venues areas, the duplicate venue and artist checks
+    op.create_index('ix_venues_city_state', 'venues', ['city', 'state'])
+    op.create_index('ix_venues_address', 'venues', ['address'])
+    op.create_index('ix_venues_phone', 'venues', ['phone'])
+    op.create_index('ix_artists_name', 'artists', ['name'])
+    op.create_index('ix_artists_phone', 'artists', ['phone'])
+    # the name searches, ilike '%...%' can only use a trigram index. other
+    # databases would only get a copy of ix_artists_name
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        op.create_index('ix_venues_name_trgm', 'venues', ['name'], postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'})
+        op.create_index('ix_artists_name_trgm', 'artists', ['name'], postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'})
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.drop_index('ix_artists_name_trgm', table_name='artists')
+        op.drop_index('ix_venues_name_trgm', table_name='venues')
+    op.drop_index('ix_artists_phone', table_name='artists')
+    op.drop_index('ix_artists_name', table_name='artists')
+    op.drop_index('ix_venues_phone', table_name='venues')
+    op.drop_index('ix_venues_address', table_name='venues')
+    op.drop_index('ix_venues_city_state', table_name='venues')
+    op.drop_index('ix_shows_artist_id_start_time', table_name='shows')
+    op.drop_index('ix_shows_venue_id_start_time', table_name='shows')
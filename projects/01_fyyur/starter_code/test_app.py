@@ -0,0 +1,357 @@
+import contextlib
+import datetime
+import os
+import tempfile
+import unittest
+
+from sqlalchemy import event, inspect
+
+from app import (app, db, Venue, Artist, Show, search_with_upcoming_shows,
+                 with_shows)
+
+
+def setUpModule():
+    global database_file
+    handle, database_file = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+    app.config.update(
+        SQLALCHEMY_DATABASE_URI='sqlite:///' + database_file,
+        TESTING=True,
+        WTF_CSRF_ENABLED=False,
+        SEARCH_RESULTS_PER_PAGE=5,
+        SHOWS_PER_PAGE=3,
+        LISTING_PER_PAGE=2)
+
+
+def tearDownModule():
+    with app.app_context():
+        db.engine.dispose()
+    os.remove(database_file)
+
+
+@contextlib.contextmanager
+def count_queries():
+    '''collects the statements run on the database inside the block'''
+    statements = []
+
+    def collect(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engine = db.engine
+    event.listen(engine, 'before_cursor_execute', collect)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', collect)
+
+
+class FyyurTestCase(unittest.TestCase):
+    """This class represents the fyyur test case"""
+
+    def setUp(self):
+        self.client = app.test_client()
+        self.context = app.app_context()
+        self.context.push()
+        db.create_all()
+        app.extensions['venue_areas'].invalidate()
+
+        now = datetime.datetime.now()
+        self.past = now - datetime.timedelta(days=30)
+        self.future = now + datetime.timedelta(days=30)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def add_venue(self, name, **fields):
+        venue = Venue(name=name, city=fields.pop('city', 'San Francisco'),
+                      state=fields.pop('state', 'CA'),
+                      address=fields.pop('address', name + ' Street'),
+                      genres='{Jazz}', **fields)
+        db.session.add(venue)
+        return venue
+
+    def add_artist(self, name, **fields):
+        artist = Artist(name=name, city='San Francisco', state='CA',
+                        genres='{Jazz}', **fields)
+        db.session.add(artist)
+        return artist
+
+    def add_show(self, venue, artist, start_time):
+        show = Show(venue=venue, artist=artist, start_time=start_time)
+        db.session.add(show)
+        return show
+
+    def add_search_data(self):
+        hop = self.add_venue('The Musical Hop')
+        park = self.add_venue('Park Square Live Music & Coffee')
+        pianos = self.add_venue('The Dueling Pianos Bar')
+        petals = self.add_artist('Guns N Petals')
+        sax = self.add_artist('The Wild Sax Band')
+        self.add_artist('Matt Quevado')
+        self.add_show(hop, petals, self.past)
+        self.add_show(hop, petals, self.future)
+        self.add_show(hop, sax, self.future)
+        self.add_show(pianos, sax, self.past)
+        self.add_show(park, sax, self.future)
+        db.session.commit()
+
+    def test_trigram_indexes_only_on_postgresql(self):
+        indexes = {index['name'] for table in ('venues', 'artists')
+                   for index in inspect(db.engine).get_indexes(table)}
+
+        self.assertIn('ix_artists_name', indexes)
+        self.assertNotIn('ix_venues_name_trgm', indexes)
+        self.assertNotIn('ix_artists_name_trgm', indexes)
+
+    def test_search_venues(self):
+        self.add_search_data()
+        with app.test_request_context():
+            results = search_with_upcoming_shows(
+                Venue, Show.venue_id, 'music', 1)
+
+        self.assertEqual(results['count'], 2)
+        self.assertEqual(results['pages'], 1)
+        self.assertEqual(
+            [(venue['name'], venue['num_upcoming_shows'])
+             for venue in results['data']],
+            [('Park Square Live Music & Coffee', 1), ('The Musical Hop', 2)])
+
+    def test_search_artists(self):
+        self.add_search_data()
+        with app.test_request_context():
+            results = search_with_upcoming_shows(
+                Artist, Show.artist_id, 'A', 1)
+
+        self.assertEqual(results['count'], 3)
+        self.assertEqual(
+            [(artist['name'], artist['num_upcoming_shows'])
+             for artist in results['data']],
+            [('Guns N Petals', 1), ('Matt Quevado', 0),
+             ('The Wild Sax Band', 2)])
+
+    def test_search_venues_page(self):
+        self.add_search_data()
+        res = self.client.post('/venues/search', data={'search_term': 'hop'})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(b'The Musical Hop', res.data)
+        self.assertNotIn(b'The Dueling Pianos Bar', res.data)
+
+    def test_search_runs_one_query_per_page(self):
+        artist = self.add_artist('Guns N Petals')
+        for number in range(12):
+            venue = self.add_venue('Venue %02d' % number)
+            for day in range(number):
+                self.add_show(venue, artist,
+                              self.future + datetime.timedelta(days=day))
+        db.session.commit()
+
+        with count_queries() as statements:
+            res = self.client.post('/venues/search',
+                                   data={'search_term': 'venue', 'page': 3})
+        self.assertEqual(res.status_code, 200)
+        # the page, with its upcoming shows, and the number of results
+        self.assertEqual(len(statements), 2)
+        self.assertIn(b'Venue 10', res.data)
+        self.assertIn(b'Venue 11', res.data)
+        self.assertNotIn(b'Venue 09', res.data)
+        self.assertIn(b'Page 3 of 3', res.data)
+
+        with count_queries() as statements:
+            res = self.client.post('/artists/search',
+                                   data={'search_term': 'petals'})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(statements), 1)
+
+    def test_show_venue(self):
+        self.add_search_data()
+        with count_queries() as statements:
+            res = self.client.get('/venues/1')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(statements), 1)
+        self.assertIn(b'2 Upcoming Shows', res.data)
+        self.assertIn(b'1 Past Show<', res.data)
+        self.assertIn(b'Guns N Petals', res.data)
+        self.assertIn(b'The Wild Sax Band', res.data)
+        self.assertNotIn(b'Load more', res.data)
+
+    def test_show_artist(self):
+        self.add_search_data()
+        with count_queries() as statements:
+            res = self.client.get('/artists/2')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(statements), 1)
+        self.assertIn(b'2 Upcoming Shows', res.data)
+        self.assertIn(b'The Musical Hop', res.data)
+        self.assertIn(b'Park Square Live Music &amp; Coffee', res.data)
+        self.assertIn(b'The Dueling Pianos Bar', res.data)
+
+    def test_show_artist_without_shows(self):
+        self.add_search_data()
+        res = self.client.get('/artists/3')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(b'Matt Quevado', res.data)
+        self.assertIn(b'0 Upcoming Shows', res.data)
+        self.assertIn(b'0 Past Shows', res.data)
+
+    def test_404_show_venue(self):
+        res = self.client.get('/venues/1000')
+
+        self.assertEqual(res.status_code, 404)
+
+    def test_show_venue_load_more(self):
+        venue = self.add_venue('The Musical Hop')
+        for number in range(8):
+            self.add_show(venue, self.add_artist('Artist %02d' % number),
+                          self.future + datetime.timedelta(days=number))
+        for number in range(8, 10):
+            self.add_show(venue, self.add_artist('Artist %02d' % number),
+                          self.past - datetime.timedelta(days=number))
+        db.session.commit()
+
+        with app.test_request_context():
+            first, shows = with_shows(Venue, Show.venue_id, Artist,
+                                      Show.artist_id, venue.id,
+                                      {True: 1, False: 1})
+            more, more_shows = with_shows(Venue, Show.venue_id, Artist,
+                                          Show.artist_id, venue.id,
+                                          {True: 2, False: 1})
+
+        self.assertEqual(first.name, 'The Musical Hop')
+        self.assertEqual(shows[True][0], 8)
+        self.assertEqual([show['name'] for show in shows[True][1]],
+                         ['Artist 00', 'Artist 01', 'Artist 02'])
+        self.assertEqual(shows[False][0], 2)
+        self.assertEqual([show['name'] for show in shows[False][1]],
+                         ['Artist 08', 'Artist 09'])
+        self.assertEqual(len(more_shows[True][1]), 6)
+
+        with count_queries() as statements:
+            res = self.client.get('/venues/%d?upcoming_page=3' % venue.id)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(statements), 1)
+        self.assertIn(b'Artist 07', res.data)
+        self.assertNotIn(b'Load more upcoming shows', res.data)
+
+    def test_venues(self):
+        self.add_search_data()
+        self.add_venue('The Dueling Pianos Bar', city='New York', state='NY',
+                       address='335 Delancey Street')
+        db.session.commit()
+
+        with count_queries() as statements:
+            res = self.client.get('/venues')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(statements), 1)
+        self.assertIn(b'New York, NY', res.data)
+        self.assertIn(b'San Francisco, CA', res.data)
+
+        areas = app.extensions['venue_areas'].areas()
+        self.assertEqual(
+            [(area['city'], area['state'],
+              [(venue['name'], venue['num_upcoming_shows'])
+               for venue in area['venues']]) for area in areas],
+            [('San Francisco', 'CA', [('Park Square Live Music & Coffee', 1),
+                                      ('The Dueling Pianos Bar', 0),
+                                      ('The Musical Hop', 2)]),
+             ('New York', 'NY', [('The Dueling Pianos Bar', 0)])])
+
+    def test_venues_are_cached(self):
+        self.add_search_data()
+        self.client.get('/venues')
+
+        with count_queries() as statements:
+            res = self.client.get('/venues')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(statements), 0)
+
+        res = self.client.post('/shows/create', data={
+            'artist_id': 1, 'venue_id': 3,
+            'start_time': self.future.strftime('%Y-%m-%d %H:%M:%S')})
+        self.assertEqual(res.status_code, 200)
+        with count_queries() as statements:
+            self.client.get('/venues')
+        self.assertEqual(len(statements), 1)
+        pianos = app.extensions['venue_areas'].areas()[0]['venues'][1]
+        self.assertEqual(pianos['name'], 'The Dueling Pianos Bar')
+        self.assertEqual(pianos['num_upcoming_shows'], 1)
+
+    def test_venues_invalidated_while_listing(self):
+        self.add_search_data()
+        areas = app.extensions['venue_areas']
+
+        def invalidate(conn, cursor, statement, parameters, context,
+                       executemany):
+            # a show is committed by another request meanwhile
+            areas.invalidate()
+
+        event.listen(db.engine, 'after_cursor_execute', invalidate)
+        try:
+            areas.areas()
+        finally:
+            event.remove(db.engine, 'after_cursor_execute', invalidate)
+
+        with count_queries() as statements:
+            areas.areas()
+        self.assertEqual(len(statements), 1)
+
+    def test_venues_are_not_cached_with_uncommitted_changes(self):
+        self.add_search_data()
+        self.add_venue('The Dueling Pianos Bar', city='New York', state='NY',
+                       address='335 Delancey Street')
+        db.session.flush()
+        self.assertEqual(len(app.extensions['venue_areas'].areas()), 2)
+        db.session.rollback()
+
+        self.assertEqual(len(app.extensions['venue_areas'].areas()), 1)
+
+    def test_artists(self):
+        self.add_search_data()
+        with count_queries() as statements:
+            res = self.client.get('/artists')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(statements), 1)
+        self.assertIn(b'Guns N Petals', res.data)
+        self.assertIn(b'The Wild Sax Band', res.data)
+        self.assertNotIn(b'Matt Quevado', res.data)
+        self.assertIn(b'/artists?after_id=2', res.data)
+
+        res = self.client.get('/artists?after_id=2')
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(b'Matt Quevado', res.data)
+        self.assertNotIn(b'Guns N Petals', res.data)
+        self.assertNotIn(b'after_id=', res.data)
+
+    def test_shows(self):
+        self.add_search_data()
+        with count_queries() as statements:
+            res = self.client.get('/shows?after_id=2')
+        self.assertEqual(res.status_code, 200)
+        # the artists and venues are joined to the shows
+        self.assertEqual(len(statements), 1)
+        self.assertIn(b'The Wild Sax Band', res.data)
+        self.assertIn(b'The Dueling Pianos Bar', res.data)
+        self.assertNotIn(b'Park Square', res.data)
+        self.assertIn(b'/shows?after_id=4', res.data)
+
+    def test_streamed_shows(self):
+        self.add_search_data()
+        with count_queries() as statements:
+            res = self.client.get('/shows?stream=1')
+            self.assertTrue(res.is_streamed)
+            data = res.get_data()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(data.count(b'tile-show'), 5)
+        self.assertIn(b'Park Square Live Music &amp; Coffee', data)
+        self.assertNotIn(b'after_id=', data)
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
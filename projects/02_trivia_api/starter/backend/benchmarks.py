@@ -0,0 +1,474 @@
+'''
+Micro-benchmarks for the trivia backend
+
+they run against a throwaway sqlite database unless TRIVIA_BENCHMARK_DATABASE
+names another one (e.g. postgresql://postgres@localhost:5432/trivia_bench,
+its tables are dropped at the end). run them from the backend directory:
+    python benchmarks.py                # every benchmark
+    python benchmarks.py pagination     # a single one
+'''
+import os
+import random
+import sys
+import tempfile
+import time
+import timeit
+from contextlib import contextmanager
+
+BENCHMARKS = {}
+
+
+def benchmark(f):
+    BENCHMARKS[f.__name__[len('bench_'):]] = f
+    return f
+
+
+def report_ms(label, seconds, number):
+    print('  {:<44} {:>10.2f} ms/op'.format(label, seconds / number * 1e3))
+
+
+def report_throughput(label, seconds, number, unit='rows/s'):
+    print('  {:<44} {:>10,.0f} {}'.format(label, number / seconds, unit))
+
+
+'''
+temporary_app()
+    the trivia app bound to the benchmark database, emptied on exit
+'''
+@contextmanager
+def temporary_app():
+    from flaskr import create_app
+    from migrations import migrate
+    from models import db
+
+    uri = os.environ.get('TRIVIA_BENCHMARK_DATABASE') or \
+        'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'benchmark.db')
+    app = create_app({'SQLALCHEMY_DATABASE_URI': uri})
+    migrate(uri, log=lambda message: None)
+    with app.app_context():
+        try:
+            yield app
+        finally:
+            db.session.remove()
+            db.drop_all()
+
+
+WORDS = ['river', 'painter', 'planet', 'king', 'movie', 'goal', 'element',
+         'mountain', 'novel', 'battle', 'ocean', 'composer', 'island',
+         'olympic', 'empire', 'actor', 'comet', 'bridge', 'symphony', 'lake']
+
+
+def make_question(i, rng):
+    return {
+        'question': 'Which {} of the {} is {} number {}?'.format(
+            rng.choice(WORDS), rng.choice(WORDS), rng.choice(WORDS), i),
+        'answer': ' '.join(rng.sample(WORDS, 2)),
+        'category': rng.randint(1, 6),
+        'difficulty': rng.randint(1, 5)
+    }
+
+
+def seed_questions(count, batch_size=10000):
+    from models import db, Question, Category
+
+    rng = random.Random(count)
+    db.session.execute(Category.__table__.insert(), [
+        {'id': i + 1, 'type': name} for i, name in enumerate(
+            ['Science', 'Art', 'Geography', 'History', 'Entertainment',
+             'Sports'])])
+    for start in range(0, count, batch_size):
+        db.session.execute(Question.__table__.insert(), [
+            make_question(i, rng)
+            for i in range(start, min(start + batch_size, count))])
+    db.session.commit()
+
+
+'''
+pagination
+    GET /questions over a large question bank: loading every row and
+    slicing in python (the former implementation) versus LIMIT/OFFSET and
+    the ?after_id= keyset cursor, on a shallow and a deep page
+'''
+@benchmark
+def bench_pagination(questions=200000, number=20):
+    from flaskr import QUESTIONS_PER_PAGE
+    from models import Question
+
+    with temporary_app() as app:
+        seed_questions(questions)
+        client = app.test_client()
+        print('pagination ({} questions, {} requests)'.format(
+            questions, number))
+
+        def load_all_and_slice(page):
+            start = (page - 1) * QUESTIONS_PER_PAGE
+            all_questions = Question.query.order_by(Question.id).all()
+            formatted = [question.format() for question in all_questions]
+            return formatted[start:start + QUESTIONS_PER_PAGE], \
+                len(all_questions)
+
+        last_page = questions // QUESTIONS_PER_PAGE
+        deep_id = Question.query.order_by(Question.id).offset(
+            questions - QUESTIONS_PER_PAGE - 1).first().id
+        report_ms('load all + slice, page 1',
+                  timeit.timeit(lambda: load_all_and_slice(1), number=3), 3)
+        report_ms('load all + slice, last page',
+                  timeit.timeit(lambda: load_all_and_slice(last_page),
+                                number=3), 3)
+        report_ms('GET /questions?page=1',
+                  timeit.timeit(lambda: client.get('/questions?page=1'),
+                                number=number), number)
+        report_ms('GET /questions?page={}'.format(last_page),
+                  timeit.timeit(lambda: client.get(
+                      '/questions?page={}'.format(last_page)),
+                      number=number), number)
+        report_ms('GET /questions?after_id={}'.format(deep_id),
+                  timeit.timeit(lambda: client.get(
+                      '/questions?after_id={}'.format(deep_id)),
+                      number=number), number)
+
+
+'''
+category_questions
+    GET /categories/<id>/questions over a large question bank: loading the
+    whole category and slicing in python (the former implementation) versus
+    the paginated query, without and with the (category, id) index of
+    migrations.convert_question_category, with the plan of the page query
+'''
+@benchmark
+def bench_category_questions(questions=200000, number=20):
+    from flaskr import QUESTIONS_PER_PAGE
+    from models import db, Question
+    from sqlalchemy import text
+
+    with temporary_app() as app:
+        seed_questions(questions)
+        explain = 'EXPLAIN' if db.engine.dialect.name == 'postgresql' \
+            else 'EXPLAIN QUERY PLAN'
+        page_query = text(
+            '{} SELECT * FROM questions WHERE category = 1 ORDER BY id '
+            'LIMIT {} OFFSET 1000'.format(explain, QUESTIONS_PER_PAGE + 1))
+        client = app.test_client()
+        category_size = Question.query.filter(Question.category == 1).count()
+        last_page = (category_size - 1) // QUESTIONS_PER_PAGE + 1
+        deep_id = db.session.query(Question.id).filter(
+            Question.category == 1).order_by(Question.id).offset(
+            category_size - QUESTIONS_PER_PAGE - 1).limit(1).scalar()
+        print('category_questions ({} questions, {} in the category, '
+              '{} requests)'.format(questions, category_size, number))
+
+        def load_all_and_slice(page):
+            start = (page - 1) * QUESTIONS_PER_PAGE
+            category_questions = Question.query.filter(
+                Question.category == 1).all()
+            formatted = [question.format() for question in category_questions]
+            return formatted[start:start + QUESTIONS_PER_PAGE], \
+                len(category_questions)
+
+        report_ms('load all + slice (former), page 1',
+                  timeit.timeit(lambda: load_all_and_slice(1), number=3), 3)
+        for indexed in (False, True):
+            db.session.execute(text(
+                'CREATE INDEX questions_category_id_idx '
+                'ON questions (category, id)' if indexed else
+                'DROP INDEX questions_category_id_idx'))
+            db.session.execute(text('ANALYZE questions'))
+            db.session.commit()
+            state = 'with index' if indexed else 'no index'
+            print('  {} plan:'.format(state))
+            for row in db.session.execute(page_query):
+                print('    ' + str(row[-1]))
+            for url in ['/categories/1/questions?page=1',
+                        '/categories/1/questions?page={}'.format(last_page),
+                        '/categories/1/questions?after_id={}'.format(
+                            deep_id)]:
+                report_ms('{}, {}'.format(state, url[len('/categories/1'):]),
+                          timeit.timeit(lambda: client.get(url),
+                                        number=number), number)
+
+
+'''
+question_rows
+    serializing listed questions: Question objects and Question.format()
+    (the former implementation) versus QUESTION_COLUMNS rows and
+    format_question_row(), for a page and for a large batch
+'''
+@benchmark
+def bench_question_rows(questions=100000, batches=(10, 10000), number=20):
+    from models import db, Question, QUESTION_COLUMNS, format_question_row
+
+    with temporary_app() as app:
+        seed_questions(questions)
+        print('question_rows ({} questions)'.format(questions))
+        for size in batches:
+            def objects():
+                questions = Question.query.order_by(Question.id).limit(size)
+                result = [question.format() for question in questions]
+                # a request does not keep its objects around either
+                db.session.expunge_all()
+                return result
+
+            def rows():
+                return [format_question_row(row) for row in db.session.query(
+                    *QUESTION_COLUMNS).order_by(Question.id).limit(size)]
+
+            assert objects() == rows()
+            rounds = max(number, 100000 // size)
+            report_throughput('{} rows, Question + format()'.format(size),
+                              timeit.timeit(objects, number=rounds),
+                              rounds * size)
+            report_throughput('{} rows, columns + format_question_row'.format(
+                size), timeit.timeit(rows, number=rounds), rounds * size)
+
+
+'''
+stats
+    the question totals: counting with a COUNT query per request (the
+    former totals of the list endpoints) versus GET /stats, recounted by
+    its GROUP BY and served from QuestionStats
+'''
+@benchmark
+def bench_stats(questions=200000, number=200):
+    from flaskr.stats import question_stats
+    from models import db, Question
+
+    with temporary_app() as app:
+        seed_questions(questions)
+        client = app.test_client()
+        print('stats ({} questions, {} requests)'.format(questions, number))
+
+        report_ms('COUNT(*) of all the questions (former)', timeit.timeit(
+            lambda: db.session.query(db.func.count(Question.id)).scalar(),
+            number=20), 20)
+        report_ms('COUNT(*) of a category (former)', timeit.timeit(
+            lambda: db.session.query(db.func.count(Question.id)).filter(
+                Question.category == 1).scalar(), number=20), 20)
+
+        def recount():
+            question_stats().invalidate()
+            return question_stats().body()
+
+        report_ms('GROUP BY category, difficulty (a miss)',
+                  timeit.timeit(recount, number=20), 20)
+        report_ms('GET /stats, cached', timeit.timeit(
+            lambda: client.get('/stats'), number=number), number)
+        rng = random.Random(questions)
+        report_ms('POST /questions + GET /stats (counts applied)',
+                  timeit.timeit(lambda: (
+                      client.post('/questions',
+                                  json=make_question(questions, rng)),
+                      client.get('/stats')), number=number), number)
+        report_ms('GET /questions?page=1', timeit.timeit(
+            lambda: client.get('/questions?page=1'), number=number), number)
+        report_ms('GET /categories/1/questions?page=1', timeit.timeit(
+            lambda: client.get('/categories/1/questions?page=1'),
+            number=number), number)
+
+
+'''
+categories
+    GET /categories querying and jsonifying the categories on every request
+    (the former implementation) versus the per-app CategoryCache
+'''
+@benchmark
+def bench_categories(number=2000):
+    from flask import jsonify
+    from flaskr.categories import category_cache
+    from models import Category
+
+    with temporary_app() as app:
+        seed_questions(0)
+        client = app.test_client()
+        print('categories ({} requests)'.format(number))
+
+        def query_and_jsonify():
+            with app.test_request_context('/categories'):
+                return jsonify({
+                    'categories': {category.id: category.type for category in
+                                   Category.query.order_by(Category.id).all()},
+                    'success': True
+                }).get_data()
+
+        report_ms('view body: query + jsonify (former)', timeit.timeit(
+            query_and_jsonify, number=number), number)
+        report_ms('GET /categories, cached body', timeit.timeit(
+            lambda: client.get('/categories'), number=number), number)
+        report_ms('view body: CategoryCache.body()', timeit.timeit(
+            lambda: category_cache().body(), number=number), number)
+        print('  {:<44} {}'.format('cache stats', category_cache().stats()))
+
+
+'''
+search
+    POST /questions {"searchTerm": ...} over a large question bank: ILIKE
+    loading every match (the former implementation) versus the search
+    backend of the database (InvertedIndexSearch on sqlite, PostgresSearch
+    on PostgreSQL)
+'''
+@benchmark
+def bench_search(questions=200000, number=20):
+    from flaskr.search import question_search
+    from models import Question
+
+    with temporary_app() as app:
+        seed_questions(questions)
+        client = app.test_client()
+        print('search ({} questions, {} requests, {})'.format(
+            questions, number, type(question_search()).__name__))
+
+        def ilike_and_slice(term):
+            matches = Question.query.filter(Question.question.ilike(
+                '%' + term + '%')).order_by(Question.id).all()
+            return [question.format() for question in matches][:10], \
+                len(matches)
+
+        def search(term):
+            return client.post('/questions', json={'searchTerm': term})
+
+        started = time.perf_counter()
+        search('river')
+        report_ms('first search, builds the index',
+                  time.perf_counter() - started, 1)
+        for term in ['river', 'number 123456', 'zzz']:
+            report_ms('ILIKE + slice (former), {!r}'.format(term),
+                      timeit.timeit(lambda: ilike_and_slice(term), number=3),
+                      3)
+            report_ms('POST /questions search, {!r}'.format(term),
+                      timeit.timeit(lambda: search(term), number=number),
+                      number)
+
+
+'''
+quiz
+    POST /quizzes as the question bank grows: loading every eligible
+    question and fetching the chosen one again (the former implementation)
+    versus the cached id arrays of QuestionPicker
+'''
+@benchmark
+def bench_quiz(sizes=(1000, 10000, 100000), number=200):
+    from models import Question
+
+    print('quiz ({} requests, 20 previous questions)'.format(number))
+    for size in sizes:
+        with temporary_app() as app:
+            seed_questions(size)
+            client = app.test_client()
+            rng = random.Random(size)
+            previous = rng.sample(range(1, size + 1), 20)
+            body = {'previous_questions': previous,
+                    'quiz_category': {'id': 1, 'type': 'Science'}}
+
+            def load_all_and_choose():
+                eligible = Question.query.filter(
+                    Question.category == 1,
+                    ~Question.id.in_(previous)).all()
+                return Question.query.get(
+                    rng.choice([question.id for question in eligible]))
+
+            client.post('/quizzes', json=body)
+            report_ms('{} questions, load all + choice (former)'.format(size),
+                      timeit.timeit(load_all_and_choose, number=5), 5)
+            report_ms('{} questions, POST /quizzes'.format(size),
+                      timeit.timeit(lambda: client.post('/quizzes', json=body),
+                                    number=number), number)
+
+
+'''
+quiz_session
+    a long quiz played with POST /quizzes, resending every previous question
+    each turn, versus a quiz session answering each turn by its cursor
+'''
+@benchmark
+def bench_quiz_session(questions=100000, turns=1000):
+    with temporary_app() as app:
+        seed_questions(questions)
+        client = app.test_client()
+        category = {'id': 1, 'type': 'Science'}
+        print('quiz_session ({} questions, {} turns)'.format(
+            questions, turns))
+
+        previous = []
+        started = time.perf_counter()
+        for _ in range(turns):
+            question = client.post('/quizzes', json={
+                'previous_questions': previous,
+                'quiz_category': category}).get_json()['question']
+            previous.append(question['id'])
+        report_ms('POST /quizzes, previous_questions resent',
+                  time.perf_counter() - started, turns)
+
+        started = time.perf_counter()
+        session_id = client.post('/quizzes/sessions', json={
+            'quiz_category': category}).get_json()['session_id']
+        report_ms('POST /quizzes/sessions (once)',
+                  time.perf_counter() - started, 1)
+        started = time.perf_counter()
+        for _ in range(turns):
+            client.post('/quizzes/sessions/{}/next'.format(session_id))
+        report_ms('POST /quizzes/sessions/<id>/next',
+                  time.perf_counter() - started, turns)
+
+
+'''
+question_import
+    loading questions one POST /questions at a time (a commit per question)
+    versus flask import-questions on csv, ndjson and json files, with the
+    peak memory of the process
+'''
+@benchmark
+def bench_question_import(questions=1000000, posted=1000):
+    import csv
+    import json
+    import resource
+
+    rng = random.Random(questions)
+    directory = tempfile.mkdtemp()
+
+    def path(file_format):
+        return os.path.join(directory, 'questions.' + file_format)
+
+    # written a row at a time, so the peak memory is the import's
+    with open(path('csv'), 'w', newline='') as csv_file, \
+            open(path('ndjson'), 'w') as ndjson_file, \
+            open(path('json'), 'w') as json_file:
+        writer = csv.DictWriter(csv_file, fieldnames=[
+            'question', 'answer', 'category', 'difficulty'])
+        writer.writeheader()
+        json_file.write('[')
+        for i in range(questions):
+            row = make_question(i, rng)
+            writer.writerow(row)
+            ndjson_file.write(json.dumps(row) + '\n')
+            json_file.write((',\n' if i else '') + json.dumps(row))
+        json_file.write(']')
+
+    print('question_import ({} questions)'.format(questions))
+    with temporary_app() as app:
+        seed_questions(0)
+        client = app.test_client()
+        started = time.perf_counter()
+        for i in range(posted):
+            client.post('/questions', json=make_question(i, rng))
+        report_throughput('POST /questions, one at a time',
+                          time.perf_counter() - started, posted)
+
+    for file_format in ['csv', 'ndjson', 'json']:
+        with temporary_app() as app:
+            seed_questions(0)
+            runner = app.test_cli_runner()
+            started = time.perf_counter()
+            result = runner.invoke(args=['import-questions',
+                                         path(file_format)])
+            report_throughput('flask import-questions, ' + file_format,
+                              time.perf_counter() - started, questions)
+            if result.exit_code != 0:
+                print(result.output)
+    print('  {:<44} {:>10.1f} MiB'.format(
+        'peak memory', resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
@@ -2,17 +2,66 @@ import os
 from flask import Flask, request, abort, jsonify
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-import random
 
-from models import setup_db, Question, Category
+from models import setup_db, database_path, db, Question, \
+    QUESTION_COLUMNS, format_question_row
+from .categories import category_cache, init_category_cache
+from .importer import import_questions_command
+from .quiz import init_question_picker, question_picker, quiz_sessions, \
+    QUIZ_SESSION_QUESTIONS
+from .search import init_question_search, question_search
+from .stats import init_question_stats, question_stats
 
 QUESTIONS_PER_PAGE = 10
 
+'''
+paginate_questions(query)
+    the page of query asked for by the request, sliced by the database
+    query selects QUESTION_COLUMNS, so the page is a list of rows
+      ?page=<n>       LIMIT/OFFSET, the numbered pages of the frontend
+      ?after_id=<id>  keyset cursor: the questions following that id, the
+                      cost stays the same however deep the page is
+    returns (questions, next_after_id), next_after_id is None on the last
+    page. the totals come from question_stats(), nothing is counted here
+'''
+def paginate_questions(query):
+    query = query.order_by(Question.id)
+    after_id = request.args.get('after_id', type=int)
+    if after_id is not None:
+        query = query.filter(Question.id > after_id)
+    else:
+        page = request.args.get('page', 1, type=int)
+        query = query.offset(max(page - 1, 0) * QUESTIONS_PER_PAGE)
+    # one row more than a page tells whether there is a next page
+    questions = query.limit(QUESTIONS_PER_PAGE + 1).all()
+
+    next_after_id = None
+    if len(questions) > QUESTIONS_PER_PAGE:
+        questions = questions[:QUESTIONS_PER_PAGE]
+        next_after_id = questions[-1][0]
+    return questions, next_after_id
+
+
+'''
+init_caches(app)
+    gives app empty per-app caches: categories, search backend, quiz
+    question ids and sessions, question statistics
+'''
+def init_caches(app):
+    init_category_cache(app)
+    init_question_search(app)
+    init_question_picker(app)
+    init_question_stats(app)
+
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
-    setup_db(app)
+    if test_config is not None:
+        app.config.from_mapping(test_config)
+    setup_db(app, app.config.get('SQLALCHEMY_DATABASE_URI', database_path))
+    init_caches(app)
+    app.cli.add_command(import_questions_command)
 
     '''
   @TODO: Set up CORS. Allow '*' for origins.
@@ -36,14 +85,8 @@ def create_app(test_config=None):
   '''
     @app.route('/categories')
     def get_categories():
-        all_categories = Category.query.order_by(Category.id).all()
-        formatted_categories = {
-            Category.id: Category.type for Category in all_categories}
-
-        return jsonify({
-            'categories': formatted_categories,
-            'success': True
-        })
+        return app.response_class(category_cache().body(),
+                                  mimetype='application/json')
 
     '''
   @TODO:
@@ -60,22 +103,18 @@ def create_app(test_config=None):
   '''
     @app.route('/questions')
     def get_questions():
-        page = request.args.get('page', 1, type=int)
-        start = (page - 1) * QUESTIONS_PER_PAGE
-        end = start + QUESTIONS_PER_PAGE
-
-        all_categories = Category.query.order_by(Category.id).all()
-        formatted_categories = {
-            Category.id: Category.type for Category in all_categories}
+        formatted_categories = category_cache().categories()
 
-        all_questions = Question.query.order_by(Question.id).all()
-        formatted_questions = [Question.format() for Question in all_questions]
-        formatted_current_selection = formatted_questions[start:end]
+        questions, next_after_id = paginate_questions(
+            db.session.query(*QUESTION_COLUMNS))
+        formatted_current_selection = [
+            format_question_row(question) for question in questions]
 
         if len(formatted_current_selection):
             return jsonify({
                 'questions': formatted_current_selection,
-                'total_questions': len(all_questions),
+                'total_questions': question_stats().total(),
+                'next_after_id': next_after_id,
                 'categories': formatted_categories,
                 'current_category': '',
                 'success': True
@@ -127,29 +166,22 @@ def create_app(test_config=None):
         body = request.get_json()
 
         if 'searchTerm' in body:
-            search_term = body.get('searchTerm', None)
+            search_term = body.get('searchTerm', None) or ''
             page = request.args.get('page', 1, type=int)
-            start = (page - 1) * QUESTIONS_PER_PAGE
-            end = start + QUESTIONS_PER_PAGE
-
-            search_term_questions = Question.query.filter(
-                Question.question.ilike(
-                    '%' +
-                    search_term +
-                    '%')).order_by(
-                Question.id).all()
-            formatted_search_term_questions = [
-                Question.format() for Question in search_term_questions]
-            formatted_current_selection =\
-                formatted_search_term_questions[start:end]
-
-            all_categories = Category.query.order_by(Category.id).all()
-            formatted_categories = {
-                Category.id: Category.type for Category in all_categories}
+            start = max(page - 1, 0) * QUESTIONS_PER_PAGE
+
+            # best matches first, one page fetched by the search backend
+            search_term_questions, total = question_search().search(
+                search_term, start, QUESTIONS_PER_PAGE)
+            formatted_current_selection = [
+                format_question_row(question)
+                for question in search_term_questions]
+
+            formatted_categories = category_cache().categories()
 
             return jsonify({
                 'questions': formatted_current_selection,
-                'total_questions': len(search_term_questions),
+                'total_questions': total,
                 'categories': formatted_categories,
                 'current_category': ''
             })
@@ -166,7 +198,7 @@ def create_app(test_config=None):
                 question = Question(
                     new_question,
                     new_question_answer,
-                    new_question_category,
+                    int(new_question_category),
                     new_question_difficulty)
                 question.insert()
 
@@ -199,27 +231,33 @@ def create_app(test_config=None):
   '''
     @app.route('/categories/<int:category_id>/questions')
     def get_category_questions(category_id):
-        page = request.args.get('page', 1, type=int)
-        start = (page - 1) * QUESTIONS_PER_PAGE
-        end = start + QUESTIONS_PER_PAGE
-
-        current_category = Category.query.filter(
-            Category.id == category_id).one_or_none()
+        current_category = category_cache().categories().get(category_id)
         if current_category is None:
             abort(404)
 
-        category_questions = Question.query.filter(
-            Question.category == category_id).all()
-        formatted_category_questions = [
-            Question.format() for Question in category_questions]
-        formatted_current_selection = formatted_category_questions[start:end]
+        # a range of the (category, id) index, see paginate_questions
+        questions, next_after_id = paginate_questions(
+            db.session.query(*QUESTION_COLUMNS).filter(
+                Question.category == category_id))
+        formatted_current_selection = [
+            format_question_row(question) for question in questions]
 
         return jsonify({
             'questions': formatted_current_selection,
-            'total_questions': len(category_questions),
-            'current_category': current_category.type
+            'total_questions': question_stats().total(category_id),
+            'next_after_id': next_after_id,
+            'current_category': current_category
         })
 
+    '''
+  Question counts for dashboards: the totals, per category and per
+  difficulty, without listing any question.
+  '''
+    @app.route('/stats')
+    def get_stats():
+        return app.response_class(question_stats().body(),
+                                  mimetype='application/json')
+
     '''
   @TODO:
   Create a POST endpoint to get questions to play the quiz.
@@ -240,38 +278,66 @@ def create_app(test_config=None):
         previous_questions = body.get('previous_questions', None)
         quiz_category = body.get('quiz_category', None)
 
-        if quiz_category['id'] == 0:
-            all_questions = Question.query.filter(
-                ~Question.id.in_(previous_questions)).all()
-            all_questions_ids = [Question.id for Question in all_questions]
-            if len(all_questions_ids) == 0:
-                return jsonify({
-                    'question': None,
-                    'success': True
-                })
-            formatted_random_question = Question.query.get(
-                random.choice(all_questions_ids)).format()
-            return jsonify({
-                'question': formatted_random_question,
-                'success': True
-            })
-        else:
-            category_questions = Question.query.filter(
-                Question.category == quiz_category['id'],
-                ~Question.id.in_(previous_questions)).all()
-            category_questions_ids = [
-                Question.id for Question in category_questions]
-            if len(category_questions_ids) == 0:
-                return jsonify({
-                    'question': None,
-                    'success': True
-                })
-            random_question = Question.query.get(
-                random.choice(category_questions_ids)).format()
-            return jsonify({
-                'question': random_question,
-                'success': True
-            })
+        # a random question out of the cached ids of the category,
+        # then a single primary key lookup
+        question = question_picker().pick(quiz_category['id'],
+                                          previous_questions)
+        return jsonify({
+            'question': question.format() if question is not None else None,
+            'success': True
+        })
+
+    '''
+  Quiz sessions, an alternative to POST /quizzes for long quizzes: the
+  question order is shuffled once when the session starts, and each turn
+  only sends the session id instead of every previous question. a session
+  serves at most QUIZ_SESSION_QUESTIONS (config) questions.
+  '''
+    @app.route('/quizzes/sessions', methods=['POST'])
+    def start_quiz_session():
+        body = request.get_json() or {}
+        if not isinstance(body, dict):
+            abort(400)
+
+        quiz_category = body.get('quiz_category', None)
+        if not isinstance(quiz_category, dict) or \
+                not isinstance(quiz_category.get('id'), (int, str)):
+            abort(400)
+        previous_questions = body.get('previous_questions', None) or []
+        if not isinstance(previous_questions, list) or not all(
+                isinstance(question_id, int)
+                for question_id in previous_questions):
+            abort(400)
+
+        question_ids = question_picker().shuffled(
+            quiz_category['id'], previous_questions,
+            app.config.get('QUIZ_SESSION_QUESTIONS', QUIZ_SESSION_QUESTIONS))
+        return jsonify({
+            'session_id': quiz_sessions().create(question_ids),
+            'total_questions': len(question_ids),
+            'success': True
+        })
+
+    @app.route('/quizzes/sessions/<session_id>/next', methods=['POST'])
+    def next_quiz_question(session_id):
+        while True:
+            try:
+                question_id, remaining = quiz_sessions().advance(session_id)
+            except KeyError:
+                abort(404)
+            if question_id is None:
+                question = None
+                break
+            question = db.session.get(Question, question_id)
+            # skip the questions deleted since the session started
+            if question is not None:
+                break
+
+        return jsonify({
+            'question': question.format() if question is not None else None,
+            'remaining_questions': remaining,
+            'success': True
+        })
 
     '''
   @TODO:
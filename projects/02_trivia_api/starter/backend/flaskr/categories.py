@@ -0,0 +1,116 @@
+import json
+import threading
+import time
+
+from flask import current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+from models import Category
+
+CATEGORY_CACHE_TTL = 300
+
+'''
+CategoryCache
+the {id: type} map of the categories and the GET /categories body already
+encoded as json, read from the database once and shared by every request
+
+    each app created by create_app gets its own cache in
+    app.extensions['category_cache'], see init_category_cache(app)
+    it is emptied when a transaction inserting, updating or deleting a
+    category is committed by this process, and rebuilt after ttl seconds
+    anyway so changes made by another process show up
+    hits and misses count the reads served from memory and from the database
+'''
+class CategoryCache:
+    def __init__(self, ttl=CATEGORY_CACHE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entry = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    '''
+    categories()
+        the {id: type} map, shared between requests: do not modify it
+    '''
+    def categories(self):
+        return self._get()[0]
+
+    '''
+    body()
+        the {"categories": {...}, "success": true} json body as bytes
+    '''
+    def body(self):
+        return self._get()[1]
+
+    def invalidate(self):
+        with self._lock:
+            self._entry = None
+            self.invalidations += 1
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations
+        }
+
+    def _get(self):
+        entry = self._entry
+        if entry is not None and entry[2] > time.monotonic():
+            self.hits += 1
+            return entry
+
+        with self._lock:
+            # another request may have loaded them while this one waited
+            entry = self._entry
+            if entry is not None and entry[2] > time.monotonic():
+                self.hits += 1
+                return entry
+            self.misses += 1
+            categories = {category.id: category.type for category in
+                          Category.query.order_by(Category.id).all()}
+            body = json.dumps({'categories': categories, 'success': True},
+                              separators=(',', ':')).encode()
+            self._entry = (categories, body, time.monotonic() + self.ttl)
+            return self._entry
+
+'''
+init_category_cache(app)
+    gives app its CategoryCache, the ttl is read from the
+    CATEGORY_CACHE_TTL config
+'''
+def init_category_cache(app):
+    cache = CategoryCache(app.config.get('CATEGORY_CACHE_TTL',
+                                         CATEGORY_CACHE_TTL))
+    app.extensions['category_cache'] = cache
+    return cache
+
+'''
+category_cache()
+    the CategoryCache of the current app
+'''
+def category_cache():
+    return current_app.extensions['category_cache']
+
+
+@event.listens_for(Category, 'after_insert')
+@event.listens_for(Category, 'after_update')
+@event.listens_for(Category, 'after_delete')
+def category_changed(mapper, connection, target):
+    object_session(target).info['categories_changed'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_category_cache(session):
+    # after the commit, so a request cannot cache the old categories again
+    if session.info.pop('categories_changed', False) and \
+            has_app_context() and 'category_cache' in current_app.extensions:
+        category_cache().invalidate()
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_category_changes(session):
+    session.info.pop('categories_changed', None)
@@ -0,0 +1,285 @@
+import codecs
+import csv
+import functools
+import io
+import itertools
+import json
+import re
+import time
+
+import click
+from flask.cli import with_appcontext
+
+from models import db, Question
+from .categories import category_cache
+from .quiz import question_picker
+from .search import question_search
+from .stats import question_stats
+
+BATCH_SIZE = 10000
+CHUNK_SIZE = 64 * 1024
+# a json array item larger than this stops the import instead of buffering
+# the rest of the file looking for its end
+MAX_ITEM_SIZE = 1024 * 1024
+# rejected rows listed in full, the others are only counted
+MAX_REPORTED_ERRORS = 20
+COLUMNS = ('question', 'answer', 'category', 'difficulty')
+DIFFICULTIES = range(1, 6)
+WHITESPACE = re.compile(r'\s*')
+
+'''
+ImportFormatError
+the file can not be read any further: not a json array, a broken csv quote,
+a missing csv column...
+'''
+class ImportFormatError(ValueError):
+    pass
+
+'''
+question file readers
+each reads a binary stream a chunk or a line at a time and yields
+(position, row) pairs, position being where the row is in the file
+('line 12', 'item 3') and row a dict, or a ValueError for a row that is
+not valid json
+    iter_csv     a header line naming the columns, then one question a line
+    iter_ndjson  a json object a line
+    iter_json    a json array of objects
+'''
+def iter_csv(stream):
+    lines = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    reader = csv.DictReader(lines)
+    missing = [name for name in COLUMNS
+               if name not in (reader.fieldnames or ())]
+    if missing:
+        raise ImportFormatError('missing columns: ' + ', '.join(missing))
+    try:
+        for row in reader:
+            yield 'line {}'.format(reader.line_num), row
+    except csv.Error as error:
+        raise ImportFormatError('line {}: {}'.format(reader.line_num, error))
+
+
+def iter_ndjson(stream):
+    lines = io.TextIOWrapper(stream, encoding='utf-8-sig')
+    for number, line in enumerate(lines, 1):
+        if line.strip():
+            try:
+                row = json.loads(line)
+            except ValueError as error:
+                row = ValueError('invalid json: {}'.format(error))
+            yield 'line {}'.format(number), row
+
+
+def iter_json(stream, chunk_size=CHUNK_SIZE):
+    decoder = json.JSONDecoder()
+    chunks = codecs.iterdecode(
+        iter(functools.partial(stream.read, chunk_size), b''), 'utf-8-sig')
+    expected = {'[': "'['", 'first': "an item or ']'", 'item': 'an item',
+                ',]': "',' or ']'", 'end': 'the end of the file'}
+    buffer, position, state, number = '', 0, '[', 0
+
+    for chunk in itertools.chain(chunks, [None]):
+        final = chunk is None
+        buffer = buffer[position:] + (chunk or '')
+        position = 0
+        while True:
+            position = WHITESPACE.match(buffer, position).end()
+            if position == len(buffer):
+                break
+            char = buffer[position]
+            if state in ('[', ',]') and char in state or \
+                    state == 'first' and char == ']':
+                position += 1
+                state = {'[': 'first', ',': 'item', ']': 'end'}[char]
+                continue
+            if state not in ('first', 'item'):
+                raise ImportFormatError('item {}: expected {}'.format(
+                    number + 1, expected[state]))
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError as error:
+                # the item may go on in the next chunk
+                if not final and len(buffer) - position < MAX_ITEM_SIZE:
+                    break
+                raise ImportFormatError('item {}: {}'.format(
+                    number + 1, error.msg))
+            if end == len(buffer) and not final:
+                # a number may go on in the next chunk, decode it again
+                break
+            number += 1
+            position = end
+            state = ',]'
+            yield 'item {}'.format(number), item
+
+    if state != 'end':
+        raise ImportFormatError('item {}: expected {}'.format(
+            number + 1, expected[state]))
+
+
+READERS = {'csv': iter_csv, 'ndjson': iter_ndjson, 'jsonl': iter_ndjson,
+           'json': iter_json}
+
+'''
+validate_question(row, categories)
+    returns the (question, answer, category id, difficulty) of a row of a
+    question file. the category is a category id or type ('Science'), case
+    insensitive; categories maps the ids and the lowercase types to the ids
+    raises ValueError when the row is not a valid question
+'''
+def validate_question(row, categories):
+    if isinstance(row, ValueError):
+        raise row
+    if not isinstance(row, dict):
+        raise ValueError('question must be an object')
+
+    values = []
+    for name in ('question', 'answer'):
+        value = row.get(name)
+        if not isinstance(value, str) or not value.strip():
+            raise ValueError(name + ' is required')
+        values.append(value.strip())
+
+    category = row.get('category')
+    if isinstance(category, str):
+        category = category.strip().lower()
+        if category.isdigit():
+            category = int(category)
+    if isinstance(category, bool) or \
+            not isinstance(category, (int, str)) or category not in categories:
+        raise ValueError('unknown category {!r}'.format(row.get('category')))
+    values.append(categories[category])
+
+    difficulty = row.get('difficulty')
+    if isinstance(difficulty, str) and difficulty.strip().isdigit():
+        difficulty = int(difficulty)
+    if isinstance(difficulty, bool) or not isinstance(difficulty, int) or \
+            difficulty not in DIFFICULTIES:
+        raise ValueError('difficulty must be 1 to 5')
+    values.append(difficulty)
+    return tuple(values)
+
+'''
+QuestionImport
+imports questions in batches, one transaction per batch: COPY on
+PostgreSQL, one executemany INSERT elsewhere
+
+    rows that are not valid questions are counted in rejected and skipped,
+    the first MAX_REPORTED_ERRORS of them are kept in errors. a file that
+    can not be read any further stops the import after the rows read so far
+    and sets malformed. memory use is bounded by the batch size, whatever
+    the size of the file
+    progress(result), if given, is called after every batch
+    EXAMPLE
+        with open('questions.csv', 'rb') as stream:
+            result = QuestionImport().run(iter_csv(stream))
+        result.imported, result.rejected, result.errors
+'''
+class QuestionImport:
+    def __init__(self, batch_size=BATCH_SIZE, progress=None):
+        self.batch_size = batch_size
+        self.progress = progress
+        self.imported = 0
+        self.rejected = 0
+        self.errors = []
+        self.malformed = None
+        self._batch = []
+
+    def run(self, rows):
+        categories = {}
+        for category_id, category_type in \
+                category_cache().categories().items():
+            categories[category_id] = category_id
+            categories[category_type.lower()] = category_id
+
+        try:
+            for position, row in rows:
+                try:
+                    self._batch.append(validate_question(row, categories))
+                except ValueError as error:
+                    self.error(position, str(error))
+                    continue
+                if len(self._batch) >= self.batch_size:
+                    self.flush()
+        except (ImportFormatError, UnicodeDecodeError) as error:
+            self.malformed = str(error)
+        self.flush()
+        return self
+
+    def error(self, position, message):
+        self.rejected += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'position': position, 'message': message})
+
+    '''
+    flush()
+        inserts the pending batch in its own transaction
+    '''
+    def flush(self):
+        if not self._batch:
+            return
+        if db.engine.dialect.name == 'postgresql':
+            self._copy(self._batch)
+        else:
+            db.session.execute(Question.__table__.insert(), [
+                dict(zip(COLUMNS, values)) for values in self._batch])
+        db.session.commit()
+        # the batches bypass the orm events keeping these up to date
+        question_search().invalidate()
+        question_picker().invalidate()
+        question_stats().invalidate()
+        self.imported += len(self._batch)
+        self._batch = []
+        if self.progress is not None:
+            self.progress(self)
+
+    def _copy(self, batch):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(batch)
+        buffer.seek(0)
+        cursor = db.session.connection().connection.cursor()
+        try:
+            cursor.copy_expert(
+                'COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(
+                    Question.__tablename__, ', '.join(COLUMNS)), buffer)
+        finally:
+            cursor.close()
+
+'''
+flask import-questions FILE
+    imports a csv, json or ndjson question file ('-' reads stdin), the
+    format is guessed from the file extension unless --format is given
+    EXAMPLE
+        FLASK_APP=flaskr flask import-questions questions.csv
+'''
+@click.command('import-questions')
+@click.argument('file', type=click.File('rb'))
+@click.option('--format', 'file_format', type=click.Choice(sorted(READERS)),
+              help='The file format, by default its extension.')
+@click.option('--batch-size', default=BATCH_SIZE, show_default=True,
+              help='Questions inserted per transaction.')
+@with_appcontext
+def import_questions_command(file, file_format, batch_size):
+    if file_format is None:
+        file_format = file.name.rpartition('.')[2].lower()
+        if file_format not in READERS:
+            raise click.UsageError('pass --format, the format of {} can not '
+                                   'be told from its name'.format(file.name))
+
+    started = time.perf_counter()
+
+    def report(result):
+        click.echo('{:,} questions imported, {:,} rejected ({:,.0f}/s)'.format(
+            result.imported, result.rejected,
+            result.imported / (time.perf_counter() - started)), err=True)
+
+    result = QuestionImport(batch_size, progress=report).run(
+        READERS[file_format](file))
+    for error in result.errors:
+        click.echo('{position}: {message}'.format(**error), err=True)
+    if result.rejected > len(result.errors):
+        click.echo('... {:,} more rejected rows'.format(
+            result.rejected - len(result.errors)), err=True)
+    click.echo('{:,} questions imported, {:,} rejected in {:.1f}s'.format(
+        result.imported, result.rejected, time.perf_counter() - started))
+    if result.malformed is not None:
+        raise click.ClickException('import stopped, ' + result.malformed)
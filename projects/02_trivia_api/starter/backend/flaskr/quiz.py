@@ -0,0 +1,206 @@
+import random
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models import db, Question
+
+QUESTION_IDS_TTL = 60
+QUIZ_SESSION_TTL = 3600
+MAX_QUIZ_SESSIONS = 10000
+# questions a quiz session serves at most
+QUIZ_SESSION_QUESTIONS = 50
+# random draws tried before falling back to listing the remaining ids
+MAX_DRAWS = 16
+
+'''
+QuestionPicker
+picks the random quiz questions out of per category arrays of question ids,
+so a quiz turn costs one primary key lookup instead of loading every
+eligible question
+
+    the id arrays are loaded once per category (0 for all the categories),
+    dropped when questions are written through the orm in this process and
+    reloaded after ttl seconds anyway. each app created by create_app gets
+    its own picker in app.extensions['question_picker'], and its quiz
+    session store in app.extensions['quiz_sessions']
+'''
+class QuestionPicker:
+    def __init__(self, ttl=QUESTION_IDS_TTL, rng=None):
+        self.ttl = ttl
+        self.rng = rng or random.Random()
+        self._lock = threading.Lock()
+        self._ids = {}
+        # bumped by invalidate(), ids loaded across a bump are not kept
+        self._generation = 0
+
+    '''
+    pick(category_id, previous_questions)
+        a random Question of the category (0 for any) whose id is not in
+        previous_questions, None when every question was asked already
+    '''
+    def pick(self, category_id, previous_questions):
+        excluded = set(previous_questions or ())
+        for _ in range(2):
+            question_id = self._pick_id(self.ids(category_id), excluded)
+            if question_id is None:
+                return None
+            question = db.session.get(Question, question_id)
+            if question is not None:
+                return question
+            # deleted by another process since the ids were loaded
+            self.invalidate()
+        return None
+
+    '''
+    ids(category_id)
+        the ids of the questions of the category, 0 for all of them
+    '''
+    def ids(self, category_id):
+        entry = self._ids.get(category_id)
+        if entry is not None and entry[1] > time.monotonic():
+            return entry[0]
+
+        generation = self._generation
+        query = db.session.query(Question.id)
+        if category_id != 0:
+            query = query.filter(Question.category == category_id)
+        ids = tuple(question_id for question_id, in query)
+        with self._lock:
+            if generation == self._generation:
+                self._ids[category_id] = (ids, time.monotonic() + self.ttl)
+        return ids
+
+    def invalidate(self):
+        with self._lock:
+            self._ids.clear()
+            self._generation += 1
+
+    def _pick_id(self, ids, excluded):
+        if len(excluded) < len(ids):
+            # while most questions are left a few draws find one, whatever
+            # the size of the category
+            for _ in range(MAX_DRAWS):
+                question_id = self.rng.choice(ids)
+                if question_id not in excluded:
+                    return question_id
+        remaining = [question_id for question_id in ids
+                     if question_id not in excluded]
+        return self.rng.choice(remaining) if remaining else None
+
+    '''
+    shuffled(category_id, previous_questions, limit)
+        the question ids of the category not in previous_questions, in a
+        random order, at most limit of them (every one when limit is None)
+    '''
+    def shuffled(self, category_id, previous_questions=(), limit=None):
+        excluded = set(previous_questions or ())
+        ids = [question_id for question_id in self.ids(category_id)
+               if question_id not in excluded]
+        if limit is None or limit > len(ids):
+            limit = len(ids)
+        return self.rng.sample(ids, limit)
+
+'''
+MemoryQuizSessionStore
+quiz sessions kept in the memory of this process
+
+    a session is the shuffled tuple of the question ids of a quiz and a
+    cursor into it. the quiz routes start sessions with at most the
+    QUIZ_SESSION_QUESTIONS config ids, however large the category, so a
+    session stays a few hundred bytes. at most maxsize sessions are kept,
+    the least recently used one is dropped first, and a session expires ttl
+    seconds after its last use
+    another store (e.g. shared by several processes) only needs the same
+    create(question_ids) and advance(session_id) methods, set it with the
+    QUIZ_SESSION_STORE config
+'''
+class MemoryQuizSessionStore:
+    def __init__(self, maxsize=MAX_QUIZ_SESSIONS, ttl=QUIZ_SESSION_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()
+
+    '''
+    create(question_ids)
+        stores a new session serving question_ids in order, returns its id
+    '''
+    def create(self, question_ids):
+        session_id = secrets.token_urlsafe(16)
+        with self._lock:
+            self._sessions[session_id] = [tuple(question_ids), 0,
+                                          time.monotonic() + self.ttl]
+            while len(self._sessions) > self.maxsize:
+                self._sessions.popitem(last=False)
+        return session_id
+
+    '''
+    advance(session_id)
+        moves the cursor of the session, returns (question id, number of
+        questions left after it), the question id is None once the quiz is
+        over. raises KeyError for an unknown or expired session
+    '''
+    def advance(self, session_id):
+        now = time.monotonic()
+        with self._lock:
+            session = self._sessions[session_id]
+            if session[2] <= now:
+                del self._sessions[session_id]
+                raise KeyError(session_id)
+            self._sessions.move_to_end(session_id)
+            question_ids, cursor, _ = session
+            session[2] = now + self.ttl
+            if cursor >= len(question_ids):
+                return None, 0
+            session[1] = cursor + 1
+            return question_ids[cursor], len(question_ids) - cursor - 1
+
+    def __len__(self):
+        return len(self._sessions)
+
+'''
+init_question_picker(app)
+    gives app its QuestionPicker, the ttl is read from the
+    QUESTION_IDS_TTL config
+'''
+def init_question_picker(app):
+    picker = QuestionPicker(app.config.get('QUESTION_IDS_TTL',
+                                           QUESTION_IDS_TTL))
+    app.extensions['question_picker'] = picker
+    store = app.config.get('QUIZ_SESSION_STORE')
+    app.extensions['quiz_sessions'] = \
+        store if store is not None else MemoryQuizSessionStore()
+    return picker
+
+
+def question_picker():
+    return current_app.extensions['question_picker']
+
+
+def quiz_sessions():
+    return current_app.extensions['quiz_sessions']
+
+
+@event.listens_for(Question, 'after_insert')
+@event.listens_for(Question, 'after_update')
+@event.listens_for(Question, 'after_delete')
+def quiz_question_changed(mapper, connection, target):
+    Session.object_session(target).info['quiz_questions_changed'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_question_ids(session):
+    if session.info.pop('quiz_questions_changed', False) and \
+            has_app_context() and 'question_picker' in current_app.extensions:
+        question_picker().invalidate()
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_quiz_question_changes(session):
+    session.info.pop('quiz_questions_changed', None)
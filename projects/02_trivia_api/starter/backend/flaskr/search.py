@@ -0,0 +1,211 @@
+import re
+import threading
+from collections import defaultdict
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, inspect, text
+from sqlalchemy.orm import Session
+
+from models import db, Question, QUESTION_COLUMNS, QUESTION_FIELDS
+
+WORD = re.compile(r'\w+')
+
+'''
+question search backends
+every backend has search(term, offset, limit) returning (questions, total):
+one page of the questions matching term, best match first, as rows of
+QUESTION_COLUMNS, and the number of matches. a question matches when it
+contains term, or when every word of term is found in it
+
+    PostgresSearch       tsvector column + GIN index, ranked, see
+                         migrations.add_question_search
+    LikeSearch           ILIKE '%term%', what PostgreSQL uses before the
+                         migration ran (pg_trgm makes it use an index)
+    InvertedIndexSearch  an index of the words of every question kept in
+                         this process, used on SQLite (tests, benchmarks)
+'''
+
+
+def like_pattern(term):
+    return '%' + re.sub(r'([\\%_])', r'\\\1', term) + '%'
+
+
+class LikeSearch:
+    def search(self, term, offset, limit):
+        query = db.session.query(*QUESTION_COLUMNS).filter(
+            Question.question.ilike(like_pattern(term), escape='\\'))
+        total = query.order_by(None).count()
+        questions = query.order_by(Question.id).offset(offset).limit(
+            limit).all()
+        return questions, total
+
+    def invalidate(self):
+        pass
+
+
+class PostgresSearch(LikeSearch):
+    # full text matches first, by rank, then the other substring matches by
+    # trigram similarity. the GIN indexes of the migration serve both
+    # conditions, count(*) OVER () gives the total in the same query
+    SEARCH = text('''
+        SELECT {}, count(*) OVER () AS total
+        FROM questions, websearch_to_tsquery('english', :term) AS query
+        WHERE search_vector @@ query OR question ILIKE :pattern
+        ORDER BY ts_rank(search_vector, query) DESC,
+                 similarity(question, :term) DESC, id
+        LIMIT :limit OFFSET :offset'''.format(', '.join(QUESTION_FIELDS)))
+    COUNT = text('''
+        SELECT count(*)
+        FROM questions, websearch_to_tsquery('english', :term) AS query
+        WHERE search_vector @@ query OR question ILIKE :pattern''')
+
+    def search(self, term, offset, limit):
+        params = {'term': term, 'pattern': like_pattern(term),
+                  'offset': offset, 'limit': limit}
+        rows = db.session.execute(self.SEARCH, params).all()
+        if not rows:
+            # past the last page, count(*) OVER () had no row to ride on
+            return [], db.session.execute(self.COUNT, params).scalar()
+        return [row[:-1] for row in rows], rows[0].total
+
+
+'''
+InvertedIndexSearch
+the words of every question mapped to the ids of the questions using them
+
+    built on the first search, then kept up to date by the questions
+    inserted, updated and deleted through the orm in this process. call
+    invalidate() after writing questions by other means
+    a term word is looked up as a whole word first; only when no question
+    uses it is every indexed word containing it matched, so substrings
+    still match. the words of each question are kept too, so a change only
+    touches the postings of the question changed
+'''
+class InvertedIndexSearch(LikeSearch):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._postings = None
+        self._words = None
+
+    def search(self, term, offset, limit):
+        words = WORD.findall(term.lower())
+        if not words:
+            # nothing to look up, e.g. blank or punctuation only
+            return super().search(term, offset, limit)
+
+        postings = self._index()
+        with self._lock:
+            matches = None
+            for word in words:
+                ids = postings.get(word)
+                if not ids:
+                    ids = set()
+                    for indexed_word, word_ids in postings.items():
+                        if word in indexed_word:
+                            ids |= word_ids
+                matches = ids if matches is None else matches & ids
+                if not matches:
+                    return [], 0
+
+            ranked = sorted(matches, key=lambda question_id: (
+                -sum(question_id in postings.get(word, ())
+                     for word in words),
+                question_id))
+        page = ranked[offset:offset + limit]
+        by_id = {question[0]: question for question in
+                 db.session.query(*QUESTION_COLUMNS).filter(
+                     Question.id.in_(page))} if page else {}
+        return [by_id[question_id] for question_id in page
+                if question_id in by_id], len(ranked)
+
+    def invalidate(self):
+        with self._lock:
+            self._postings = None
+            self._words = None
+
+    '''
+    apply(changes)
+        updates a built index with (question id, question text or None for a
+        deleted question) pairs
+    '''
+    def apply(self, changes):
+        with self._lock:
+            if self._postings is None:
+                return
+            for question_id, question in changes:
+                for word in self._words.pop(question_id, ()):
+                    ids = self._postings[word]
+                    ids.discard(question_id)
+                    if not ids:
+                        del self._postings[word]
+                if question is not None:
+                    self._add(question_id, question)
+
+    def _index(self):
+        postings = self._postings
+        if postings is not None:
+            return postings
+        with self._lock:
+            if self._postings is None:
+                self._postings = defaultdict(set)
+                self._words = {}
+                for question_id, question in db.session.query(
+                        Question.id, Question.question):
+                    self._add(question_id, question)
+            return self._postings
+
+    def _add(self, question_id, question):
+        words = self._words[question_id] = set(
+            WORD.findall((question or '').lower()))
+        for word in words:
+            self._postings[word].add(question_id)
+
+
+'''
+init_question_search(app)
+    the search backend of app is picked on its first search, from the
+    database it is bound to
+'''
+def init_question_search(app):
+    app.extensions['question_search'] = None
+
+
+def question_search():
+    backend = current_app.extensions.get('question_search')
+    if backend is None:
+        if db.engine.dialect.name != 'postgresql':
+            backend = InvertedIndexSearch()
+        elif 'search_vector' in {column['name'] for column in inspect(
+                db.engine).get_columns(Question.__tablename__)}:
+            backend = PostgresSearch()
+        else:
+            backend = LikeSearch()
+        current_app.extensions['question_search'] = backend
+    return backend
+
+
+@event.listens_for(Question, 'after_insert')
+@event.listens_for(Question, 'after_update')
+def question_written(mapper, connection, target):
+    Session.object_session(target).info.setdefault(
+        'question_changes', []).append((target.id, target.question))
+
+
+@event.listens_for(Question, 'after_delete')
+def question_deleted(mapper, connection, target):
+    Session.object_session(target).info.setdefault(
+        'question_changes', []).append((target.id, None))
+
+
+@event.listens_for(Session, 'after_commit')
+def update_question_search(session):
+    changes = session.info.pop('question_changes', None)
+    if changes and has_app_context():
+        backend = current_app.extensions.get('question_search')
+        if isinstance(backend, InvertedIndexSearch):
+            backend.apply(changes)
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_question_changes(session):
+    session.info.pop('question_changes', None)
@@ -0,0 +1,213 @@
+import copy
+import json
+import threading
+import time
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, func, inspect
+from sqlalchemy.orm import Session
+
+from models import db, Question
+from .categories import category_cache
+
+QUESTION_STATS_TTL = 60
+
+'''
+QuestionStats
+the question counts of the bank, all of them read by a single GROUP BY
+category, difficulty query and shared by every request
+
+    stats() is
+        {'total_questions': 19,
+         'difficulties': {1: 2, 2: 5, ...},
+         'categories': {1: {'total_questions': 3,
+                            'difficulties': {1: 0, 2: 1, ...}}, ...}}
+    with every category and difficulty, 0 when no question has it. the
+    questions without a category only count in the totals
+    each app created by create_app gets its own stats in
+    app.extensions['question_stats']. the questions inserted, updated and
+    deleted through the orm by this process are added to the counts when
+    their transaction is committed, without counting again. the counts are
+    made again after ttl seconds anyway so the questions written by another
+    process show up
+'''
+class QuestionStats:
+    DIFFICULTIES = range(1, 6)
+
+    def __init__(self, ttl=QUESTION_STATS_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entry = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    '''
+    stats()
+        the counts, shared between requests: do not modify them
+    '''
+    def stats(self):
+        return self._get()[0]
+
+    '''
+    body()
+        the GET /stats json body as bytes
+    '''
+    def body(self):
+        return self._get()[1]
+
+    '''
+    total(category_id=None)
+        the number of questions, of the category if one is given
+    '''
+    def total(self, category_id=None):
+        stats = self.stats()
+        if category_id is None:
+            return stats['total_questions']
+        category = stats['categories'].get(category_id)
+        return category['total_questions'] if category is not None else 0
+
+    def invalidate(self):
+        with self._lock:
+            self._entry = None
+            self.invalidations += 1
+
+    '''
+    apply(changes)
+        adds (category id, difficulty, +1 or -1) changes of the questions
+        written by this process to the counts, if they were made already
+    '''
+    def apply(self, changes):
+        with self._lock:
+            entry = self._entry
+            if entry is None:
+                return
+            # requests may still be reading the current counts
+            stats = copy.deepcopy(entry[0])
+            for category_id, difficulty, count in changes:
+                self._add(stats, category_id, difficulty, count)
+            self._entry = (stats, self._encode(stats), entry[2])
+
+    def _get(self):
+        entry = self._entry
+        if entry is not None and entry[2] > time.monotonic():
+            self.hits += 1
+            return entry
+
+        with self._lock:
+            # another request may have counted them while this one waited
+            entry = self._entry
+            if entry is not None and entry[2] > time.monotonic():
+                self.hits += 1
+                return entry
+            self.misses += 1
+            stats = self._count()
+            entry = (stats, self._encode(stats), time.monotonic() + self.ttl)
+            # counts including uncommitted questions of this session are not
+            # kept, apply() adds those questions once they are committed
+            if not db.session.info.get('question_stats_changes'):
+                self._entry = entry
+            return entry
+
+    def _count(self):
+        stats = {
+            'total_questions': 0,
+            'difficulties': self._histogram(),
+            'categories': {category_id: {'total_questions': 0,
+                                         'difficulties': self._histogram()}
+                           for category_id in category_cache().categories()}
+        }
+        rows = db.session.query(
+            Question.category, Question.difficulty,
+            func.count(Question.id)).group_by(
+            Question.category, Question.difficulty)
+        for category_id, difficulty, count in rows:
+            self._add(stats, category_id, difficulty, count)
+        return stats
+
+    def _add(self, stats, category_id, difficulty, count):
+        counts = [stats]
+        if category_id is not None:
+            counts.append(stats['categories'].setdefault(category_id, {
+                'total_questions': 0, 'difficulties': self._histogram()}))
+        for counted in counts:
+            counted['total_questions'] += count
+            if difficulty is not None:
+                counted['difficulties'][difficulty] = \
+                    counted['difficulties'].get(difficulty, 0) + count
+
+    def _histogram(self):
+        return dict.fromkeys(self.DIFFICULTIES, 0)
+
+    def _encode(self, stats):
+        return json.dumps(dict(stats, success=True),
+                          separators=(',', ':')).encode()
+
+'''
+init_question_stats(app)
+    gives app its QuestionStats, the ttl is read from the
+    QUESTION_STATS_TTL config
+'''
+def init_question_stats(app):
+    stats = QuestionStats(app.config.get('QUESTION_STATS_TTL',
+                                         QUESTION_STATS_TTL))
+    app.extensions['question_stats'] = stats
+    return stats
+
+'''
+question_stats()
+    the QuestionStats of the current app
+'''
+def question_stats():
+    return current_app.extensions['question_stats']
+
+
+def count_change(target, category_id, difficulty, count):
+    Session.object_session(target).info.setdefault(
+        'question_stats_changes', []).append((category_id, difficulty, count))
+
+
+@event.listens_for(Question, 'after_insert')
+def question_counted(mapper, connection, target):
+    count_change(target, target.category, target.difficulty, 1)
+
+
+@event.listens_for(Question, 'after_delete')
+def question_uncounted(mapper, connection, target):
+    count_change(target, target.category, target.difficulty, -1)
+
+
+@event.listens_for(Question, 'after_update')
+def question_recounted(mapper, connection, target):
+    attributes = inspect(target).attrs
+    history = [attributes.category.history, attributes.difficulty.history]
+    if not any(changed.has_changes() for changed in history):
+        return
+    if any(changed.has_changes() and not changed.deleted
+           for changed in history):
+        # the former value was not loaded, count everything again
+        Session.object_session(target).info['question_stats_stale'] = True
+        return
+    former = [changed.deleted[0] if changed.deleted else value
+              for changed, value in zip(
+                  history, [target.category, target.difficulty])]
+    count_change(target, former[0], former[1], -1)
+    count_change(target, target.category, target.difficulty, 1)
+
+
+@event.listens_for(Session, 'after_commit')
+def update_question_stats(session):
+    changes = session.info.pop('question_stats_changes', None)
+    stale = session.info.pop('question_stats_stale', False)
+    if (changes or stale) and has_app_context() and \
+            'question_stats' in current_app.extensions:
+        if stale:
+            question_stats().invalidate()
+        else:
+            question_stats().apply(changes)
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_question_stats_changes(session):
+    session.info.pop('question_stats_changes', None)
+    session.info.pop('question_stats_stale', None)
@@ -0,0 +1,152 @@
+'''
+migrations
+schema changes of the trivia database that db.create_all() does not make
+
+    every migration checks what is already there, running them again is
+    harmless. run them from the backend directory:
+        python migrations.py                     # the database of models.py
+        python migrations.py postgresql://postgres@localhost:5432/trivia_test
+'''
+import sys
+
+from sqlalchemy import Integer, create_engine, inspect, text
+
+from models import database_path
+
+'''
+add_question_search(connection)
+    full text search of the questions on PostgreSQL:
+    - questions.search_vector, the tsvector of the question text, filled in
+      by a trigger on every insert and update of the question
+    - a GIN index on it for the @@ matches of the search endpoint
+    - the pg_trgm extension and a trigram GIN index on questions.question,
+      so substring (ILIKE '%term%') matches use an index too
+    other databases search with flaskr.search.InvertedIndexSearch instead
+'''
+QUESTION_SEARCH = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "ALTER TABLE questions ADD COLUMN IF NOT EXISTS search_vector tsvector",
+    """
+    CREATE OR REPLACE FUNCTION questions_search_vector_update()
+    RETURNS trigger AS $$
+    BEGIN
+        NEW.search_vector := to_tsvector('english',
+                                         coalesce(NEW.question, ''));
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS questions_search_vector_update ON questions",
+    """
+    CREATE TRIGGER questions_search_vector_update
+    BEFORE INSERT OR UPDATE OF question ON questions
+    FOR EACH ROW EXECUTE PROCEDURE questions_search_vector_update()
+    """,
+    """
+    UPDATE questions
+    SET search_vector = to_tsvector('english', coalesce(question, ''))
+    WHERE search_vector IS NULL
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS questions_search_vector_idx
+    ON questions USING gin (search_vector)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS questions_question_trgm_idx
+    ON questions USING gin (question gin_trgm_ops)
+    """,
+]
+
+
+def add_question_search(connection, log=print):
+    if connection.dialect.name != 'postgresql':
+        log('add_question_search: skipped, not a PostgreSQL database')
+        return
+    for statement in QUESTION_SEARCH:
+        connection.execute(text(statement))
+
+
+'''
+convert_question_category(connection)
+    questions.category becomes an integer foreign key to categories.id, like
+    in trivia.psql (databases made by db.create_all() had it as a string),
+    with a (category, id) index so a page of a category is an index range
+    scan. PostgreSQL converts the column in place, SQLite copies the table
+'''
+SQLITE_QUESTIONS = '''
+    CREATE TABLE questions_migrated (
+        id INTEGER NOT NULL,
+        question VARCHAR,
+        answer VARCHAR,
+        category INTEGER,
+        difficulty INTEGER,
+        PRIMARY KEY (id),
+        FOREIGN KEY(category) REFERENCES categories (id)
+            ON DELETE SET NULL ON UPDATE CASCADE
+    )'''
+
+
+def convert_question_category(connection, log=print):
+    inspector = inspect(connection)
+    columns = {column['name']: column
+               for column in inspector.get_columns('questions')}
+    has_foreign_key = any(
+        foreign_key['constrained_columns'] == ['category']
+        for foreign_key in inspector.get_foreign_keys('questions'))
+
+    converted = not isinstance(columns['category']['type'], Integer)
+    if converted:
+        log('questions.category: converting to integer')
+        if connection.dialect.name == 'postgresql':
+            connection.execute(text(
+                "ALTER TABLE questions ALTER COLUMN category TYPE integer "
+                "USING NULLIF(category, '')::integer"))
+        else:
+            connection.execute(text(SQLITE_QUESTIONS))
+            connection.execute(text(
+                'INSERT INTO questions_migrated '
+                '(id, question, answer, category, difficulty) '
+                'SELECT id, question, answer, '
+                "CAST(NULLIF(category, '') AS INTEGER), "
+                'difficulty FROM questions'))
+            connection.execute(text('DROP TABLE questions'))
+            connection.execute(text(
+                'ALTER TABLE questions_migrated RENAME TO questions'))
+            has_foreign_key = True
+
+    if converted or not has_foreign_key:
+        orphans = connection.execute(text(
+            'UPDATE questions SET category = NULL WHERE category NOT IN '
+            '(SELECT id FROM categories)')).rowcount
+        if orphans:
+            log('{} questions had an unknown category, set to NULL'.format(
+                orphans))
+    if not has_foreign_key:
+        log('questions.category: adding the foreign key')
+        connection.execute(text(
+            'ALTER TABLE questions ADD CONSTRAINT questions_category_fkey '
+            'FOREIGN KEY (category) REFERENCES categories (id) '
+            'ON UPDATE CASCADE ON DELETE SET NULL'))
+
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS questions_category_id_idx '
+        'ON questions (category, id)'))
+
+
+MIGRATIONS = [add_question_search, convert_question_category]
+
+'''
+migrate(database_url)
+    runs every migration in order, in a single transaction
+'''
+def migrate(database_url=database_path, log=print):
+    engine = create_engine(database_url)
+    with engine.begin() as connection:
+        for migration in MIGRATIONS:
+            log('running ' + migration.__name__)
+            migration(connection, log=log)
+    engine.dispose()
+
+
+if __name__ == '__main__':
+    migrate(*sys.argv[1:2])
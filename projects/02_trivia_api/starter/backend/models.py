@@ -1,5 +1,5 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
+from sqlalchemy import Column, String, Integer, ForeignKey, Index, create_engine
 from flask_sqlalchemy import SQLAlchemy
 import json
 
@@ -25,11 +25,15 @@ Question
 '''
 class Question(db.Model):  
   __tablename__ = 'questions'
+  # the questions of a category in id order, for the paginated category
+  # listings (see migrations.convert_question_category for older databases)
+  __table_args__ = (Index('questions_category_id_idx', 'category', 'id'),)
 
   id = Column(Integer, primary_key=True)
   question = Column(String)
   answer = Column(String)
-  category = Column(String)
+  category = Column(Integer, ForeignKey('categories.id', onupdate='CASCADE',
+                                        ondelete='SET NULL'))
   difficulty = Column(Integer)
 
   def __init__(self, question, answer, category, difficulty):
@@ -58,6 +62,21 @@ class Question(db.Model):
       'difficulty': self.difficulty
     }
 
+'''
+QUESTION_COLUMNS, format_question_row(row)
+    the columns Question.format() reads, and format() of a row of them
+    list endpoints query these columns instead of Question, so no Question
+    object is built per listed question
+    EXAMPLE
+        [format_question_row(row) for row in
+         db.session.query(*QUESTION_COLUMNS).limit(10)]
+'''
+QUESTION_FIELDS = ('id', 'question', 'answer', 'category', 'difficulty')
+QUESTION_COLUMNS = tuple(getattr(Question, field) for field in QUESTION_FIELDS)
+
+def format_question_row(row):
+  return dict(zip(QUESTION_FIELDS, row))
+
 '''
 Category
 
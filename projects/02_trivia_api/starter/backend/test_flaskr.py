@@ -1,10 +1,117 @@
 import os
+import re
 import unittest
 import json
-from flask_sqlalchemy import SQLAlchemy
+import tempfile
+import threading
+import time
 
-from flaskr import create_app
-from models import setup_db, Question, Category
+from sqlalchemy import Integer, create_engine, event, text
+
+from flaskr import create_app, init_caches
+from migrations import migrate
+from models import db, Question, Category
+
+'''
+test database
+the app is created, the schema migrated and the fixtures (the rows of
+trivia.psql) inserted once per test process, then every test runs in a
+transaction rolled back at its end, with empty app caches, so the tests
+leave nothing behind and run in any order
+
+    by default the tests use a SQLite database in a temporary directory.
+    set TRIVIA_TEST_DATABASE to the url of a local PostgreSQL server
+    (e.g. postgresql://postgres@localhost:5432/postgres) to run them on a
+    database created for this process and dropped at the end instead.
+    each test process gets its own database, so parallel workers
+    (pytest -n 4) do not see each other
+'''
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'trivia.psql')
+server_url = os.environ.get('TRIVIA_TEST_DATABASE')
+test_database = 'trivia_test_{}'.format(os.getpid())
+database_url = None
+app = None
+
+
+def read_fixtures(path=FIXTURES):
+    """Read the rows of the COPY blocks of a database dump by table"""
+    tables, rows = {}, None
+    with open(path, encoding='utf-8') as dump:
+        for line in dump:
+            copy = re.match(r'COPY public\.(\w+) \((.*)\) FROM stdin;', line)
+            if copy:
+                table = db.metadata.tables[copy.group(1)]
+                columns = [table.c[name] for name in copy.group(2).split(', ')]
+                rows = tables[table] = []
+            elif line.startswith('\\.'):
+                rows = None
+            elif rows is not None:
+                rows.append({
+                    column.name: None if value == '\\N' else
+                    int(value) if isinstance(column.type, Integer) else value
+                    for column, value in zip(
+                        columns, line.rstrip('\n').split('\t'))})
+    return tables
+
+
+def setUpModule():
+    global database_url, app
+    if server_url is None:
+        database_url = 'sqlite:///' + os.path.join(tempfile.mkdtemp(),
+                                                   'trivia_test.db')
+    else:
+        database_url = server_url.rsplit('/', 1)[0] + '/' + test_database
+        with server_connection() as connection:
+            connection.execute(text('DROP DATABASE IF EXISTS ' +
+                                    test_database))
+            connection.execute(text('CREATE DATABASE ' + test_database))
+
+    config = {'SQLALCHEMY_DATABASE_URI': database_url}
+    if server_url is None:
+        # the connection of a test is shared by the requests it runs in
+        # threads
+        config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+            'connect_args': {'check_same_thread': False}}
+    app = create_app(config)
+    migrate(database_url, log=lambda message: None)
+    with app.app_context():
+        # categories first, the questions reference them
+        for table, rows in sorted(read_fixtures().items(),
+                                  key=lambda item: item[0] is not
+                                  Category.__table__):
+            db.session.execute(table.insert(), rows)
+        if db.engine.dialect.name == 'postgresql':
+            for table in ('categories', 'questions'):
+                db.session.execute(text(
+                    "SELECT setval(pg_get_serial_sequence('{0}', 'id'), "
+                    "(SELECT max(id) FROM {0}))".format(table)))
+        db.session.commit()
+        db.session.remove()
+        engine = db.get_engine()
+        engine.dispose()
+        if engine.dialect.name == 'sqlite':
+            # let SQLAlchemy emit BEGIN and SAVEPOINT, pysqlite would not
+            @event.listens_for(engine, 'connect')
+            def connect(dbapi_connection, connection_record):
+                dbapi_connection.isolation_level = None
+
+            @event.listens_for(engine, 'begin')
+            def begin(connection):
+                connection.exec_driver_sql('BEGIN')
+
+
+def tearDownModule():
+    with app.app_context():
+        db.get_engine().dispose()
+    if server_url is not None:
+        with server_connection() as connection:
+            connection.execute(text('DROP DATABASE IF EXISTS ' +
+                                    test_database))
+
+
+def server_connection():
+    return create_engine(server_url, isolation_level='AUTOCOMMIT').connect()
 
 
 class TriviaTestCase(unittest.TestCase):
@@ -12,11 +119,13 @@ class TriviaTestCase(unittest.TestCase):
 
     def setUp(self):
         """Define test variables and initialize app."""
-        self.app = create_app()
+        self.app = app
+        self.config = app.config.copy()
+        init_caches(app)
         self.client = self.app.test_client
-        self.database_name = "trivia_test"
-        self.database_path = "postgresql://{}/{}".format('postgres:123456@localhost:5432', self.database_name)
-        setup_db(self.app, self.database_path)
+        self.context = self.app.app_context()
+        self.context.push()
+        self.begin_test_transaction()
 
         self.new_question = {
             'question': 'New Question Test Case ?',
@@ -28,16 +137,31 @@ class TriviaTestCase(unittest.TestCase):
         self.invalid_new_question = {
             'question': 'New Question Test Case ?'
         }
-        # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
-    
+
+    def begin_test_transaction(self):
+        """Run the test in a transaction, and whatever the app commits or
+        rolls back in savepoints inside it"""
+        self.connection = db.get_engine().connect()
+        self.transaction = self.connection.begin()
+        self.savepoint = self.connection.begin_nested()
+        self.session = db.session
+        db.session = db.create_scoped_session({'bind': self.connection,
+                                               'binds': {}})
+
+        @event.listens_for(db.session, 'after_transaction_end')
+        def restart_savepoint(session, transaction):
+            if not self.savepoint.is_active:
+                self.savepoint = self.connection.begin_nested()
+
     def tearDown(self):
         """Executed after reach test"""
-        pass
+        db.session.remove()
+        db.session = self.session
+        self.transaction.rollback()
+        self.connection.close()
+        self.context.pop()
+        self.app.config.clear()
+        self.app.config.update(self.config)
 
     """
     TODO
@@ -53,6 +177,48 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(len(data['categories']))
         self.assertEqual(data['success'], True)
 
+    def test_categories_are_cached(self):
+        """Test categories are read from the database once per app"""
+        self.client().get('/categories')
+        self.client().get('/questions')
+        stats = self.app.extensions['category_cache'].stats()
+
+        # GET /questions reads them, and so does counting the questions
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 2)
+
+    def test_concurrent_cold_reads_query_once(self):
+        """Test concurrent requests on empty caches load them once"""
+        statements = []
+
+        def slow_first_load(conn, cursor, statement, parameters, context,
+                            executemany):
+            statements.append(statement)
+            if len(statements) == 1:
+                # the first request is still loading when the others arrive
+                time.sleep(0.2)
+
+        event.listen(self.connection, 'before_cursor_execute',
+                     slow_first_load)
+        responses = []
+        threads = [threading.Thread(
+            target=lambda path=path: responses.append(
+                (path, self.client().get(path))))
+            for path in ['/categories', '/stats'] * 3]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        event.remove(self.connection, 'before_cursor_execute',
+                     slow_first_load)
+
+        self.assertEqual([res.status_code for _, res in responses], [200] * 6)
+        self.assertEqual(len({(path, res.data) for path, res in responses}),
+                         2)
+        # the categories, and the question counts
+        self.assertEqual(len([statement for statement in statements
+                              if statement.startswith('SELECT')]), 2)
+
     def test_get_questions_per_page(self):
         """Test questions per page"""
         res = self.client().get('/questions')
@@ -66,6 +232,21 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(len(data['categories']))
         self.assertEqual(data['success'], True)
 
+    def test_get_questions_after_id(self):
+        """Test keyset pagination of questions"""
+        first_page = json.loads(self.client().get('/questions').data)
+        res = self.client().get(
+            '/questions?after_id=' + str(first_page['next_after_id']))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(len(data['questions']))
+        self.assertTrue(all(question['id'] > first_page['next_after_id']
+                            for question in data['questions']))
+        self.assertEqual(data['total_questions'],
+                         first_page['total_questions'])
+
     def test_get_questions_for_invalid_page(self):
         """Test questions per page"""
         res = self.client().get('/questions/page=300')
@@ -113,6 +294,64 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 400)
         self.assertEqual(data['success'], False)
 
+    def test_search_questions(self):
+        """Test searching questions by a substring of the question"""
+        res = self.client().post('/questions', json={'searchTerm': 'title'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['total_questions'])
+        self.assertTrue(all('title' in question['question'].lower()
+                            for question in data['questions']))
+
+    def test_search_questions_without_results(self):
+        """Test searching questions with a term nothing contains"""
+        res = self.client().post('/questions',
+                                 json={'searchTerm': 'xyzzyplugh'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total_questions'], 0)
+        self.assertEqual(data['questions'], [])
+
+    def test_search_follows_question_updates(self):
+        """Test the search index drops the words a question no longer uses"""
+        self.client().post('/questions', json={'searchTerm': 'penicillin'})
+        question = Question.query.filter(
+            Question.question.ilike('%penicillin%')).one()
+        question.question = 'Who discovered the antibiotic mold?'
+        question.update()
+
+        old = json.loads(self.client().post(
+            '/questions', json={'searchTerm': 'penicillin'}).data)
+        new = json.loads(self.client().post(
+            '/questions', json={'searchTerm': 'antibiotic'}).data)
+        partial = json.loads(self.client().post(
+            '/questions', json={'searchTerm': 'antibio'}).data)
+
+        self.assertEqual(old['total_questions'], 0)
+        self.assertEqual([q['id'] for q in new['questions']], [question.id])
+        self.assertEqual([q['id'] for q in partial['questions']],
+                         [question.id])
+
+    def test_get_stats(self):
+        """Test question counts, kept up to date by new questions"""
+        stats = json.loads(self.client().get('/stats').data)
+        self.client().post('/questions', json=self.new_question)
+        res = self.client().get('/stats')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(sum(data['difficulties'].values()),
+                         data['total_questions'])
+        self.assertEqual(data['total_questions'],
+                         stats['total_questions'] + 1)
+        self.assertEqual(data['categories']['1']['total_questions'],
+                         stats['categories']['1']['total_questions'] + 1)
+        self.assertEqual(json.loads(self.client().get(
+            '/questions').data)['total_questions'], data['total_questions'])
+
     def test_get_category_questions(self):
         """Test get category questions"""
         res = self.client().get('/categories/1/questions')
@@ -122,6 +361,10 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['questions'])
         self.assertTrue(data['total_questions'])
         self.assertTrue(data['current_category'])
+        self.assertTrue(all(question['category'] == 1
+                            for question in data['questions']))
+        self.assertEqual(data['questions'],
+                         sorted(data['questions'], key=lambda q: q['id']))
 
     def test_get_invalid_category_questions(self):
         """Test get category questions"""
@@ -133,6 +376,131 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['error'], 404)
         self.assertEqual(data['message'], 'Not found')
 
+    def test_play_quiz(self):
+        """Test quiz questions come from the category and are not repeated"""
+        category_ids = [question.id for question in Question.query.filter(
+            Question.category == 1).all()]
+        res = self.client().post('/quizzes', json={
+            'previous_questions': category_ids[1:],
+            'quiz_category': {'id': 1, 'type': 'Science'}})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['question']['id'], category_ids[0])
+
+    def test_play_quiz_without_questions_left(self):
+        """Test the quiz ends once every question was asked"""
+        all_ids = [question.id for question in Question.query.all()]
+        res = self.client().post('/quizzes', json={
+            'previous_questions': all_ids,
+            'quiz_category': {'id': 0, 'type': 'click'}})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['question'], None)
+
+    def test_question_ids_invalidated_while_loading(self):
+        """Test ids loaded across an invalidate() are not kept"""
+        picker = self.app.extensions['question_picker']
+
+        def invalidate(conn, cursor, statement, parameters, context,
+                       executemany):
+            if statement.startswith('SELECT questions.id'):
+                # another request commits a question meanwhile
+                picker.invalidate()
+
+        event.listen(self.connection, 'after_cursor_execute', invalidate)
+        ids = picker.ids(1)
+        event.remove(self.connection, 'after_cursor_execute', invalidate)
+        # not through the orm, so the picker is not invalidated again
+        db.session.execute(Question.__table__.insert(), {
+            'question': 'New?', 'answer': 'Yes', 'category': 1,
+            'difficulty': 1})
+        new_id = db.session.query(db.func.max(Question.id)).scalar()
+
+        self.assertNotIn(new_id, ids)
+        self.assertIn(new_id, picker.ids(1))
+
+    def test_play_quiz_session(self):
+        """Test a quiz session serves every question of the category once"""
+        category_ids = [question.id for question in Question.query.filter(
+            Question.category == 1).all()]
+        res = self.client().post('/quizzes/sessions', json={
+            'quiz_category': {'id': 1, 'type': 'Science'}})
+        data = json.loads(res.data)
+
+        served = []
+        for _ in category_ids:
+            turn = json.loads(self.client().post(
+                '/quizzes/sessions/' + data['session_id'] + '/next').data)
+            served.append(turn['question']['id'])
+        last = json.loads(self.client().post(
+            '/quizzes/sessions/' + data['session_id'] + '/next').data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total_questions'], len(category_ids))
+        self.assertEqual(sorted(served), sorted(category_ids))
+        self.assertEqual(last['question'], None)
+
+    def test_quiz_session_question_limit(self):
+        """Test a quiz session keeps at most QUIZ_SESSION_QUESTIONS ids"""
+        self.app.config['QUIZ_SESSION_QUESTIONS'] = 2
+        res = self.client().post('/quizzes/sessions', json={
+            'quiz_category': {'id': 0, 'type': 'click'}})
+        data = json.loads(res.data)
+
+        served = [json.loads(self.client().post(
+            '/quizzes/sessions/' + data['session_id'] + '/next').data)
+            for _ in range(3)]
+
+        self.assertEqual(data['total_questions'], 2)
+        self.assertEqual(len({turn['question']['id']
+                              for turn in served[:2]}), 2)
+        self.assertEqual(served[1]['remaining_questions'], 0)
+        self.assertEqual(served[2]['question'], None)
+
+    def test_quiz_session_bad_request(self):
+        """Test malformed quiz sessions are a 400, not a 500"""
+        for body in [{}, [], {'quiz_category': 1},
+                     {'quiz_category': [1]}, {'quiz_category': 'id'},
+                     {'quiz_category': {'id': [1]}},
+                     {'quiz_category': {'id': 1}, 'previous_questions': 5},
+                     {'quiz_category': {'id': 1},
+                      'previous_questions': [{'id': 1}]}]:
+            res = self.client().post('/quizzes/sessions', json=body)
+
+            self.assertEqual(res.status_code, 400, body)
+            self.assertEqual(json.loads(res.data)['success'], False)
+
+    def test_unknown_quiz_session(self):
+        """Test the next question of an unknown quiz session"""
+        res = self.client().post('/quizzes/sessions/unknown/next')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+
+    def test_import_questions(self):
+        """Test importing a csv question file, skipping the invalid rows"""
+        path = os.path.join(tempfile.mkdtemp(), 'questions.csv')
+        with open(path, 'w') as f:
+            f.write('question,answer,category,difficulty\n'
+                    'Imported Question One ?,Answer,science,2\n'
+                    'Imported Question Two ?,Answer,2,3\n'
+                    'Imported Question Three ?,Answer,Nowhere,1\n')
+        result = self.app.test_cli_runner().invoke(
+            args=['import-questions', path])
+
+        imported = Question.query.filter(
+            Question.question.like('Imported Question %')).all()
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("line 4: unknown category 'Nowhere'", result.output)
+        self.assertEqual(sorted((question.category, question.difficulty)
+                                for question in imported),
+                         [(1, 2), (2, 3)])
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
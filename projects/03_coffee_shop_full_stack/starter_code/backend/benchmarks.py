@@ -0,0 +1,379 @@
+'''
+Micro-benchmarks for the coffee shop backend
+
+run them from the backend directory:
+    python benchmarks.py                # every benchmark
+    python benchmarks.py permissions    # a single one
+'''
+import json
+import os
+import sys
+import tempfile
+import time
+import timeit
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+BENCHMARKS = {}
+
+
+def benchmark(f):
+    BENCHMARKS[f.__name__[len('bench_'):]] = f
+    return f
+
+
+def report(label, seconds, number):
+    print('  {:<40} {:>10.2f} us/op'.format(label, seconds / number * 1e6))
+
+
+def report_ms(label, seconds, number):
+    print('  {:<40} {:>10.2f} ms/op'.format(label, seconds / number * 1e3))
+
+
+def report_throughput(label, seconds, number, unit='req/s'):
+    print('  {:<40} {:>10.0f} {}'.format(label, number / seconds, unit))
+
+
+'''
+use_local_signing_key()
+    verifies tokens against a key generated here instead of the Auth0
+    tenant, it has to run before the app is imported
+    returns a function making a token with the given permissions
+'''
+def use_local_signing_key():
+    import rsa
+    from jose import jwk, jwt
+
+    _, private_key = rsa.newkeys(1024)
+    pem = private_key.save_pkcs1().decode()
+    public_jwk = jwk.construct(pem, 'RS256').public_key().to_dict()
+    public_jwk.update({'kid': 'benchmark-key', 'use': 'sig'})
+    os.environ['AUTH0_JWKS_FILE'] = os.path.join(tempfile.mkdtemp(),
+                                                 'jwks.json')
+    with open(os.environ['AUTH0_JWKS_FILE'], 'w') as jwks_file:
+        json.dump({'keys': [public_jwk]}, jwks_file)
+
+    def make_token(permissions):
+        from src.auth.auth import AUTH0_DOMAIN, API_AUDIENCE
+        return jwt.encode({
+            'iss': 'https://' + AUTH0_DOMAIN + '/',
+            'aud': API_AUDIENCE,
+            'sub': 'auth0|benchmark',
+            'exp': int(time.time()) + 3600,
+            'permissions': permissions
+        }, pem, algorithm='RS256', headers={'kid': 'benchmark-key'})
+    return make_token
+
+
+'''
+run_concurrently(request, threads, number)
+    calls request(client) number times from a pool of threads, each thread
+    with its own test client, returns the elapsed seconds
+'''
+def run_concurrently(app, request, threads, number):
+    clients = [app.test_client() for _ in range(threads)]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        list(pool.map(lambda i: request(clients[i % threads]), range(number)))
+    return time.perf_counter() - started
+
+
+'''
+temporary_app()
+    the api app bound to a throwaway sqlite database instead of database.db
+'''
+@contextmanager
+def temporary_app():
+    from src.api import app
+    from src.database.models import db
+
+    directory = tempfile.mkdtemp()
+    original_uri = app.config['SQLALCHEMY_DATABASE_URI']
+    app.config['SQLALCHEMY_DATABASE_URI'] = \
+        'sqlite:///' + os.path.join(directory, 'benchmark.db')
+    try:
+        with app.app_context():
+            db.create_all()
+            yield app
+            db.session.remove()
+            db.drop_all()
+    finally:
+        app.config['SQLALCHEMY_DATABASE_URI'] = original_uri
+
+
+def make_recipe(i):
+    return [{'name': 'ingredient %d' % n, 'color': '#%06x' % (i * 7 + n),
+             'parts': n + 1} for n in range(3)]
+
+
+def seed_drinks(count):
+    from src.database.models import db, Drink, Ingredient, parse_recipe
+
+    db.session.execute(Drink.__table__.insert(), [
+        {'id': i + 1, 'title': 'drink %d' % i} for i in range(count)])
+    db.session.execute(Ingredient.__table__.insert(), [
+        dict(ingredient, drink_id=i + 1, position=position)
+        for i in range(count)
+        for position, ingredient in enumerate(parse_recipe(make_recipe(i)))])
+    db.session.commit()
+
+
+'''
+permissions
+    check_permissions against a role-heavy token (hundreds of scopes),
+    scanning the claim list versus the precompiled Permissions frozenset
+'''
+@benchmark
+def bench_permissions(scopes=500, number=100000):
+    from src.auth.auth import ALL, ANY, Permissions, \
+        required_permissions
+
+    payload = {'permissions': ['scope:%d' % i for i in range(scopes)]}
+    missing = 'scope:missing'
+    last = 'scope:%d' % (scopes - 1)
+    several = ['scope:%d' % i for i in range(scopes - 5, scopes)]
+
+    print('permissions ({} scopes, {} checks)'.format(scopes, number))
+    report('list scan, last scope',
+           timeit.timeit(lambda: last in payload['permissions'],
+                         number=number), number)
+    report('list scan, missing scope',
+           timeit.timeit(lambda: missing in payload['permissions'],
+                         number=number), number)
+    report('list scan, 5 scopes all()',
+           timeit.timeit(
+               lambda: all(p in payload['permissions'] for p in several),
+               number=number), number)
+
+    granted = Permissions.from_payload(payload)
+    required = required_permissions(several)
+    report('compile Permissions (once per token)',
+           timeit.timeit(lambda: Permissions.from_payload(payload),
+                         number=number // 10), number // 10)
+    report('frozenset, last scope',
+           timeit.timeit(lambda: last in granted, number=number), number)
+    report('frozenset, missing scope',
+           timeit.timeit(lambda: missing in granted, number=number), number)
+    report('frozenset, 5 scopes ALL',
+           timeit.timeit(lambda: granted.allows(required, ALL),
+                         number=number), number)
+    report('frozenset, 5 scopes ANY',
+           timeit.timeit(lambda: granted.allows(required, ANY),
+                         number=number), number)
+
+
+'''
+drinks_menu
+    GET /drinks and GET /drinks-detail bodies over a few thousand drinks,
+    building every representation and encoding it with jsonify per request
+    versus the cached, pre-encoded representations
+'''
+@benchmark
+def bench_drinks_menu(drinks=3000, number=30):
+    from flask import jsonify
+    from sqlalchemy.orm import selectinload
+    from src.api import drinks_body
+    from src.database.models import Drink, representation_cache
+
+    with temporary_app():
+        seed_drinks(drinks)
+        print('drinks_menu ({} drinks, {} requests)'.format(drinks, number))
+
+        def uncached_short():
+            all_drinks = Drink.query.options(
+                selectinload(Drink.ingredients)).order_by(Drink.id).all()
+            return jsonify({'success': True, 'drinks': [
+                {'id': d.id, 'title': d.title,
+                 'recipe': [{'color': r['color'], 'parts': r['parts']}
+                            for r in d.recipe]}
+                for d in all_drinks]}).get_data()
+
+        def uncached_long():
+            all_drinks = Drink.query.options(
+                selectinload(Drink.ingredients)).order_by(Drink.id).all()
+            return jsonify({'success': True, 'drinks': [
+                {'id': d.id, 'title': d.title, 'recipe': d.recipe}
+                for d in all_drinks]}).get_data()
+
+        def cached(form):
+            return drinks_body(getattr(d, form) for d in Drink.menu())
+
+        report_ms('build + jsonify, short',
+                  timeit.timeit(uncached_short, number=number), number)
+        report_ms('build + jsonify, long',
+                  timeit.timeit(uncached_long, number=number), number)
+        representation_cache.clear()
+        report_ms('cold representation cache, short',
+                  timeit.timeit(lambda: cached('short_json'), number=1),
+                  1)
+        report_ms('warm representation cache, short',
+                  timeit.timeit(lambda: cached('short_json'),
+                                number=number), number)
+        report_ms('warm representation cache, long',
+                  timeit.timeit(lambda: cached('long_json'),
+                                number=number), number)
+        representation_cache.clear()
+
+
+'''
+menu_concurrency
+    GET /drinks under concurrent load: rebuilding the body on every request,
+    serving the cached body, and revalidating with If-None-Match (304)
+'''
+@benchmark
+def bench_menu_concurrency(drinks=1000, threads=8, number=400):
+    from src.api import app, response_cache
+    from src.database.models import representation_cache
+
+    with temporary_app():
+        seed_drinks(drinks)
+        print('menu_concurrency ({} drinks, {} threads, {} requests)'.format(
+            drinks, threads, number))
+
+        def uncached(client):
+            response_cache.clear()
+            return client.get('/drinks')
+
+        report_throughput('body rebuilt every request', run_concurrently(
+            app, uncached, threads, number), number)
+
+        etag = app.test_client().get('/drinks').headers['ETag']
+        report_throughput('cached body, 200', run_concurrently(
+            app, lambda client: client.get('/drinks'), threads, number),
+            number)
+        report_throughput('If-None-Match, 304', run_concurrently(
+            app, lambda client: client.get(
+                '/drinks', headers={'If-None-Match': etag}),
+            threads, number), number)
+        response_cache.clear()
+        representation_cache.clear()
+
+
+'''
+sqlite_profile
+    reader and writer processes (like the workers of a server) hitting the
+    same database: readers list pages of the menu while writers add drinks,
+    each operation in its own session like a request, with the sqlite
+    defaults versus SQLITE_PROFILE (wal) and the connection pool
+'''
+@benchmark
+def bench_sqlite_profile(drinks=5000, readers=6, writers=2, seconds=3):
+    import multiprocessing
+    from sqlalchemy import exc
+    from src.api import app
+    from src.database.models import db, Drink, load_recipes
+
+    print('sqlite_profile ({} drinks, {} reader and {} writer processes, '
+          '{}s)'.format(drinks, readers, writers, seconds))
+
+    def read(name, i):
+        rows = db.session.query(Drink.id, Drink.title).filter(
+            Drink.id > (i * 97) % drinks).order_by(Drink.id).limit(20).all()
+        load_recipes([row.id for row in rows])
+
+    def write(name, i):
+        Drink(title='new drink {}-{}'.format(name, i),
+              recipe=make_recipe(i)).insert()
+
+    def worker(operation, name, deadline, results):
+        ops = errors = 0
+        latencies = []
+        with app.app_context():
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                try:
+                    operation(name, ops + errors)
+                    ops += 1
+                except exc.OperationalError:
+                    errors += 1
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+                latencies.append(time.perf_counter() - started)
+        results.put((operation.__name__, ops, errors, max(latencies)))
+
+    context = multiprocessing.get_context('fork')
+    original_profile = app.config.get('SQLITE_PROFILE', {})
+    for label, profile in [('sqlite defaults', None),
+                           ('SQLITE_PROFILE', original_profile)]:
+        app.config['SQLITE_PROFILE'] = profile
+        with temporary_app():
+            seed_drinks(drinks)
+            db.session.remove()
+            # every process opens its own connections
+            db.engine.dispose()
+            results = context.Queue()
+            deadline = time.perf_counter() + seconds
+            processes = [context.Process(target=worker, args=(
+                read, n, deadline, results)) for n in range(readers)]
+            processes += [context.Process(target=worker, args=(
+                write, n, deadline, results)) for n in range(writers)]
+            for process in processes:
+                process.start()
+            totals = {'read': [0, 0, 0], 'write': [0, 0, 0]}
+            for _ in processes:
+                name, ops, errors, worst = results.get()
+                totals[name][0] += ops
+                totals[name][1] += errors
+                totals[name][2] = max(totals[name][2], worst)
+            for process in processes:
+                process.join()
+            for name in ['read', 'write']:
+                ops, errors, worst = totals[name]
+                report_throughput('{}, {}s'.format(label, name), seconds,
+                                  ops, 'ops/s')
+                print('  {:<40} {:>10.1f} ms, {} locked errors'.format(
+                    '{}, slowest {}'.format(label, name), worst * 1e3,
+                    errors))
+    app.config['SQLITE_PROFILE'] = original_profile
+
+
+'''
+bulk_import
+    importing drinks with one POST /drinks per drink versus a single
+    streamed POST /drinks/bulk (json array and ndjson), then streaming them
+    back with GET /drinks/export
+'''
+@benchmark
+def bench_bulk_import(drinks=100000, single=1000):
+    from src.api import app
+    from src.database.models import Drink
+
+    headers = {'Authorization': 'Bearer ' + make_token(
+        ['post:drinks', 'get:drinks-detail'])}
+    drink_list = [{'title': 'drink %d' % i, 'recipe': make_recipe(i)}
+                  for i in range(drinks)]
+    print('bulk_import ({} drinks, {} single posts)'.format(drinks, single))
+
+    with temporary_app():
+        client = app.test_client()
+        started = time.perf_counter()
+        for drink in drink_list[:single]:
+            client.post('/drinks', headers=headers, json=drink)
+        report_throughput('POST /drinks, one per drink',
+                          time.perf_counter() - started, single, 'drinks/s')
+
+    for label, body in [
+            ('POST /drinks/bulk, json array', json.dumps(drink_list)),
+            ('POST /drinks/bulk, ndjson',
+             '\n'.join(json.dumps(drink) for drink in drink_list))]:
+        with temporary_app():
+            client = app.test_client()
+            started = time.perf_counter()
+            res = client.post('/drinks/bulk', headers=headers, data=body)
+            elapsed = time.perf_counter() - started
+            assert res.get_json()['imported'] == drinks, res.get_json()
+            report_throughput(label, elapsed, drinks, 'drinks/s')
+
+            started = time.perf_counter()
+            lines = sum(1 for _ in client.get(
+                '/drinks/export', headers=headers).response)
+            report_throughput('GET /drinks/export',
+                              time.perf_counter() - started, lines, 'drinks/s')
+
+
+if __name__ == '__main__':
+    make_token = use_local_signing_key()
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
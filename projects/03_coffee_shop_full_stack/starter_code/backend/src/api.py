@@ -1,17 +1,25 @@
+import hashlib
 import os
-from flask import Flask, request, jsonify, abort
+from flask import Flask, request, jsonify, abort, stream_with_context
 from sqlalchemy import exc
-import json
 from flask_cors import CORS
 from jose import jwt
 
-from .database.models import db_drop_and_create_all, setup_db, Drink
-from .auth.auth import AuthError, requires_auth
+from .database.models import db, db_drop_and_create_all, setup_db, Drink, \
+    VersionConflict, menu_version
+from .database.bulk import BulkImport
+from .database.migrate import pending_migrations
+from .auth.auth import AuthError, auth0, requires_auth
+from .json_stream import iter_json_items
+from .response_cache import ResponseCache
 
 app = Flask(__name__)
 setup_db(app)
 CORS(app)
 
+# load the Auth0 signing keys now rather than on the first request
+auth0.prefetch()
+
 '''
 @TODO uncomment the following line to initialize the datbase
 !! NOTE THIS WILL DROP ALL RECORDS AND START YOUR DB FROM SCRATCH
@@ -19,24 +27,120 @@ CORS(app)
 '''
 #db_drop_and_create_all()
 
+'''
+check_database_schema()
+    while the database still has the schema of an older version every
+    request gets a 500 naming the migration to run, see README "Upgrading an
+    existing database". checked once per database
+'''
+_current_schemas = set()
+
+@app.before_request
+def check_database_schema():
+    uri = app.config['SQLALCHEMY_DATABASE_URI']
+    if uri in _current_schemas:
+        return None
+    with db.engine.connect() as connection:
+        pending = pending_migrations(connection)
+    if pending:
+        message = 'the database schema is outdated ({}), run ' \
+            'python -m src.database.migrate'.format(', '.join(pending))
+        app.logger.error(message)
+        return jsonify({
+            "success": False,
+            "error": 500,
+            "message": message
+        }), 500
+    _current_schemas.add(uri)
+    return None
+
+'''
+drinks_body(encoded_drinks)
+    builds the {"success": True, "drinks": drinks} response body out of
+    drinks already encoded, see DrinkRepresentation
+'''
+def drinks_body(encoded_drinks):
+    return b'{"drinks":[' + b','.join(encoded_drinks) + b'],"success":true}'
+
+response_cache = ResponseCache()
+
+'''
+menu_response(name, form, private)
+    serves the whole drink menu from a pre-encoded body cached per menu
+    version, with a strong etag derived from that version
+        name: the cache key and etag prefix of the representation
+        form: 'short_json' or 'long_json', the DrinkRepresentation field
+        private: True for representations that need authorization
+        ingredient: only list the drinks using this ingredient
+    a request whose If-None-Match carries the current etag gets a 304 without
+    the database being queried, the body is rebuilt after a menu change
+'''
+def menu_response(name, form, private=False, ingredient=None):
+    version = menu_version().current()
+    etag = '{}-{}'.format(name, version)
+    if ingredient is not None:
+        etag += '-' + hashlib.sha1(ingredient.encode()).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    elif ingredient is not None:
+        # filtered menus are not cached, there is one per ingredient name
+        drinks = Drink.menu(Drink.with_ingredient(ingredient))
+        response = app.response_class(
+            drinks_body(getattr(drink, form) for drink in drinks),
+            mimetype='application/json')
+    else:
+        body = response_cache.get(name, version, lambda: drinks_body(
+            getattr(drink, form) for drink in Drink.menu()))
+        response = app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    response.cache_control.private = private or None
+    return response
+
+'''
+drink_response(drink)
+    the {"success": True, "drinks": [drink.long()]} response of a single
+    drink, with an etag naming the version of the drink, the If-Match value
+    of its next PATCH
+'''
+def drink_response(drink):
+    response = jsonify({
+        'success': True,
+        'drinks': [drink.long()]
+    })
+    response.set_etag(drink_etag(drink.id, drink.version))
+    return response
+
+def drink_etag(drink_id, version):
+    return 'drink-{}-{}'.format(drink_id, version)
+
+'''
+if_match_versions(drink_id)
+    the drink versions accepted by the If-Match header of the request,
+    None when any version is (If-Match: *, or no If-Match header at all)
+'''
+def if_match_versions(drink_id):
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    prefix = 'drink-{}-'.format(drink_id)
+    return [int(etag[len(prefix):]) for etag in request.if_match.as_set()
+            if etag.startswith(prefix) and etag[len(prefix):].isdigit()]
+
 ## ROUTES
 '''
 @TODO implement endpoint
     GET /drinks
         it should be a public endpoint
         it should contain only the drink.short() data representation
+        ?ingredient=<name> only lists the drinks using that ingredient
     returns status code 200 and json {"success": True, "drinks": drinks} where drinks is the list of drinks
         or appropriate status code indicating reason for failure
 '''
 
 @app.route('/drinks', methods=['GET'])
 def get_drinks():
-    all_drinks = Drink.query.order_by(Drink.id).all()
-    formatted_drinks = [Drink.short() for Drink in all_drinks]
-    return jsonify({
-        'success': True,
-        'drinks': formatted_drinks
-    })
+    return menu_response('drinks', 'short_json',
+                         ingredient=request.args.get('ingredient'))
 
 
 '''
@@ -50,12 +154,7 @@ def get_drinks():
 @app.route('/drinks-detail', methods=['GET'])
 @requires_auth('get:drinks-detail')
 def get_drinks_detail(jwt):
-    all_drinks = Drink.query.order_by(Drink.id).all()
-    formatted_drinks_details = [Drink.long() for Drink in all_drinks]
-    return jsonify({
-        'success': True,
-        'drinks': formatted_drinks_details
-    })
+    return menu_response('drinks-detail', 'long_json', private=True)
 
 '''
 @TODO implement endpoint
@@ -72,23 +171,87 @@ def add_drinks(jwt):
     body = request.get_json()
     new_drink_title = body.get('title', None)
     new_drink_recipe = body.get('recipe', None)
-    print(new_drink_recipe)
 
     if not new_drink_title or not new_drink_recipe:
         abort(400)
     try:
-        drink = Drink(title=new_drink_title, recipe=json.dumps(new_drink_recipe))
+        drink = Drink(title=new_drink_title, recipe=new_drink_recipe)
         drink.insert()
 
-        return jsonify({
-            'success': True,
-            'drinks': [drink.long()]
-        })
+        return drink_response(drink)
 
     except BaseException:
         abort(422)
 
 
+'''
+POST /drinks/bulk
+    imports many drinks in one request, it requires the 'post:drinks'
+    permission
+    the body is a json array of drinks or one drink per line (ndjson), each
+    drink as for POST /drinks. it is read as a stream and inserted in
+    batched transactions
+    returns status code 200 and json {"success": True, "imported": count,
+    "rejected": count, "errors": [{"index": index, "message": message}]}
+    listing the first 100 drinks that were skipped, or status code 400 when
+    the body is not valid json, the drinks read before the error are still
+    imported
+'''
+@app.route('/drinks/bulk', methods=['POST'])
+@requires_auth('post:drinks')
+def import_drinks(jwt):
+    importer = BulkImport().run(iter_json_items(request.stream))
+    if importer.malformed:
+        return jsonify({
+            'success': False,
+            'error': 400,
+            'message': 'bad request',
+            'imported': importer.imported,
+            'rejected': importer.rejected,
+            'errors': importer.errors
+        }), 400
+
+    return jsonify({
+        'success': True,
+        'imported': importer.imported,
+        'rejected': importer.rejected,
+        'errors': importer.errors
+    })
+
+'''
+GET /drinks/export
+    streams every drink in the drink.long() data representation, one json
+    object per line (ndjson), it requires the 'get:drinks-detail' permission
+    the drinks are read one page at a time while the response is sent
+'''
+@app.route('/drinks/export', methods=['GET'])
+@requires_auth('get:drinks-detail')
+def export_drinks(jwt):
+    def generate():
+        for drink in Drink.iter_menu():
+            yield drink.long_json + b'\n'
+
+    return app.response_class(stream_with_context(generate()),
+                              mimetype='application/x-ndjson')
+
+
+'''
+GET /drinks/<id>
+    where <id> is the existing model id
+    it requires the 'get:drinks-detail' permission
+    returns status code 200 and json {"success": True, "drinks": drink} where
+    drink an array containing only the drink.long() data representation, with
+    the etag of its version, or status code 404 if <id> is not found
+'''
+@app.route('/drinks/<int:id>', methods=['GET'])
+@requires_auth('get:drinks-detail')
+def get_drink(jwt, id):
+    drink = Drink.query.filter(Drink.id == id).one_or_none()
+    if drink is None:
+        abort(404)
+    return drink_response(drink)
+
+
 '''
 @TODO implement endpoint
     PATCH /drinks/<id>
@@ -97,37 +260,37 @@ def add_drinks(jwt):
         it should update the corresponding row for <id>
         it should require the 'patch:drinks' permission
         it should contain the drink.long() data representation
+        an If-Match header with the etag of the drink version the update
+        applies to makes it conditional, a 412 when the drink was changed
     returns status code 200 and json {"success": True, "drinks": drink} where drink an array containing only the updated drink
         or appropriate status code indicating reason for failure
 '''
-@app.route('/drinks/<id>', methods=['PATCH'])
+@app.route('/drinks/<int:id>', methods=['PATCH'])
 @requires_auth('patch:drinks')
 def update_drinks(jwt,id):
-    drink = Drink.query.filter(Drink.id == id).one_or_none()
-    if drink is None:
-        abort(404)
     body = request.get_json()
     updated_drink_title = body.get('title', None)
     updated_drink_recipe = body.get('recipe', None)
 
     if updated_drink_title is None and updated_drink_recipe is None:
         abort(400)
-    
-    try:
-        if not updated_drink_title is None:
-            drink.title = updated_drink_title
-        if not updated_drink_recipe is None:
-            drink.recipe = json.dumps(updated_drink_recipe)
-        drink.update()
-
-        return jsonify({
-            'success': True,
-            'drinks': [drink.long()]
-        })
 
+    # one conditional UPDATE, a client sending If-Match with the etag of the
+    # drink it read gets a 412 instead of overwriting a concurrent edit
+    versions = if_match_versions(id)
+    try:
+        drink = Drink.update_if_version(id, versions,
+                                        title=updated_drink_title,
+                                        recipe=updated_drink_recipe)
+    except VersionConflict:
+        abort(412)
     except BaseException:
         abort(422)
 
+    if drink is None:
+        abort(404)
+    return drink_response(drink)
+
 '''
 @TODO implement endpoint
     DELETE /drinks/<id>
@@ -138,7 +301,7 @@ def update_drinks(jwt,id):
     returns status code 200 and json {"success": True, "delete": id} where id is the id of the deleted record
         or appropriate status code indicating reason for failure
 '''
-@app.route('/drinks/<id>', methods=['DELETE'])
+@app.route('/drinks/<int:id>', methods=['DELETE'])
 @requires_auth('delete:drinks')
 def delete_drinks(jwt,id):
 
@@ -194,6 +357,14 @@ def not_found(error):
         "message": "resource not found"
     }), 404
 
+@app.errorhandler(412)
+def precondition_failed(error):
+    return jsonify({
+        "success": False,
+        "error": 412,
+        "message": "precondition failed, the drink was changed"
+    }), 412
+
 @app.errorhandler(400)
 def unprocessable(error):
     return jsonify({
@@ -1,171 +1,55 @@
-import json
-from flask import request, _request_ctx_stack
-from functools import wraps
-from jose import jwt
-from urllib.request import urlopen
-from flask import abort
+import os
+
+# the token verification is shared with BasicFlaskAuth, see /fsnd_auth at
+# the root of the repository (installed by requirements.txt)
+from fsnd_auth import (ALL, ANY, Auth0, AuthError, Permissions,
+                       check_permissions, get_token_auth_header,
+                       required_permissions)
 
 AUTH0_DOMAIN = 'iazer.us.auth0.com'
 ALGORITHMS = ['RS256']
 API_AUDIENCE = 'coffeeShop'
 
-## AuthError Exception
-'''
-AuthError Exception
-A standardized way to communicate auth failure modes
-'''
-class AuthError(Exception):
-    def __init__(self, error, status_code):
-        self.error = error
-        self.status_code = status_code
-
-
-## Auth Header
-
-'''
-@TODO implement get_token_auth_header() method
-    it should attempt to get the header from the request
-        it should raise an AuthError if no header is present
-    it should attempt to split bearer and the token
-        it should raise an AuthError if the header is malformed
-    return the token part of the header
-'''
-def get_token_auth_header():
-    auth = request.headers.get("Authorization", None)
-    if not auth:
-        raise AuthError({"code": "authorization_header_missing",
-                        "description":
-                            "Authorization header is expected"}, 401)
-
-    parts = auth.split()
-
-    if parts[0].lower() != "bearer":
-        raise AuthError({"code": "invalid_header",
-                        "description":
-                            "Authorization header must start with"
-                            " Bearer"}, 401)
-    elif len(parts) == 1:
-        raise AuthError({"code": "invalid_header",
-                        "description": "Token not found"}, 401)
-    elif len(parts) > 2:
-        raise AuthError({"code": "invalid_header",
-                        "description":
-                            "Authorization header must be"
-                            " Bearer token"}, 401)
-
-    token = parts[1]
-    return token
-
-'''
-@TODO implement check_permissions(permission, payload) method
-    @INPUTS
-        permission: string permission (i.e. 'post:drink')
-        payload: decoded jwt payload
-
-    it should raise an AuthError if permissions are not included in the payload
-        !!NOTE check your RBAC settings in Auth0
-    it should raise an AuthError if the requested permission string is not in the payload permissions array
-    return true otherwise
-'''
-def check_permissions(permission, payload):
-    if 'permissions' not in payload:
-                        raise AuthError({
-                            'code': 'invalid_claims',
-                            'description': 'Permissions not included in JWT.'
-                        }, 400)
-
-    if permission not in payload['permissions']:
-        raise AuthError({
-            'code': 'unauthorized',
-            'description': 'Permission not found.'
-        }, 403)
-    return True
-
-'''
-@TODO implement verify_decode_jwt(token) method
-    @INPUTS
-        token: a json web token (string)
-
-    it should be an Auth0 token with key id (kid)
-    it should verify the token using Auth0 /.well-known/jwks.json
-    it should decode the payload from the token
-    it should validate the claims
-    return the decoded payload
-
-    !!NOTE urlopen has a common certificate error described here: https://stackoverflow.com/questions/50236117/scraping-ssl-certificate-verify-failed-error-for-http-en-wikipedia-org
-'''
-def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
-    unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
-    if 'kid' not in unverified_header:
-        raise AuthError({
-            'code': 'invalid_header',
-            'description': 'Authorization malformed.'
-        }, 401)
-
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
-    if rsa_key:
-        try:
-            
-            payload = jwt.decode(
-                token,
-                rsa_key,
-                algorithms=ALGORITHMS,
-                audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
-            )
-
-            return payload
-
-        except jwt.ExpiredSignatureError:
-            raise AuthError({
-                'code': 'token_expired',
-                'description': 'Token expired.'
-            }, 401)
-
-        except jwt.JWTClaimsError:
-            raise AuthError({
-                'code': 'invalid_claims',
-                'description': 'Incorrect claims. Please, check the audience and issuer.'
-            }, 401)
-        except Exception:
-            raise AuthError({
-                'code': 'invalid_header',
-                'description': 'Unable to parse authentication token.'
-            }, 400)
-    raise AuthError({
-                'code': 'invalid_header',
-                'description': 'Unable to find the appropriate key.'
-            }, 400)
-
-'''
-@TODO implement @requires_auth(permission) decorator method
-    @INPUTS
-        permission: string permission (i.e. 'post:drink')
-
-    it should use the get_token_auth_header method to get the token
-    it should use the verify_decode_jwt method to decode the jwt
-    it should use the check_permissions method validate claims and check the requested permission
-    return the decorator which passes the decoded payload to the decorated method
-'''
-def requires_auth(permission=''):
-    def requires_auth_decorator(f):
-        @wraps(f)
-        def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
-            return f(payload, *args, **kwargs)
-
-        return wrapper
-    return requires_auth_decorator
\ No newline at end of file
+## JWKS key cache
+'''
+the signing keys are fetched once and kept in memory instead of calling
+/.well-known/jwks.json on every request
+    JWKS_FILE: path to a local copy of the tenant jwks.json, when set the
+        keys are read from it and no outbound call is made (offline mode)
+    JWKS_CACHE_TTL: seconds before the keys are revalidated in the background
+    JWKS_MIN_REFRESH_INTERVAL: minimum seconds between refetches forced by
+        tokens carrying an unknown kid
+'''
+JWKS_FILE = os.environ.get('AUTH0_JWKS_FILE')
+JWKS_CACHE_TTL = 600
+JWKS_MIN_REFRESH_INTERVAL = 30
+
+## Verified token cache
+'''
+decoded payloads of already verified tokens, keyed by the token digest
+    TOKEN_CACHE_SIZE: maximum number of tokens kept, least recently used
+        tokens are evicted first, 0 verifies every request from scratch
+    TOKEN_CACHE_MAX_TTL: upper bound in seconds on how long a payload is
+        reused, entries never outlive the token exp claim
+'''
+TOKEN_CACHE_SIZE = 1024
+TOKEN_CACHE_MAX_TTL = 300
+
+auth0 = Auth0(AUTH0_DOMAIN, API_AUDIENCE,
+              algorithms=ALGORITHMS,
+              jwks_file=JWKS_FILE,
+              jwks_ttl=JWKS_CACHE_TTL,
+              jwks_min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL,
+              token_cache_size=TOKEN_CACHE_SIZE,
+              token_cache_max_ttl=TOKEN_CACHE_MAX_TTL)
+
+'''
+verify_decode_jwt(token)
+    verifies token against the coffee shop API and returns its payload
+requires_auth(*permissions, match=ALL)
+    EXAMPLE
+        @requires_auth('get:drinks-detail')
+        @requires_auth('patch:drinks', 'delete:drinks', match=ANY)
+'''
+verify_decode_jwt = auth0.verify_decode_jwt
+requires_auth = auth0.requires_auth
@@ -0,0 +1,131 @@
+from operator import itemgetter
+
+from sqlalchemy import exc
+
+from ..json_stream import JSONStreamError
+from .models import db, Drink, Ingredient, menu_version, parse_recipe
+
+BATCH_SIZE = 1000
+MAX_REPORTED_ERRORS = 100
+
+'''
+validate_drink(item)
+    returns (title, recipe) for a drink of a bulk import, the recipe parsed
+    with parse_recipe
+    raises ValueError when the item is not a valid drink
+'''
+def validate_drink(item):
+    if isinstance(item, ValueError):
+        raise item
+    if not isinstance(item, dict):
+        raise ValueError('drink must be an object')
+    title = item.get('title')
+    if not isinstance(title, str) or not title.strip():
+        raise ValueError('drink needs a title')
+    if len(title) > Drink.title.type.length:
+        raise ValueError('title is too long')
+    return title, parse_recipe(item.get('recipe'))
+
+'''
+BulkImport
+imports drinks in batches, one transaction and two executemany statements
+per batch instead of a commit per drink
+
+    items that are not valid drinks or whose title is already taken are
+    skipped and counted in rejected, the other drinks are imported. errors
+    lists the MAX_REPORTED_ERRORS first of them by index. titles are checked
+    against the database batch by batch, so memory use does not grow with
+    the request. a malformed stream stops the import after the drinks read
+    so far and sets malformed
+    EXAMPLE
+        result = BulkImport().run(iter_json_items(request.stream))
+        result.imported, result.rejected, result.errors
+'''
+class BulkImport:
+    def __init__(self, batch_size=BATCH_SIZE):
+        self.batch_size = batch_size
+        self.imported = 0
+        self.rejected = 0
+        self.errors = []
+        self.malformed = False
+        self._batch = {}
+
+    def run(self, items):
+        try:
+            for index, item in enumerate(items):
+                self.add(index, item)
+        except JSONStreamError as error:
+            self.malformed = True
+            self.error(error.index, str(error))
+        self.flush()
+        self._trim_errors()
+        return self
+
+    def add(self, index, item):
+        try:
+            title, recipe = validate_drink(item)
+        except ValueError as error:
+            self.error(index, str(error))
+            return
+        if title in self._batch:
+            self.error(index, 'duplicate title')
+            return
+        self._batch[title] = (index, title, recipe)
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def error(self, index, message):
+        self.rejected += 1
+        self.errors.append({'index': index, 'message': message})
+        # errors are reported out of order, keep the first ones by index
+        if len(self.errors) >= 2 * MAX_REPORTED_ERRORS:
+            self._trim_errors()
+
+    def _trim_errors(self):
+        self.errors.sort(key=itemgetter('index'))
+        del self.errors[MAX_REPORTED_ERRORS:]
+
+    '''
+    flush()
+        inserts the pending batch in one transaction and bumps the menu
+        version once
+    '''
+    def flush(self):
+        batch, self._batch = list(self._batch.values()), {}
+        if not batch:
+            return
+        existing = {title for title, in db.session.query(Drink.title).filter(
+            Drink.title.in_([title for _, title, _ in batch]))}
+        for index, title, _ in batch:
+            if title in existing:
+                self.error(index, 'title already exists')
+        batch = [drink for drink in batch if drink[1] not in existing]
+        if not batch:
+            return
+
+        try:
+            self._insert(batch)
+        except exc.IntegrityError:
+            # a concurrent writer took one of the titles, insert the batch
+            # drink by drink to report which one
+            db.session.rollback()
+            for drink in batch:
+                try:
+                    self._insert([drink])
+                except exc.IntegrityError:
+                    db.session.rollback()
+                    self.error(drink[0], 'title already exists')
+        menu_version().bump()
+
+    def _insert(self, batch):
+        db.session.execute(Drink.__table__.insert(),
+                           [{'title': title} for _, title, _ in batch])
+        # titles are unique, read the generated ids back by title
+        ids = dict(db.session.query(Drink.title, Drink.id).filter(
+            Drink.title.in_([title for _, title, _ in batch])))
+        db.session.execute(Ingredient.__table__.insert(), [
+            dict(ingredient, drink_id=ids[title], position=position)
+            for _, title, recipe in batch
+            for position, ingredient in enumerate(recipe)])
+        db.session.commit()
+        self.imported += len(batch)
@@ -0,0 +1,86 @@
+import os
+import threading
+import uuid
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - windows
+    fcntl = None
+
+'''
+MenuVersion
+a menu version counter shared by every process using the same database
+
+    the counter lives in a small file next to the sqlite database, so every
+    worker process sees a bump made by any other worker. reading it costs a
+    stat() call while the file is unchanged, the database is never queried.
+    the file holds "<epoch> <counter>", the epoch is random and picked when
+    the file is created, so a recreated file never reuses an old version.
+    EXAMPLE
+        version = MenuVersion('/path/to/database.db.version')
+        version.current()   # 'a1b2c3-0'
+        version.bump()      # 'a1b2c3-1'
+'''
+class MenuVersion:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._stat_key = None
+        self._value = None
+
+    '''
+    current()
+        the current version as a string, suitable for an etag
+    '''
+    def current(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return self.bump(increment=False)
+        stat_key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if stat_key != self._stat_key:
+            value = self._read()
+            if value is None:
+                return self.bump(increment=False)
+            self._value, self._stat_key = value, stat_key
+        return self._value
+
+    '''
+    bump()
+        increments the counter, call it after committing a menu change
+        returns the new version
+    '''
+    def bump(self, increment=True):
+        with self._lock, open(self.path + '.lock', 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            parts = self._read_parts()
+            if parts is not None and not increment:
+                # another process created the file while we waited
+                return self._format(*parts)
+            epoch, counter = parts or (uuid.uuid4().hex[:12], 0)
+            if increment:
+                counter += 1
+            temp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(temp_path, 'w') as temp_file:
+                temp_file.write('{} {}'.format(epoch, counter))
+            # replacing the file changes its inode, current() in every other
+            # process notices the new version on its next stat()
+            os.replace(temp_path, self.path)
+            return self._format(epoch, counter)
+
+    def _read(self):
+        parts = self._read_parts()
+        return self._format(*parts) if parts else None
+
+    def _read_parts(self):
+        try:
+            with open(self.path) as version_file:
+                epoch, counter = version_file.read().split()
+            return epoch, int(counter)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    @staticmethod
+    def _format(epoch, counter):
+        return '{}-{}'.format(epoch, counter)
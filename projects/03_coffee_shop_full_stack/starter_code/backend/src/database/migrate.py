@@ -0,0 +1,122 @@
+'''
+migrate
+brings an existing coffee shop database up to the current schema
+
+    every step checks the schema first, so running the migrations again is
+    harmless. run them from the backend directory:
+        python -m src.database.migrate                  # src/database/database.db
+        python -m src.database.migrate sqlite:///other.db
+'''
+import sys
+
+from sqlalchemy import create_engine, inspect, text
+
+from .models import Ingredient, database_path, parse_recipe
+
+'''
+MigrationError
+a migration cannot complete without losing data, nothing was changed
+'''
+class MigrationError(Exception):
+    pass
+
+'''
+migrate_recipes(connection)
+    moves the json recipe blobs of the drink table into the ingredient table,
+    in batches of batch_size drinks, then drops the drink.recipe column
+    recipes that cannot be parsed are reported, and MigrationError is raised
+    before the column is dropped so the transaction is rolled back: fix or
+    clear those recipes and run the migration again
+    returns the number of migrated drinks
+'''
+def migrate_recipes(connection, batch_size=1000, log=print):
+    columns = {c['name'] for c in inspect(connection).get_columns('drink')}
+    if 'recipe' not in columns:
+        return 0
+
+    Ingredient.__table__.create(connection, checkfirst=True)
+    insert_ingredients = Ingredient.__table__.insert()
+    migrated = 0
+    failed = []
+    last_id = 0
+    while True:
+        rows = connection.execute(text(
+            'SELECT id, recipe FROM drink WHERE id > :last_id '
+            'ORDER BY id LIMIT :batch_size'),
+            {'last_id': last_id, 'batch_size': batch_size}).fetchall()
+        if not rows:
+            break
+
+        ingredients = []
+        for drink_id, recipe in rows:
+            try:
+                recipe = parse_recipe(recipe)
+            except ValueError as error:
+                log('drink {}: recipe not migrated ({})'.format(drink_id, error))
+                failed.append(drink_id)
+                continue
+            ingredients.extend(
+                dict(ingredient, drink_id=drink_id, position=position)
+                for position, ingredient in enumerate(recipe))
+        if ingredients:
+            connection.execute(insert_ingredients, ingredients)
+        migrated += len(rows)
+        last_id = rows[-1][0]
+        log('{} drinks migrated'.format(migrated))
+
+    if failed:
+        raise MigrationError(
+            '{} recipes could not be migrated (drinks {}), drink.recipe was '
+            'kept'.format(len(failed), ', '.join(map(str, failed[:20]))))
+    connection.execute(text('ALTER TABLE drink DROP COLUMN recipe'))
+    return migrated
+
+'''
+add_drink_version(connection)
+    adds the drink.version column used for optimistic concurrency, every
+    existing drink starts at version 1
+'''
+def add_drink_version(connection, log=print):
+    columns = {c['name'] for c in inspect(connection).get_columns('drink')}
+    if 'version' in columns:
+        return
+    connection.execute(text(
+        'ALTER TABLE drink ADD COLUMN version INTEGER NOT NULL DEFAULT 1'))
+    log('drink.version added')
+
+MIGRATIONS = [migrate_recipes, add_drink_version]
+
+'''
+pending_migrations(connection)
+    the names of the migrations the database still needs, none for a
+    database without tables (db_drop_and_create_all creates them as they are)
+'''
+def pending_migrations(connection):
+    if not inspect(connection).has_table('drink'):
+        return []
+    columns = {c['name'] for c in inspect(connection).get_columns('drink')}
+    pending = []
+    if 'recipe' in columns:
+        pending.append(migrate_recipes.__name__)
+    if 'version' not in columns:
+        pending.append(add_drink_version.__name__)
+    return pending
+
+'''
+migrate(database_uri)
+    runs every migration in order, in a single transaction
+'''
+def migrate(database_uri=database_path, log=print):
+    engine = create_engine(database_uri)
+    with engine.begin() as connection:
+        for migration in MIGRATIONS:
+            log('running ' + migration.__name__)
+            migration(connection, log=log)
+    engine.dispose()
+
+
+if __name__ == '__main__':
+    try:
+        migrate(*sys.argv[1:2])
+    except MigrationError as error:
+        sys.exit(str(error))
@@ -1,13 +1,21 @@
 import os
-from sqlalchemy import Column, String, Integer
-from flask_sqlalchemy import SQLAlchemy
+import threading
+from collections import defaultdict, namedtuple
+from sqlalchemy import Column, String, Integer, Float, ForeignKey, select, \
+    update, delete
+from sqlalchemy.orm import relationship
+from sqlalchemy.orm.attributes import flag_modified
 import json
 
+from .menu_version import MenuVersion
+from .sqlite_profile import ProfiledSQLAlchemy
+
 database_filename = "database.db"
 project_dir = os.path.dirname(os.path.abspath(__file__))
 database_path = "sqlite:///{}".format(os.path.join(project_dir, database_filename))
 
-db = SQLAlchemy()
+# sqlite connections get the pragmas of sqlite_profile.SQLITE_PROFILE
+db = ProfiledSQLAlchemy()
 
 '''
 setup_db(app)
@@ -29,6 +37,217 @@ def db_drop_and_create_all():
     db.drop_all()
     db.create_all()
 
+'''
+menu_version()
+    the MenuVersion of the database the app is bound to, kept in a
+    `.version` file next to the sqlite file so every worker process shares it
+    Drink.insert/update/delete bump it after committing
+'''
+_menu_versions = {}
+
+def menu_version():
+    uri = db.get_app().config["SQLALCHEMY_DATABASE_URI"]
+    version = _menu_versions.get(uri)
+    if version is None:
+        if uri.startswith('sqlite:///') and uri != 'sqlite:///':
+            path = uri[len('sqlite:///'):] + '.version'
+        else:
+            path = os.path.join(project_dir, 'menu.version')
+        version = _menu_versions.setdefault(uri, MenuVersion(path))
+    return version
+
+'''
+DrinkRepresentation
+the short and long forms of one drink, built and json encoded once
+    stamp: the menu version the representation was built from
+    version: the version of the drink row it was built from
+'''
+DrinkRepresentation = namedtuple(
+    'DrinkRepresentation',
+    ['stamp', 'version', 'id', 'short_recipe', 'long_recipe', 'short_json',
+     'long_json'])
+
+'''
+RepresentationCache
+an in-process cache of DrinkRepresentation keyed by drink id
+
+    an entry is only reused while the menu version is unchanged, so rows
+    changed by another process are rebuilt on their next read, and
+    Drink.insert/update/delete drop the entry of the row they touch.
+    it must also match the version of the drink row read, so a read landing
+    between the commit of an update and the menu version bump never pairs
+    the new drink version (its etag) with the recipe of the previous one.
+'''
+class RepresentationCache:
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    '''
+    get(drink, stamp=None, recipe=None, store=True)
+        returns the DrinkRepresentation of drink, building it when missing
+        or stale
+        stamp: the current menu version, when the caller already read it
+        recipe: the long recipe of drink, when the caller already loaded it
+        store: False to build a missing representation without keeping it
+    '''
+    def get(self, drink, stamp=None, recipe=None, store=True):
+        if stamp is None:
+            stamp = menu_version().current()
+        entry = self._entries.get(drink.id)
+        if entry is not None and entry.stamp == stamp and \
+                entry.version == drink.version:
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+        long_recipe = drink.recipe if recipe is None else recipe
+        short_recipe = [{'color': r['color'], 'parts': r['parts']}
+                        for r in long_recipe]
+        entry = DrinkRepresentation(
+            stamp,
+            drink.version,
+            drink.id,
+            short_recipe,
+            long_recipe,
+            encode_json({'id': drink.id, 'title': drink.title,
+                         'recipe': short_recipe}),
+            encode_json({'id': drink.id, 'title': drink.title,
+                         'recipe': long_recipe, 'version': drink.version}))
+        if store and drink.id is not None:
+            with self._lock:
+                self._entries[drink.id] = entry
+        return entry
+
+    def fresh(self, drink_id, stamp, version):
+        entry = self._entries.get(drink_id)
+        return entry is not None and entry.stamp == stamp and \
+            entry.version == version
+
+    def invalidate(self, drink_id):
+        with self._lock:
+            self._entries.pop(drink_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+'''
+encode_json(obj)
+    compact json encoding used for the pre-encoded representations
+'''
+def encode_json(obj):
+    return json.dumps(obj, separators=(',', ':')).encode()
+
+
+representation_cache = RepresentationCache()
+
+'''
+parse_recipe(recipe)
+    validates a recipe and returns it as a list of ingredient dicts
+    accepts the list form [{'color': string, 'name':string, 'parts':number}],
+    a single ingredient dict, or either one as a json string
+    raises ValueError for anything else
+'''
+def parse_recipe(recipe):
+    if isinstance(recipe, str):
+        recipe = json.loads(recipe)
+    if isinstance(recipe, dict):
+        recipe = [recipe]
+    if not isinstance(recipe, list) or not recipe:
+        raise ValueError('recipe must be a non empty list of ingredients')
+
+    ingredients = []
+    for item in recipe:
+        if not isinstance(item, dict):
+            raise ValueError('ingredient must be an object')
+        name, color = item.get('name'), item.get('color')
+        if not isinstance(name, str) or not name or \
+                not isinstance(color, str) or not color:
+            raise ValueError('ingredient needs a name and a color')
+        try:
+            parts = float(item.get('parts'))
+        except (TypeError, ValueError):
+            raise ValueError('ingredient parts must be a number')
+        if not parts > 0:
+            raise ValueError('ingredient parts must be positive')
+        ingredients.append({
+            'name': name,
+            'color': color,
+            'parts': int(parts) if parts.is_integer() else parts
+        })
+    return ingredients
+
+'''
+Ingredient
+one line of a drink recipe, stored in its own table so recipes have no size
+cap, need no json parsing and drinks can be queried by ingredient
+'''
+class Ingredient(db.Model):
+    id = Column(Integer, primary_key=True)
+    drink_id = Column(Integer, ForeignKey('drink.id', ondelete='CASCADE'),
+                      nullable=False, index=True)
+    # order of the ingredient within the recipe
+    position = Column(Integer, nullable=False)
+    # indexed for GET /drinks?ingredient=
+    name = Column(String(80), nullable=False, index=True)
+    color = Column(String(80), nullable=False)
+    parts = Column(Float, nullable=False)
+
+    def format(self):
+        return format_ingredient(self.name, self.color, self.parts)
+
+def format_ingredient(name, color, parts):
+    return {
+        'color': color,
+        'name': name,
+        'parts': int(parts) if parts.is_integer() else parts
+    }
+
+'''
+load_recipes(drink_ids)
+    {drink id: recipe} for the given drink ids, or for every drink when
+    drink_ids is None, read as plain rows in a single query per chunk of ids
+    instead of building an Ingredient object per recipe line
+'''
+RECIPE_CHUNK_SIZE = 500
+
+def load_recipes(drink_ids=None):
+    query = db.session.query(
+        Ingredient.drink_id, Ingredient.name, Ingredient.color,
+        Ingredient.parts).order_by(Ingredient.drink_id, Ingredient.position)
+    if drink_ids is None:
+        chunks = [query]
+    else:
+        drink_ids = list(drink_ids)
+        chunks = [
+            query.filter(Ingredient.drink_id.in_(
+                drink_ids[start:start + RECIPE_CHUNK_SIZE]))
+            for start in range(0, len(drink_ids), RECIPE_CHUNK_SIZE)]
+
+    recipes = defaultdict(list)
+    for chunk in chunks:
+        for drink_id, name, color, parts in chunk:
+            recipes[drink_id].append(format_ingredient(name, color, parts))
+    return recipes
+
+'''
+VersionConflict
+the drink was changed since the version the client read
+'''
+class VersionConflict(Exception):
+    pass
+
 '''
 Drink
 a persistent drink entity, extends the base SQLAlchemy Model
@@ -38,17 +257,143 @@ class Drink(db.Model):
     id = Column(Integer().with_variant(Integer, "sqlite"), primary_key=True)
     # String Title
     title = Column(String(80), unique=True)
-    # the ingredients blob - this stores a lazy json blob
-    # the required datatype is [{'color': string, 'name':string, 'parts':number}]
-    recipe =  Column(String(180), nullable=False)
+    # incremented by every update, the orm only updates the row when the
+    # version it loaded is still current
+    version = Column(Integer, nullable=False, default=1, server_default='1')
+    # the recipe lines, list endpoints load them in bulk with Drink.menu()
+    ingredients = relationship('Ingredient',
+                               order_by=Ingredient.position,
+                               cascade='all, delete-orphan')
+
+    __mapper_args__ = {'version_id_col': version}
+
+    '''
+    recipe
+        the recipe as [{'color': string, 'name':string, 'parts':number}]
+        assigning a recipe (list, dict or json string, see parse_recipe)
+        replaces the ingredients of the drink
+    '''
+    @property
+    def recipe(self):
+        return [ingredient.format() for ingredient in self.ingredients]
+
+    @recipe.setter
+    def recipe(self, recipe):
+        self.ingredients = [
+            Ingredient(position=position, **ingredient)
+            for position, ingredient in enumerate(parse_recipe(recipe))]
+        # a recipe change updates the drink row too, bumping its version
+        flag_modified(self, 'title')
+
+    '''
+    update_if_version(drink_id, versions, title=None, recipe=None)
+        updates a drink with a single conditional statement
+            UPDATE drink SET ..., version = version + 1
+            WHERE id = :drink_id AND version IN (:versions)
+        so a concurrent edit is never silently overwritten and no row is
+        read or locked first. versions None skips the version check
+        returns the updated drink, or None when there is no such drink
+        raises VersionConflict when the drink is at another version and
+        ValueError for an invalid recipe
+    '''
+    @classmethod
+    def update_if_version(cls, drink_id, versions, title=None, recipe=None):
+        if recipe is not None:
+            recipe = parse_recipe(recipe)
+        statement = update(cls.__table__).where(cls.id == drink_id)
+        if versions is not None:
+            statement = statement.where(cls.version.in_(versions))
+        values = {'version': cls.version + 1}
+        if title is not None:
+            values['title'] = title
+        try:
+            if db.session.execute(statement.values(values)).rowcount == 0:
+                db.session.rollback()
+                if db.session.query(cls.id).filter(
+                        cls.id == drink_id).first() is None:
+                    return None
+                raise VersionConflict()
+            if recipe is not None:
+                db.session.execute(delete(Ingredient.__table__).where(
+                    Ingredient.drink_id == drink_id))
+                db.session.execute(Ingredient.__table__.insert(), [
+                    dict(ingredient, drink_id=drink_id, position=position)
+                    for position, ingredient in enumerate(recipe)])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        representation_cache.invalidate(drink_id)
+        menu_version().bump()
+        return cls.query.filter(cls.id == drink_id).one_or_none()
+
+    '''
+    with_ingredient(name)
+        query of the drinks using the named ingredient, through the
+        ingredient name index
+    '''
+    @classmethod
+    def with_ingredient(cls, name):
+        drink_ids = select(Ingredient.drink_id).where(Ingredient.name == name)
+        return cls.query.filter(cls.id.in_(drink_ids))
+
+    '''
+    menu(query=None, after_id=None, limit=None, cache=True)
+        the DrinkRepresentation of every drink of query (all drinks by
+        default), ordered by id
+        after_id and limit read one page of the menu, keyset paginated
+        reads (id, title, version) rows only and loads the recipes missing from the
+        representation cache with load_recipes, no ORM objects are built
+        cache: False to leave the representations built out of the cache
+    '''
+    @classmethod
+    def menu(cls, query=None, after_id=None, limit=None, cache=True):
+        whole_menu = query is None and after_id is None and limit is None
+        # read before the drinks: a change committed in between is rebuilt
+        # on the next read instead of being cached under its new version
+        stamp = menu_version().current()
+        if query is None:
+            query = cls.query
+        query = query.with_entities(cls.id, cls.title, cls.version)
+        if after_id is not None:
+            query = query.filter(cls.id > after_id)
+        drinks = query.order_by(cls.id).limit(limit).all()
+        missing = [drink.id for drink in drinks
+                   if not representation_cache.fresh(drink.id, stamp,
+                                                     drink.version)]
+        recipes = {}
+        if missing:
+            # a cold cache reads every recipe line at once
+            recipes = load_recipes(
+                None if whole_menu and len(missing) == len(drinks)
+                else missing)
+        return [representation_cache.get(drink, stamp,
+                                          recipes.get(drink.id, []), cache)
+                for drink in drinks]
+
+    '''
+    iter_menu(batch_size)
+        yields the DrinkRepresentation of every drink, reading the menu one
+        page of batch_size drinks at a time. the representations it builds
+        are not cached, so memory use stays flat however many drinks there are
+    '''
+    @classmethod
+    def iter_menu(cls, batch_size=1000):
+        after_id = None
+        while True:
+            page = cls.menu(after_id=after_id, limit=batch_size, cache=False)
+            yield from page
+            if len(page) < batch_size:
+                return
+            after_id = page[-1].id
 
     '''
     short()
         short form representation of the Drink model
     '''
     def short(self):
-        short_recipe = [{'color': r['color'], 'parts': r['parts']} for r in json.loads(self.recipe)]
-        
+        short_recipe = representation_cache.get(self).short_recipe
+
         return {
             'id': self.id,
             'title': self.title,
@@ -57,15 +402,28 @@ class Drink(db.Model):
 
     '''
     long()
-        long form representation of the Drink model
+        long form representation of the Drink model, with the version to
+        send back in If-Match when updating the drink
     '''
     def long(self):
         return {
             'id': self.id,
             'title': self.title,
-            'recipe': json.loads(self.recipe)
+            'recipe': representation_cache.get(self).long_recipe,
+            'version': self.version
         }
 
+    '''
+    short_json() / long_json()
+        the short and long forms already encoded as json bytes, cached until
+        the drink changes
+    '''
+    def short_json(self):
+        return representation_cache.get(self).short_json
+
+    def long_json(self):
+        return representation_cache.get(self).long_json
+
     '''
     insert()
         inserts a new model into a database
@@ -78,6 +436,8 @@ class Drink(db.Model):
     def insert(self):
         db.session.add(self)
         db.session.commit()
+        representation_cache.invalidate(self.id)
+        menu_version().bump()
 
     '''
     delete()
@@ -90,6 +450,8 @@ class Drink(db.Model):
     def delete(self):
         db.session.delete(self)
         db.session.commit()
+        representation_cache.invalidate(self.id)
+        menu_version().bump()
 
     '''
     update()
@@ -102,6 +464,8 @@ class Drink(db.Model):
     '''
     def update(self):
         db.session.commit()
+        representation_cache.invalidate(self.id)
+        menu_version().bump()
 
     def __repr__(self):
         return json.dumps(self.short())
\ No newline at end of file
@@ -0,0 +1,94 @@
+from functools import partial
+
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.pool import NullPool, QueuePool
+
+'''
+SQLITE_PROFILE
+the pragmas run on every new sqlite connection, override any of them with
+the SQLITE_PROFILE app config, or set that config to None to keep the
+sqlite defaults
+    journal_mode: wal lets readers go on while a write is in progress, and
+        writers no longer wait for readers to finish
+    synchronous: normal is safe with wal and syncs at checkpoints only
+    busy_timeout: milliseconds a writer waits for the lock before failing
+    mmap_size: bytes of the file read through memory mapping
+    cache_size: page cache of each connection, negative values are KiB
+    foreign_keys: enforce the foreign keys, ondelete='CASCADE' included
+'''
+SQLITE_PROFILE = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'busy_timeout': 5000,
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64000,
+    'foreign_keys': 'on',
+}
+
+'''
+SQLITE_POOL
+the connection pool of a sqlite file database, override it with the
+SQLITE_POOL app config
+    flask-sqlalchemy opens a new connection for every session on sqlite
+    files, so every request would pay for the pragmas above. the pool keeps
+    the connections open instead, each one is used by one thread at a time
+'''
+SQLITE_POOL = {
+    'poolclass': QueuePool,
+    'pool_size': 5,
+    'max_overflow': 10,
+    'pool_timeout': 30,
+}
+
+'''
+sqlite_profile(config)
+    the pragmas of SQLITE_PROFILE updated with config['SQLITE_PROFILE']
+    returns None when the profile is disabled
+'''
+def sqlite_profile(config):
+    if 'SQLITE_PROFILE' not in config:
+        return dict(SQLITE_PROFILE)
+    if config['SQLITE_PROFILE'] is None:
+        return None
+    return dict(SQLITE_PROFILE, **config['SQLITE_PROFILE'])
+
+'''
+apply_sqlite_profile(profile, dbapi_connection, connection_record)
+    the engine 'connect' event handler running the pragmas of profile
+'''
+def apply_sqlite_profile(profile, dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    try:
+        for pragma, value in profile.items():
+            cursor.execute('PRAGMA {}={}'.format(pragma, value))
+    finally:
+        cursor.close()
+
+'''
+ProfiledSQLAlchemy
+flask_sqlalchemy.SQLAlchemy applying the sqlite profile and pool to the
+engines of sqlite file databases, other databases are left as they are
+    it overrides Flask-SQLAlchemy 2.x internals (apply_driver_hacks,
+    create_engine), which is why requirements.txt pins Flask-SQLAlchemy<3
+'''
+class ProfiledSQLAlchemy(SQLAlchemy):
+    def apply_driver_hacks(self, app, sa_url, options):
+        sa_url, options = super().apply_driver_hacks(app, sa_url, options)
+        if sa_url.drivername.startswith('sqlite') and \
+                options.get('poolclass') is NullPool and \
+                sqlite_profile(app.config) is not None:
+            del options['poolclass']
+            options.update(SQLITE_POOL, **app.config.get('SQLITE_POOL', {}))
+            # the pool hands a connection to one thread at a time
+            options.setdefault('connect_args', {})['check_same_thread'] = False
+        return sa_url, options
+
+    def create_engine(self, sa_url, engine_opts):
+        engine = super().create_engine(sa_url, engine_opts)
+        if engine.dialect.name == 'sqlite':
+            profile = sqlite_profile(self.get_app().config)
+            if profile:
+                event.listen(engine, 'connect',
+                             partial(apply_sqlite_profile, profile))
+        return engine
@@ -0,0 +1,130 @@
+import codecs
+import json
+
+CHUNK_SIZE = 64 * 1024
+# a single array item larger than this is reported as malformed instead of
+# buffering the rest of the stream looking for its end
+MAX_ITEM_SIZE = 1024 * 1024
+WHITESPACE = ' \t\r\n'
+
+'''
+JSONStreamError
+the stream can not be read any further, raised for a malformed json array
+    index: the position of the item that could not be read
+'''
+class JSONStreamError(ValueError):
+    def __init__(self, message, index):
+        super().__init__(message)
+        self.index = index
+
+'''
+iter_json_items(stream)
+    yields the items of a json array or of newline delimited json (ndjson),
+    read from a binary stream chunk by chunk so the whole body is never held
+    in memory. the format is picked from the first character: '[' for an
+    array, anything else for ndjson
+    a malformed ndjson line is yielded as a ValueError and reading goes on,
+    a malformed array raises JSONStreamError
+    EXAMPLE
+        for item in iter_json_items(request.stream):
+            ...
+'''
+def iter_json_items(stream, chunk_size=CHUNK_SIZE):
+    reader = _Reader(stream, chunk_size)
+    if not reader.skip_whitespace():
+        return
+    if reader.buffer[reader.position] == '[':
+        reader.position += 1
+        yield from _iter_array(reader)
+    else:
+        yield from _iter_lines(reader)
+
+
+class _Reader:
+    def __init__(self, stream, chunk_size):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.position = 0
+        self.eof = False
+
+    '''
+    read()
+        appends the next chunk to the buffer, dropping the consumed part
+        returns False at the end of the stream
+    '''
+    def read(self):
+        if self.eof:
+            return False
+        chunk = self.stream.read(self.chunk_size)
+        self.eof = not chunk
+        self.buffer = self.buffer[self.position:] + \
+            self.decoder.decode(chunk, final=self.eof)
+        self.position = 0
+        return True
+
+    '''
+    skip_whitespace()
+        moves past whitespace, returns False when the stream ends first
+    '''
+    def skip_whitespace(self):
+        while True:
+            while self.position < len(self.buffer) and \
+                    self.buffer[self.position] in WHITESPACE:
+                self.position += 1
+            if self.position < len(self.buffer):
+                return True
+            if not self.read():
+                return False
+
+
+def _iter_array(reader):
+    decoder = json.JSONDecoder()
+    index = 0
+    if reader.skip_whitespace() and reader.buffer[reader.position] == ']':
+        return
+    while True:
+        if not reader.skip_whitespace():
+            raise JSONStreamError('unterminated array', index)
+        try:
+            item, end = decoder.raw_decode(reader.buffer, reader.position)
+        except json.JSONDecodeError as error:
+            # the item may continue in the next chunk
+            if len(reader.buffer) - reader.position < MAX_ITEM_SIZE and \
+                    reader.read():
+                continue
+            raise JSONStreamError(error.msg, index)
+        if end == len(reader.buffer) and reader.read():
+            # a number may continue in the next chunk, decode it again
+            continue
+        reader.position = end
+        yield item
+        index += 1
+
+        if not reader.skip_whitespace():
+            raise JSONStreamError('unterminated array', index)
+        separator = reader.buffer[reader.position]
+        reader.position += 1
+        if separator == ']':
+            return
+        if separator != ',':
+            raise JSONStreamError("expected ',' or ']'", index)
+
+
+def _iter_lines(reader):
+    while True:
+        end = reader.buffer.find('\n', reader.position)
+        if end == -1:
+            if reader.read():
+                continue
+            end = len(reader.buffer)
+        line = reader.buffer[reader.position:end].strip()
+        reader.position = end + 1
+        if line:
+            try:
+                yield json.loads(line)
+            except ValueError as error:
+                yield ValueError('invalid json line: ' + str(error))
+        if reader.position > len(reader.buffer) and reader.eof:
+            return
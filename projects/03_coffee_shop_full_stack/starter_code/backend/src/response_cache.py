@@ -0,0 +1,39 @@
+import threading
+
+'''
+ResponseCache
+pre-encoded response bodies of this process, stamped with the version of
+the data they were built from
+
+    get(key, version, build) returns the cached body while the version is
+    unchanged and calls build() to replace it otherwise
+'''
+class ResponseCache:
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version, build):
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == version:
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        body = build()
+        with self._lock:
+            self._entries[key] = (version, body)
+        return body
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
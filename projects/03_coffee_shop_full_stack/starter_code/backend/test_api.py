@@ -0,0 +1,500 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import rsa
+from jose import jwk, jwt
+from sqlalchemy import create_engine, event, text
+
+# verify tokens against a local key instead of the Auth0 tenant, this has to
+# be set before the app is imported
+KEY_DIRECTORY = tempfile.mkdtemp()
+_, PRIVATE_KEY = rsa.newkeys(1024)
+PEM = PRIVATE_KEY.save_pkcs1().decode()
+PUBLIC_JWK = jwk.construct(PEM, 'RS256').public_key().to_dict()
+PUBLIC_JWK.update({'kid': 'test-key', 'use': 'sig'})
+os.environ['AUTH0_JWKS_FILE'] = os.path.join(KEY_DIRECTORY, 'jwks.json')
+with open(os.environ['AUTH0_JWKS_FILE'], 'w') as jwks_file:
+    json.dump({'keys': [PUBLIC_JWK]}, jwks_file)
+
+from src.api import app, response_cache
+from src.auth.auth import AUTH0_DOMAIN, API_AUDIENCE
+from src.database.bulk import BulkImport, MAX_REPORTED_ERRORS
+from src.database.models import db, Drink, Ingredient, menu_version, \
+    representation_cache
+from src.database.menu_version import MenuVersion
+from src.database.migrate import MigrationError, migrate
+from src.database.sqlite_profile import SQLITE_PROFILE
+
+MANAGER_PERMISSIONS = ['get:drinks-detail', 'post:drinks', 'patch:drinks',
+                       'delete:drinks']
+
+
+def make_token(permissions):
+    return jwt.encode({
+        'iss': 'https://' + AUTH0_DOMAIN + '/',
+        'aud': API_AUDIENCE,
+        'sub': 'auth0|tester',
+        'exp': int(time.time()) + 3600,
+        'permissions': permissions
+    }, PEM, algorithm='RS256', headers={'kid': 'test-key'})
+
+
+class CoffeeShopTestCase(unittest.TestCase):
+    """This class represents the coffee shop api test case"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.manager = {'Authorization': 'Bearer ' +
+                       make_token(MANAGER_PERMISSIONS)}
+
+    def setUp(self):
+        """Define test variables and bind the app to a fresh database."""
+        self.directory = tempfile.mkdtemp()
+        self.original_uri = app.config['SQLALCHEMY_DATABASE_URI']
+        app.config['SQLALCHEMY_DATABASE_URI'] = \
+            'sqlite:///' + os.path.join(self.directory, 'test.db')
+        self.client = app.test_client
+        self.context = app.app_context()
+        self.context.push()
+        db.create_all()
+        Drink(title='water', recipe=[
+            {'name': 'water', 'color': 'blue', 'parts': 1}]).insert()
+
+    def tearDown(self):
+        """Executed after reach test"""
+        db.session.remove()
+        self.context.pop()
+        response_cache.clear()
+        app.config['SQLALCHEMY_DATABASE_URI'] = self.original_uri
+        shutil.rmtree(self.directory)
+
+    def count_queries(self):
+        queries = []
+        event.listen(db.engine, 'before_cursor_execute',
+                     lambda *args: queries.append(args[2]))
+        return queries
+
+    def test_sqlite_profile(self):
+        """Test new connections get the pragmas of the sqlite profile"""
+        def pragma(name):
+            return db.session.execute(text('PRAGMA ' + name)).scalar()
+
+        self.assertEqual(pragma('journal_mode'), 'wal')
+        self.assertEqual(pragma('foreign_keys'), 1)
+        self.assertEqual(pragma('busy_timeout'),
+                         SQLITE_PROFILE['busy_timeout'])
+        self.assertEqual(db.engine.pool.__class__.__name__, 'QueuePool')
+
+    def test_get_drinks_etag(self):
+        """Test the menu carries an etag and revalidates with a 304"""
+        res = self.client().get('/drinks')
+        etag = res.headers['ETag']
+
+        queries = self.count_queries()
+        again = self.client().get('/drinks',
+                                  headers={'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['drinks'][0]['title'], 'water')
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(again.headers['ETag'], etag)
+        self.assertEqual(queries, [])
+
+    def test_cached_body_skips_the_database(self):
+        """Test an unchanged menu is served from the cached body"""
+        self.client().get('/drinks')
+
+        queries = self.count_queries()
+        res = self.client().get('/drinks')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(queries, [])
+
+    def test_post_drink_changes_etag(self):
+        """Test a new drink invalidates the cached menu"""
+        etag = self.client().get('/drinks').headers['ETag']
+
+        res = self.client().post('/drinks', headers=self.manager, json={
+            'title': 'tea',
+            'recipe': [{'name': 'tea', 'color': 'brown', 'parts': 1}]})
+        menu = self.client().get('/drinks', headers={'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(menu.status_code, 200)
+        self.assertNotEqual(menu.headers['ETag'], etag)
+        self.assertEqual(len(json.loads(menu.data)['drinks']), 2)
+
+    def test_version_bumped_by_another_process(self):
+        """Test a change made by another worker is picked up"""
+        etag = self.client().get('/drinks').headers['ETag']
+
+        # another worker: its own MenuVersion over the same file
+        other_worker = MenuVersion(menu_version().path)
+        db.session.execute(Drink.__table__.insert(), {'id': 2, 'title': 'tea'})
+        db.session.execute(Ingredient.__table__.insert(), {
+            'drink_id': 2, 'position': 0, 'name': 'tea', 'color': 'brown',
+            'parts': 1})
+        db.session.commit()
+        other_worker.bump()
+
+        menu = self.client().get('/drinks', headers={'If-None-Match': etag})
+
+        self.assertEqual(menu.status_code, 200)
+        self.assertEqual(len(json.loads(menu.data)['drinks']), 2)
+
+    def test_menu_reads_version_before_drinks(self):
+        """Test a change committed while the menu is read is picked up"""
+        Drink.menu()
+        changed = []
+
+        def change_after_read(conn, cursor, statement, *args):
+            # another worker renames the drink once the menu has read it
+            if not changed and statement.startswith('SELECT drink.id'):
+                changed.append(statement)
+                with db.engine.begin() as other:
+                    other.execute(text(
+                        "UPDATE drink SET title = 'tea' WHERE id = 1"))
+                menu_version().bump()
+
+        event.listen(db.engine, 'after_cursor_execute', change_after_read)
+        try:
+            Drink.menu()
+        finally:
+            event.remove(db.engine, 'after_cursor_execute',
+                         change_after_read)
+        db.session.commit()
+        menu = Drink.menu()
+
+        self.assertEqual(len(changed), 1)
+        self.assertEqual(json.loads(menu[0].short_json)['title'], 'tea')
+
+    def test_get_drinks_detail_requires_auth(self):
+        """Test the detailed menu is private and revalidates"""
+        unauthorized = self.client().get('/drinks-detail')
+        res = self.client().get('/drinks-detail', headers=self.manager)
+        again = self.client().get('/drinks-detail', headers=dict(
+            self.manager, **{'If-None-Match': res.headers['ETag']}))
+
+        self.assertEqual(unauthorized.status_code, 401)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('private', res.headers['Cache-Control'])
+        self.assertEqual(json.loads(res.data)['drinks'][0]['recipe'][0]['name'],
+                         'water')
+        self.assertEqual(again.status_code, 304)
+
+    def test_filter_drinks_by_ingredient(self):
+        """Test GET /drinks?ingredient= only lists matching drinks"""
+        Drink(title='latte', recipe=[
+            {'name': 'espresso', 'color': 'brown', 'parts': 1},
+            {'name': 'milk', 'color': 'white', 'parts': 3}]).insert()
+        Drink(title='flat white', recipe=[
+            {'name': 'espresso', 'color': 'brown', 'parts': 1},
+            {'name': 'microfoam', 'color': 'white', 'parts': 2}]).insert()
+
+        res = self.client().get('/drinks?ingredient=milk')
+        espresso = self.client().get('/drinks?ingredient=espresso')
+        none = self.client().get('/drinks?ingredient=rum')
+
+        self.assertEqual([d['title'] for d in json.loads(res.data)['drinks']],
+                         ['latte'])
+        self.assertEqual(len(json.loads(espresso.data)['drinks']), 2)
+        self.assertEqual(json.loads(none.data)['drinks'], [])
+        self.assertNotEqual(res.headers['ETag'], espresso.headers['ETag'])
+
+    def test_post_long_recipe(self):
+        """Test recipes are no longer capped by a string column"""
+        recipe = [{'name': 'ingredient %d' % i, 'color': 'red', 'parts': 1}
+                  for i in range(20)]
+
+        res = self.client().post('/drinks', headers=self.manager,
+                                 json={'title': 'punch', 'recipe': recipe})
+        detail = self.client().get('/drinks-detail', headers=self.manager)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['drinks'][0]['recipe'], recipe)
+        self.assertEqual(json.loads(detail.data)['drinks'][1]['recipe'],
+                         recipe)
+
+    def test_post_invalid_recipe(self):
+        """Test a malformed recipe is unprocessable"""
+        res = self.client().post('/drinks', headers=self.manager, json={
+            'title': 'broken', 'recipe': [{'name': 'x', 'parts': 'many'}]})
+
+        self.assertEqual(res.status_code, 422)
+
+    def test_delete_drink_removes_ingredients(self):
+        """Test deleting a drink deletes its recipe lines"""
+        res = self.client().delete('/drinks/1', headers=self.manager)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(Ingredient.query.count(), 0)
+
+    def test_patch_drink_if_match(self):
+        """Test PATCH only applies to the version named by If-Match"""
+        first = self.client().patch('/drinks/1', headers=dict(
+            self.manager, **{'If-Match': '"drink-1-1"'}),
+            json={'title': 'sparkling water'})
+        stale = self.client().patch('/drinks/1', headers=dict(
+            self.manager, **{'If-Match': '"drink-1-1"'}),
+            json={'title': 'still water'})
+        current = self.client().patch('/drinks/1', headers=dict(
+            self.manager, **{'If-Match': first.headers['ETag']}), json={
+                'recipe': [{'name': 'water', 'color': 'clear', 'parts': 1}]})
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.headers['ETag'], '"drink-1-2"')
+        self.assertEqual(stale.status_code, 412)
+        self.assertEqual(current.status_code, 200)
+        self.assertEqual(current.headers['ETag'], '"drink-1-3"')
+        self.assertEqual(json.loads(current.data)['drinks'][0], {
+            'id': 1, 'title': 'sparkling water', 'version': 3,
+            'recipe': [{'name': 'water', 'color': 'clear', 'parts': 1}]})
+
+    def test_get_drink_etag(self):
+        """Test a drink and the detailed menu carry the drink version"""
+        res = self.client().get('/drinks/1', headers=self.manager)
+        menu = self.client().get('/drinks-detail', headers=self.manager)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['ETag'], '"drink-1-1"')
+        self.assertEqual(json.loads(res.data)['drinks'][0]['version'], 1)
+        self.assertEqual(json.loads(menu.data)['drinks'][0]['version'], 1)
+        self.assertEqual(self.client().get(
+            '/drinks/1000', headers=self.manager).status_code, 404)
+
+    def test_get_drink_before_menu_version_bump(self):
+        """Test a drink updated but not yet bumped is not served stale"""
+        self.client().get('/drinks/1', headers=self.manager)
+        # another worker committed its update and has not bumped the menu
+        # version or dropped the cached representation yet
+        with db.engine.begin() as connection:
+            connection.execute(text(
+                "UPDATE drink SET version = version + 1 WHERE id = 1"))
+            connection.execute(text(
+                "UPDATE ingredient SET name = 'tea' WHERE drink_id = 1"))
+
+        res = self.client().get('/drinks/1', headers=self.manager)
+
+        self.assertEqual(res.headers['ETag'], '"drink-1-2"')
+        self.assertEqual(
+            json.loads(res.data)['drinks'][0]['recipe'][0]['name'], 'tea')
+
+    def test_patch_without_if_match(self):
+        """Test PATCH without If-Match updates the current version"""
+        res = self.client().patch('/drinks/1', headers=self.manager,
+                                  json={'title': 'tea'})
+        star = self.client().patch('/drinks/1', headers=dict(
+            self.manager, **{'If-Match': '*'}), json={'title': 'milk'})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['ETag'], '"drink-1-2"')
+        self.assertEqual(star.status_code, 200)
+        self.assertEqual(json.loads(star.data)['drinks'][0]['title'], 'milk')
+        self.assertEqual(json.loads(star.data)['drinks'][0]['version'], 3)
+
+    def test_patch_missing_drink(self):
+        """Test PATCH of an unknown drink is a 404, not a 412"""
+        res = self.client().patch('/drinks/1000', headers=dict(
+            self.manager, **{'If-Match': '"drink-1000-1"'}),
+            json={'title': 'ghost'})
+
+        self.assertEqual(res.status_code, 404)
+
+    def test_concurrent_patches_lose_no_update(self):
+        """Test concurrent read-modify-write edits are all kept"""
+        writers, edits = 4, 5
+        unexpected = []
+
+        def edit(writer):
+            client = app.test_client()
+            for n in range(edits):
+                while True:
+                    read = client.get('/drinks/1', headers=self.manager)
+                    recipe = json.loads(read.data)['drinks'][0]['recipe']
+                    recipe.append({'name': 'edit %d-%d' % (writer, n),
+                                   'color': 'red', 'parts': 1})
+                    res = client.patch('/drinks/1', json={'recipe': recipe},
+                                       headers=dict(self.manager, **{
+                                           'If-Match': read.headers['ETag']}))
+                    if res.status_code != 412:
+                        break
+                if res.status_code != 200:
+                    unexpected.append(res.status_code)
+
+        threads = [threading.Thread(target=edit, args=(writer,))
+                   for writer in range(writers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        db.session.expire_all()
+        drink = Drink.query.get(1)
+        self.assertEqual(unexpected, [])
+        self.assertEqual(len(drink.recipe), 1 + writers * edits)
+        self.assertEqual(drink.version, 1 + writers * edits)
+
+    def test_bulk_import_json_array(self):
+        """Test POST /drinks/bulk imports an array and reports bad items"""
+        etag = self.client().get('/drinks').headers['ETag']
+        drinks = [
+            {'title': 'tea', 'recipe': [
+                {'name': 'tea', 'color': 'brown', 'parts': 1}]},
+            {'title': 'water', 'recipe': [
+                {'name': 'water', 'color': 'blue', 'parts': 1}]},
+            {'title': 'broken', 'recipe': 'nope'},
+            {'title': 'milk', 'recipe': [
+                {'name': 'milk', 'color': 'white', 'parts': 2}]},
+            {'title': 'tea', 'recipe': [
+                {'name': 'tea', 'color': 'brown', 'parts': 1}]}]
+
+        res = self.client().post('/drinks/bulk', headers=self.manager,
+                                 data=json.dumps(drinks))
+        data = json.loads(res.data)
+        menu = self.client().get('/drinks', headers={'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['imported'], 2)
+        self.assertEqual([e['index'] for e in data['errors']], [1, 2, 4])
+        self.assertEqual(menu.status_code, 200)
+        self.assertEqual([d['title'] for d in json.loads(menu.data)['drinks']],
+                         ['water', 'tea', 'milk'])
+        self.assertEqual(Drink.query.filter_by(title='milk').one().recipe,
+                         [{'name': 'milk', 'color': 'white', 'parts': 2}])
+
+    def test_bulk_import_ndjson(self):
+        """Test POST /drinks/bulk reads one drink per line"""
+        body = '\n'.join([
+            json.dumps({'title': 'drink %d' % i, 'recipe': [
+                {'name': 'water', 'color': 'blue', 'parts': i + 1}]})
+            for i in range(2500)] + ['{not json', ''])
+
+        res = self.client().post('/drinks/bulk', headers=self.manager,
+                                 data=body)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['imported'], 2500)
+        self.assertEqual([e['index'] for e in data['errors']], [2500])
+        self.assertEqual(Drink.query.count(), 2501)
+        self.assertEqual(Ingredient.query.count(), 2501)
+
+    def test_bulk_import_caps_errors(self):
+        """Test duplicates across batches are rejected, errors are capped"""
+        drinks = [{'title': 'drink %d' % (i % 3), 'recipe': [
+            {'name': 'water', 'color': 'blue', 'parts': 1}]}
+            for i in range(MAX_REPORTED_ERRORS * 3)]
+
+        importer = BulkImport(batch_size=2).run(iter(drinks))
+
+        self.assertEqual(importer.imported, 3)
+        self.assertEqual(importer.rejected, len(drinks) - 3)
+        self.assertEqual(len(importer.errors), MAX_REPORTED_ERRORS)
+        self.assertEqual([e['index'] for e in importer.errors[:3]],
+                         [3, 4, 5])
+
+    def test_bulk_import_malformed_array(self):
+        """Test a truncated array is a 400 that keeps the drinks read"""
+        res = self.client().post('/drinks/bulk', headers=self.manager,
+                                 data='[{"title": "tea", "recipe": {"name": '
+                                      '"tea", "color": "brown", "parts": 1}},'
+                                      ' {"title": "mi')
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(json.loads(res.data)['imported'], 1)
+        self.assertEqual(Drink.query.count(), 2)
+
+    def test_bulk_import_requires_permission(self):
+        """Test POST /drinks/bulk needs the post:drinks permission"""
+        barista = {'Authorization': 'Bearer ' +
+                   make_token(['get:drinks-detail'])}
+
+        res = self.client().post('/drinks/bulk', headers=barista, data='[]')
+
+        self.assertEqual(res.status_code, 403)
+
+    def test_export_drinks(self):
+        """Test GET /drinks/export streams every drink as ndjson"""
+        Drink(title='tea', recipe=[
+            {'name': 'tea', 'color': 'brown', 'parts': 1}]).insert()
+
+        res = self.client().get('/drinks/export', headers=self.manager)
+        lines = [json.loads(line) for line in res.data.splitlines()]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual([d['title'] for d in lines], ['water', 'tea'])
+        self.assertEqual(lines[1]['recipe'][0]['name'], 'tea')
+
+    def test_export_does_not_cache_drinks(self):
+        """Test the export builds its lines without keeping them"""
+        representation_cache.clear()
+        db.session.execute(Drink.__table__.insert(), [
+            {'id': i, 'title': 'drink %d' % i} for i in range(2, 2002)])
+        db.session.commit()
+        menu_version().bump()
+
+        res = self.client().get('/drinks/export', headers=self.manager)
+
+        self.assertEqual(len(res.data.splitlines()), 2001)
+        self.assertEqual(representation_cache.stats()['size'], 0)
+
+    def legacy_database(self, recipes):
+        """Create a database with the schema of the seed database, drinks
+        with their recipe as a json string"""
+        uri = 'sqlite:///' + os.path.join(self.directory, 'legacy.db')
+        engine = create_engine(uri)
+        with engine.begin() as connection:
+            connection.execute(text(
+                'CREATE TABLE drink (id INTEGER PRIMARY KEY, '
+                'title VARCHAR(80) UNIQUE, recipe VARCHAR(180))'))
+            connection.execute(text(
+                'INSERT INTO drink (title, recipe) VALUES (:title, :recipe)'),
+                [{'title': title, 'recipe': recipe}
+                 for title, recipe in recipes])
+        return uri, engine
+
+    def test_outdated_schema_is_reported(self):
+        """Test requests name the migration to run on an old database"""
+        uri, engine = self.legacy_database([('water', json.dumps(
+            [{'name': 'water', 'color': 'blue', 'parts': 1}]))])
+        engine.dispose()
+        app.config['SQLALCHEMY_DATABASE_URI'] = uri
+
+        res = self.client().get('/drinks')
+        data = json.loads(res.data)
+        migrate(uri, log=lambda message: None)
+        migrated = self.client().get('/drinks')
+
+        self.assertEqual(res.status_code, 500)
+        self.assertIn('python -m src.database.migrate', data['message'])
+        self.assertEqual(migrated.status_code, 200)
+        self.assertEqual(json.loads(migrated.data)['drinks'][0]['title'],
+                         'water')
+
+    def test_migrate_keeps_unparsable_recipes(self):
+        """Test the recipe column is kept when a recipe cannot be migrated"""
+        uri, engine = self.legacy_database([
+            ('water', json.dumps(
+                [{'name': 'water', 'color': 'blue', 'parts': 1}])),
+            ('mud', 'not json')])
+
+        with self.assertRaises(MigrationError):
+            migrate(uri, log=lambda message: None)
+
+        with engine.connect() as connection:
+            self.assertEqual(connection.execute(text(
+                'SELECT recipe FROM drink WHERE id = 2')).scalar(), 'not json')
+            self.assertEqual(connection.execute(text(
+                'SELECT count(*) FROM ingredient')).scalar(), 0)
+        engine.dispose()
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,11 @@
+from setuptools import setup
+
+# the shared fsnd_auth package, installed by the requirements of
+# BasicFlaskAuth and the coffee shop backend
+setup(
+    name='fsnd_auth',
+    version='1.0.0',
+    description='Auth0 access token verification for the FSND Flask apps',
+    packages=['fsnd_auth'],
+    install_requires=['Flask', 'python-jose'],
+)